@@ -97,7 +97,7 @@ def main():
 
     # 7. Caption overlay
     captioned = final_video_path.with_name(final_video_path.stem + "_cap.mp4")
-    caps = create_captions(str(final_video_path))
+    caps = create_captions(str(final_video_path), script=data)
     if caps:
         try:
             captions.add_captions_to_video(
@@ -0,0 +1,181 @@
+"""Prompt-similarity index of generated images.
+
+Every generated image is recorded with a MinHash signature of its prompt's
+word shingles, so a new prompt can be matched against all earlier ones
+(within a run and across runs) by estimated Jaccard similarity. The images
+themselves live in the image cache; the index stores only their cache keys.
+"""
+from __future__ import annotations
+
+import os
+import re
+import json
+import atexit
+import time
+import random
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import List
+
+import numpy as np
+from PIL import Image, ImageEnhance
+
+from config import CACHE_DIR
+
+ASSET_INDEX_PATH = CACHE_DIR / "asset_index.json"
+# Estimated Jaccard similarity at or above which an image is reused as-is
+REUSE_THRESHOLD = float(os.getenv("ASSET_REUSE_THRESHOLD", 0.8))
+# ... and at or above which it is reused as a light variation
+VARY_THRESHOLD = float(os.getenv("ASSET_VARY_THRESHOLD", 0.6))
+# Additions and removals are written at most this often, and on flush/exit
+SAVE_INTERVAL_SECONDS = 5.0
+
+NUM_PERM = 128
+_PRIME = (1 << 61) - 1
+_rng = random.Random(1729)
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+STOPWORDS = frozenset("a an the of and or in on at to with for from by is are as its into".split())
+
+
+def shingles(text: str) -> set:
+    """Lower-cased word unigrams and bigrams, ignoring punctuation and stopwords."""
+    words = [w for w in re.findall(r"[a-z0-9']+", text.lower()) if w not in STOPWORDS]
+    return set(words) | {f"{a} {b}" for a, b in zip(words, words[1:])}
+
+
+def minhash(text: str) -> np.ndarray:
+    """MinHash signature of the prompt's shingles."""
+    tokens = shingles(text) or {""}
+    hashes = [int.from_bytes(hashlib.blake2b(t.encode("utf-8"), digest_size=8).digest(), "little") for t in tokens]
+    # Universal hashing (a * h + b) mod p simulates NUM_PERM random permutations
+    return np.array([min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS], dtype=np.uint64)
+
+
+def similarity(sig_a: np.ndarray, sig_b: np.ndarray) -> float:
+    """Estimated Jaccard similarity of two signatures."""
+    return float(np.mean(sig_a == sig_b))
+
+
+def vary_image(src: str | Path, dest: str | Path, seed: int = 0) -> Path:
+    """
+    Cheap variation of an existing image: slightly re-framed and
+    colour-shifted, at the original size, so reused shots do not repeat exactly.
+    It is never mirrored, which would flip any text or logos in the image.
+    """
+    rng = np.random.RandomState(seed % (1 << 32))
+    with Image.open(src) as img:
+        img = img.convert("RGB")
+        w, h = img.size
+        zoom = rng.uniform(0.88, 0.95)
+        cw, ch = int(w * zoom), int(h * zoom)
+        x0 = rng.randint(0, w - cw + 1)
+        y0 = rng.randint(0, h - ch + 1)
+        img = img.crop((x0, y0, x0 + cw, y0 + ch)).resize((w, h), Image.LANCZOS)
+        img = ImageEnhance.Brightness(img).enhance(rng.uniform(0.94, 1.06))
+        img = ImageEnhance.Color(img).enhance(rng.uniform(0.9, 1.1))
+        img = ImageEnhance.Contrast(img).enhance(rng.uniform(0.95, 1.05))
+    dest = Path(dest)
+    dest.unlink(missing_ok=True)
+    img.save(dest)
+    return dest
+
+
+class AssetIndex:
+    """Persistent list of (prompt, image cache key, size) with MinHash lookup."""
+
+    def __init__(self, path: str | Path = ASSET_INDEX_PATH):
+        self.path = Path(path)
+        self._lock = threading.Lock()
+        self._entries: list = []
+        self._signatures = np.empty((0, NUM_PERM), dtype=np.uint64)
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            self._entries = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Asset index at {self.path} unreadable ({e}); starting empty.")
+            return
+        if self._entries:
+            self._signatures = np.array([e["signature"] for e in self._entries], dtype=np.uint64)
+
+    def _save(self) -> None:
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_suffix(".tmp")
+        tmp.write_text(json.dumps(self._entries), encoding="utf-8")
+        os.replace(tmp, self.path)
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def _touch(self) -> None:
+        self._dirty = True
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL_SECONDS:
+            self._save()
+
+    def flush(self) -> None:
+        """Write pending changes to disk."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _keep(self, keep: list) -> None:
+        self._entries = [self._entries[i] for i in keep]
+        self._signatures = self._signatures[keep]
+
+    def add(self, prompt: str, cache_key: str, width: int, height: int) -> None:
+        """Record a generated image; an entry with the same cache key is replaced."""
+        signature = minhash(prompt)
+        entry = {
+            "prompt": prompt,
+            "cache_key": cache_key,
+            "width": width,
+            "height": height,
+            "created": time.time(),
+            "signature": [int(v) for v in signature],
+        }
+        with self._lock:
+            self._keep([i for i, e in enumerate(self._entries) if e["cache_key"] != cache_key])
+            self._entries.append(entry)
+            self._signatures = np.vstack([self._signatures, signature[None]])
+            self._touch()
+
+    def discard(self, cache_key: str) -> None:
+        """Drop entries whose image is no longer in the cache."""
+        with self._lock:
+            keep = [i for i, e in enumerate(self._entries) if e["cache_key"] != cache_key]
+            if len(keep) < len(self._entries):
+                self._keep(keep)
+                self._touch()
+
+    def find(self, prompt: str, width: int, height: int, threshold: float = VARY_THRESHOLD) -> List[tuple]:
+        """
+        Return ``(entry, similarity)`` pairs, most similar first, for earlier
+        prompts generated at ``width`` x ``height`` that reach ``threshold``.
+        """
+        signature = minhash(prompt)
+        matches = []
+        with self._lock:
+            if not self._entries:
+                return matches
+            scores = np.mean(self._signatures == signature[None], axis=1)
+            for i in np.argsort(-scores, kind="stable"):
+                if scores[i] < threshold:
+                    break
+                entry = self._entries[i]
+                if entry["width"] == width and entry["height"] == height:
+                    matches.append((entry, float(scores[i])))
+        return matches
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+ASSET_INDEX = AssetIndex()
@@ -0,0 +1,41 @@
+"""Audio encodings negotiated between servertts and tts.py.
+
+Each format maps to a libsndfile container/subtype, the media type sent over
+HTTP and the file suffix the client stores. MoviePy's ffmpeg reader opens
+all of them directly, so the assembler needs no transcoding step.
+"""
+from __future__ import annotations
+
+from typing import Optional, Tuple
+
+AUDIO_FORMATS = {
+    "wav": {"format": "WAV", "subtype": "PCM_16", "media_type": "audio/wav", "suffix": ".wav"},
+    "flac": {"format": "FLAC", "subtype": "PCM_16", "media_type": "audio/flac", "suffix": ".flac"},
+    # Needs libsndfile >= 1.0.29 on the server
+    "opus": {"format": "OGG", "subtype": "OPUS", "media_type": "audio/ogg", "suffix": ".ogg"},
+}
+DEFAULT_FORMAT = "wav"
+OPUS_SAMPLE_RATES = (8000, 12000, 16000, 24000, 48000)
+MIN_SAMPLE_RATE = 8000
+MAX_SAMPLE_RATE = 48000
+
+
+def resolve_format(name: Optional[str], sample_rate: Optional[int], native_rate: int) -> Tuple[str, int]:
+    """
+    Validate a requested format and sample rate; returns ``(name, rate)``.
+    Without a rate the model's native rate is kept, except for Opus, which
+    only supports a few rates and gets the closest one above it; a requested
+    rate Opus does not support falls back to the nearest one it does.
+    """
+    name = (name or DEFAULT_FORMAT).lower()
+    if name not in AUDIO_FORMATS:
+        raise ValueError(f"Unknown audio format {name!r}; choose from {sorted(AUDIO_FORMATS)}")
+    if sample_rate is None:
+        if name != "opus":
+            return name, native_rate
+        return name, next((r for r in OPUS_SAMPLE_RATES if r >= native_rate), OPUS_SAMPLE_RATES[-1])
+    if not MIN_SAMPLE_RATE <= sample_rate <= MAX_SAMPLE_RATE:
+        raise ValueError(f"sample_rate must be between {MIN_SAMPLE_RATE} and {MAX_SAMPLE_RATE}")
+    if name == "opus" and sample_rate not in OPUS_SAMPLE_RATES:
+        return name, min(OPUS_SAMPLE_RATES, key=lambda r: abs(r - sample_rate))
+    return name, sample_rate
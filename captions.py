@@ -1,11 +1,14 @@
 import sys
 import os
 import json
+import io
+import wave
 import argparse
 import tempfile
-from typing import List, Dict, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple
 import requests
-from moviepy.editor import TextClip, ImageClip, VideoFileClip, CompositeVideoClip
+from moviepy.editor import TextClip, ImageClip, VideoFileClip, CompositeVideoClip, AudioFileClip
 from PIL import Image, ImageFilter
 import matplotlib.font_manager as fm
 import numpy as np
@@ -19,6 +22,15 @@ if dotenv_path.exists():
 else:
     load_dotenv()
 
+DEFAULT_WHISPER_URL = "http://192.168.1.154:5600/transcribe"
+WHISPER_SAMPLE_RATE = 16000
+CHUNK_TARGET_SECONDS = float(os.getenv("WHISPER_CHUNK_SECONDS", 30))
+CHUNK_MAX_SECONDS = float(os.getenv("WHISPER_CHUNK_MAX_SECONDS", 45))
+SILENCE_THRESHOLD_DB = float(os.getenv("WHISPER_SILENCE_DB", -35))
+MIN_SILENCE_SECONDS = 0.3
+# Chunks in flight per endpoint; a single Whisper server still overlaps uploads with decoding
+WHISPER_CONCURRENCY = int(os.getenv("WHISPER_CONCURRENCY", 2))
+
 
 def extract_audio(input_video_path: str) -> str:
     """
@@ -40,7 +52,7 @@ def transcribe_audio_whisper(audio_file_path: str) -> Dict:
     """
     Transcribes the given audio file via your local Whisper HTTP API.
     """
-    url = os.getenv("WHISPER_API_URL", "http://192.168.1.154:5600/transcribe")
+    url = os.getenv("WHISPER_API_URL", DEFAULT_WHISPER_URL)
     try:
         with open(audio_file_path, "rb") as f:
             response = requests.post(url, files={"audio": f})
@@ -51,6 +63,172 @@ def transcribe_audio_whisper(audio_file_path: str) -> Dict:
         return {}
 
 
+def get_whisper_urls() -> List[str]:
+    """
+    Returns the Whisper endpoints to spread chunked transcription over.
+    WHISPER_API_URLS is a comma separated list; falls back to WHISPER_API_URL.
+    """
+    urls = [u.strip() for u in os.getenv("WHISPER_API_URLS", "").split(",") if u.strip()]
+    return urls or [os.getenv("WHISPER_API_URL", DEFAULT_WHISPER_URL)]
+
+
+def load_audio_samples(audio_file_path: str, sample_rate: int = WHISPER_SAMPLE_RATE) -> np.ndarray:
+    """
+    Decodes an audio file into a mono float32 array at the given sample rate.
+    """
+    clip = AudioFileClip(audio_file_path, fps=sample_rate)
+    try:
+        samples = clip.to_soundarray(fps=sample_rate)
+    finally:
+        clip.close()
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    return samples.astype(np.float32)
+
+
+def detect_silences(
+    samples: np.ndarray,
+    sample_rate: int,
+    threshold_db: float = SILENCE_THRESHOLD_DB,
+    min_silence: float = MIN_SILENCE_SECONDS,
+    frame_ms: int = 20
+) -> List[Tuple[int, int]]:
+    """
+    Finds silent stretches with a frame energy detector.
+    A frame is silent when its RMS is `threshold_db` below the loudest frame.
+    Returns (start_sample, end_sample) pairs of runs at least `min_silence` long.
+    """
+    frame = max(1, int(sample_rate * frame_ms / 1000))
+    n_frames = len(samples) // frame
+    if n_frames == 0:
+        return []
+    frames = samples[:n_frames * frame].reshape(n_frames, frame)
+    rms = np.sqrt(np.mean(np.square(frames, dtype=np.float64), axis=1))
+    db = 20 * np.log10(rms + 1e-10)
+    silent = db < (db.max() + threshold_db)
+
+    # Rising/falling edges of the silent mask give the run boundaries
+    edges = np.diff(np.concatenate(([0], silent.astype(np.int8), [0])))
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    min_frames = int(np.ceil(min_silence * 1000 / frame_ms))
+    return [
+        (int(s * frame), int(e * frame))
+        for s, e in zip(starts, ends) if e - s >= min_frames
+    ]
+
+
+def plan_chunks(
+    total_samples: int,
+    silences: List[Tuple[int, int]],
+    sample_rate: int,
+    target_seconds: float = CHUNK_TARGET_SECONDS,
+    max_seconds: float = CHUNK_MAX_SECONDS
+) -> List[Tuple[int, int]]:
+    """
+    Splits [0, total_samples) into chunks cut at the middle of silences.
+    Each cut lands as close to `target_seconds` as the silences allow; when no
+    silence falls inside `max_seconds` the chunk is cut hard at the limit.
+    """
+    target = int(target_seconds * sample_rate)
+    limit = int(max(max_seconds, target_seconds) * sample_rate)
+    cuts = [(s + e) // 2 for s, e in silences]
+    chunks = []
+    start = 0
+    while total_samples - start > limit:
+        candidates = [c for c in cuts if start + target // 2 < c <= start + limit]
+        end = min(candidates, key=lambda c: abs(c - start - target)) if candidates else start + limit
+        chunks.append((start, end))
+        start = end
+    if start < total_samples:
+        chunks.append((start, total_samples))
+    return chunks
+
+
+def _encode_wav(samples: np.ndarray, sample_rate: int) -> bytes:
+    pcm = (np.clip(samples, -1.0, 1.0) * 32767).astype("<i2")
+    buf = io.BytesIO()
+    with wave.open(buf, "wb") as wf:
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(sample_rate)
+        wf.writeframes(pcm.tobytes())
+    return buf.getvalue()
+
+
+def _transcribe_chunk(urls: List[str], index: int, wav_bytes: bytes) -> Dict:
+    # Round-robin over endpoints, moving on to the next one if a request fails
+    last_error = None
+    for attempt in range(len(urls)):
+        url = urls[(index + attempt) % len(urls)]
+        try:
+            response = requests.post(
+                url, files={"audio": (f"chunk_{index}.wav", wav_bytes, "audio/wav")}
+            )
+            response.raise_for_status()
+            return response.json()
+        except Exception as e:
+            last_error = e
+            print(f"Chunk {index} failed on Whisper API at {url}: {e}")
+    raise RuntimeError(f"Chunk {index} could not be transcribed: {last_error}")
+
+
+def transcribe_audio_chunked(
+    audio_file_path: str,
+    urls: Optional[List[str]] = None,
+    max_workers: Optional[int] = None,
+    target_seconds: float = CHUNK_TARGET_SECONDS,
+    max_seconds: float = CHUNK_MAX_SECONDS
+) -> Dict:
+    """
+    Transcribes long audio by splitting it at silences and sending the chunks
+    concurrently to one or more Whisper endpoints. Segment times are shifted by
+    each chunk's offset so the result has the same shape as
+    transcribe_audio_whisper. Up to WHISPER_CONCURRENCY chunks are in flight
+    per endpoint unless max_workers is given.
+    """
+    urls = urls or get_whisper_urls()
+    try:
+        samples = load_audio_samples(audio_file_path)
+    except Exception as e:
+        print(f"Error decoding audio for chunked transcription: {e}")
+        return {}
+
+    sr = WHISPER_SAMPLE_RATE
+    silences = detect_silences(samples, sr)
+    chunks = plan_chunks(len(samples), silences, sr, target_seconds, max_seconds)
+    print(f"Transcribing {len(chunks)} chunk(s) across {len(urls)} Whisper endpoint(s)")
+
+    workers = max_workers or max(1, WHISPER_CONCURRENCY) * len(urls)
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(
+                lambda item: _transcribe_chunk(urls, item[0], _encode_wav(samples[item[1][0]:item[1][1]], sr)),
+                enumerate(chunks)
+            ))
+    except Exception as e:
+        print(f"Error during chunked transcription: {e}")
+        return {}
+
+    segments, texts = [], []
+    for (start, _), result in zip(chunks, results):
+        offset = start / sr
+        for seg in result.get("segments", []):
+            shifted = dict(seg, id=len(segments), start=seg["start"] + offset, end=seg["end"] + offset)
+            if seg.get("words"):
+                shifted["words"] = [
+                    dict(w, start=w["start"] + offset, end=w["end"] + offset) for w in seg["words"]
+                ]
+            segments.append(shifted)
+        if result.get("text"):
+            texts.append(result["text"].strip())
+
+    merged = {"text": " ".join(texts), "segments": segments}
+    if results and results[0].get("language"):
+        merged["language"] = results[0]["language"]
+    return merged
+
+
 def generate_captions_from_whisper(transcription: Dict) -> List[Dict]:
     captions = []
     for segment in transcription.get('segments', []):
@@ -103,45 +281,17 @@ def _compute_caption_box(video_w: int, video_h: int):
     return (width, height), ('center', y_center)
 
 
-def add_captions_to_video(
-    input_video_path: str,
+def split_transcription_words(
     transcription: List[Dict],
-    output_video_path: str,
-    font_path: Optional[str] = None,
-    fontsize: int = CAPTION_SETTINGS.get('TEXT_SIZE', 24),
-    color: str = CAPTION_SETTINGS.get('COLOR', 'white'),
-    stroke_color: str = CAPTION_SETTINGS.get('STROKE_COLOR', 'black'),
-    stroke_width: int = CAPTION_SETTINGS.get('STROKE_WIDTH', 2),
-    position: Optional[tuple] = None,
-    blur_radius: int = 0,
-    opacity: float = 1.0,
-    max_words_per_caption: int = CAPTION_SETTINGS.get('MAX_WORDS_PER_CAPTION', 8),
     time_scale: float = 1.0,
     start_delay: float = 0.0,
     duration_adjust: float = 0.0,
     per_caption_offset: Optional[Dict[int, float]] = None
-):
-    try:
-        video = VideoFileClip(input_video_path)
-    except Exception as e:
-        print(f"Error loading video: {e}")
-        return
-
-    if font_path is None:
-        try:
-            font_path = get_default_font()
-        except Exception as e:
-            print(e)
-            return
-
-    if not os.path.isfile(font_path):
-        print(f"Font file not found at {font_path}")
-        return
-
-    box_size, dyn_pos = _compute_caption_box(video.w, video.h)
-    max_caption_width = box_size[0]
+) -> List[Dict]:
+    """
+    Spreads each segment's duration evenly over its words.
+    """
     offsets = per_caption_offset or {}
-
     words_list = []
     for idx, seg in enumerate(transcription):
         text = seg['text']
@@ -157,7 +307,13 @@ def add_captions_to_video(
                 "start": start + i * dur,
                 "end": start + (i + 1) * dur
             })
+    return words_list
 
+
+def group_caption_words(words_list: List[Dict], max_words_per_caption: int) -> List[Dict]:
+    """
+    Groups timed words into captions of at most `max_words_per_caption` words.
+    """
     captions = []
     current, s, e = [], None, None
     for w in words_list:
@@ -170,28 +326,51 @@ def add_captions_to_video(
             current, s, e = [], None, None
     if current:
         captions.append({"start": s, "end": e, "text": " ".join(current)})
+    return captions
 
+
+def wrap_caption_lines(captions: List[Dict], fontsize: int, font_path: str, max_width: int) -> List[Dict]:
+    """
+    Breaks each caption into lines that fit within `max_width`.
+    """
     processed = []
     for cap in captions:
         lines, line = [], ""
         for word in cap['text'].split():
             test = f"{line} {word}".strip()
-            if does_text_fit(test, fontsize, font_path, max_caption_width):
+            if does_text_fit(test, fontsize, font_path, max_width):
                 line = test
             else:
                 if line:
                     lines.append(line)
-                if does_text_fit(word, fontsize, font_path, max_caption_width):
+                if does_text_fit(word, fontsize, font_path, max_width):
                     line = word
                 else:
                     for part in split_long_word(word):
-                        if does_text_fit(part, fontsize, font_path, max_caption_width):
+                        if does_text_fit(part, fontsize, font_path, max_width):
                             lines.append(part)
                     line = ""
         if line:
             lines.append(line)
         processed.append({"start": cap['start'], "end": cap['end'], "text": "\n".join(lines)})
+    return processed
+
 
+def build_caption_clips(
+    processed: List[Dict],
+    font_path: str,
+    box_size: tuple,
+    position,
+    fontsize: int = CAPTION_SETTINGS.get('TEXT_SIZE', 24),
+    color: str = CAPTION_SETTINGS.get('COLOR', 'white'),
+    stroke_color: str = CAPTION_SETTINGS.get('STROKE_COLOR', 'black'),
+    stroke_width: int = CAPTION_SETTINGS.get('STROKE_WIDTH', 2),
+    blur_radius: int = 0,
+    opacity: float = 1.0
+) -> list:
+    """
+    Renders wrapped captions into timed, positioned TextClips.
+    """
     clips = []
     for cap in processed:
         try:
@@ -209,8 +388,58 @@ def add_captions_to_video(
             img = moviepy_to_pillow(txt)
             img = img.filter(ImageFilter.GaussianBlur(radius=blur_radius))
             txt = ImageClip(np.array(img)).set_duration(cap['end'] - cap['start'])
-        pos = position if position is not None else dyn_pos
-        clips.append(txt.set_start(cap['start']).set_duration(cap['end'] - cap['start']).set_position(pos))
+        clips.append(txt.set_start(cap['start']).set_duration(cap['end'] - cap['start']).set_position(position))
+    return clips
+
+
+def add_captions_to_video(
+    input_video_path: str,
+    transcription: List[Dict],
+    output_video_path: str,
+    font_path: Optional[str] = None,
+    fontsize: int = CAPTION_SETTINGS.get('TEXT_SIZE', 24),
+    color: str = CAPTION_SETTINGS.get('COLOR', 'white'),
+    stroke_color: str = CAPTION_SETTINGS.get('STROKE_COLOR', 'black'),
+    stroke_width: int = CAPTION_SETTINGS.get('STROKE_WIDTH', 2),
+    position: Optional[tuple] = None,
+    blur_radius: int = 0,
+    opacity: float = 1.0,
+    max_words_per_caption: int = CAPTION_SETTINGS.get('MAX_WORDS_PER_CAPTION', 8),
+    time_scale: float = 1.0,
+    start_delay: float = 0.0,
+    duration_adjust: float = 0.0,
+    per_caption_offset: Optional[Dict[int, float]] = None
+):
+    try:
+        video = VideoFileClip(input_video_path)
+    except Exception as e:
+        print(f"Error loading video: {e}")
+        return
+
+    if font_path is None:
+        try:
+            font_path = get_default_font()
+        except Exception as e:
+            print(e)
+            return
+
+    if not os.path.isfile(font_path):
+        print(f"Font file not found at {font_path}")
+        return
+
+    box_size, dyn_pos = _compute_caption_box(video.w, video.h)
+    max_caption_width = box_size[0]
+
+    words_list = split_transcription_words(
+        transcription, time_scale, start_delay, duration_adjust, per_caption_offset
+    )
+    captions = group_caption_words(words_list, max_words_per_caption)
+    processed = wrap_caption_lines(captions, fontsize, font_path, max_caption_width)
+    clips = build_caption_clips(
+        processed, font_path, box_size, position if position is not None else dyn_pos,
+        fontsize=fontsize, color=color, stroke_color=stroke_color, stroke_width=stroke_width,
+        blur_radius=blur_radius, opacity=opacity
+    )
 
     final_video = CompositeVideoClip([video] + clips)
     try:
@@ -238,6 +467,7 @@ def main():
     parser.add_argument('--start_delay', type=float, default=0.0)
     parser.add_argument('--duration_adjust', type=float, default=0.0)
     parser.add_argument('--per_caption_offset', type=json.loads, default={})
+    parser.add_argument('--chunked', action='store_true', help='Split audio at silences and transcribe chunks in parallel.')
     args = parser.parse_args()
 
     json_file_path = args.json_file
@@ -261,7 +491,10 @@ def main():
     if not audio_path:
         sys.exit(1)
 
-    transcription = transcribe_audio_whisper(audio_path)
+    if args.chunked:
+        transcription = transcribe_audio_chunked(audio_path)
+    else:
+        transcription = transcribe_audio_whisper(audio_path)
     try:
         os.remove(audio_path)
     except:
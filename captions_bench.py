@@ -0,0 +1,174 @@
+#!/usr/bin/env python3
+"""
+Micro-benchmarks for the caption pipeline.
+
+Runs each phase of captions.add_captions_to_video on synthetic transcripts and
+reports wall time and peak Python memory per phase:
+
+    split    - spreading segment times over words
+    group    - grouping words into captions
+    wrap     - line wrapping via does_text_fit
+    clips    - TextClip creation (plus blur when enabled)
+    encode   - CompositeVideoClip over a blank video and libx264 encode
+
+Example:
+    python captions_bench.py --counts 10 100 1000 --font_sizes 60 85 --blur 0 4
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import tempfile
+import tracemalloc
+from itertools import product
+from typing import Callable, Dict, List, Tuple
+
+from moviepy.editor import ColorClip, CompositeVideoClip
+
+import captions
+from config import CAPTION_SETTINGS, VIDEO_SIZE
+
+WORDS = (
+    "the ancient city lay hidden beneath shifting desert sands for nearly three "
+    "thousand years until a storm uncovered its walls revealing temples markets "
+    "and extraordinary inscriptions describing forgotten rulers mysterious rituals"
+).split()
+SEGMENT_SECONDS = 3.0
+WORDS_PER_SEGMENT = (6, 14)
+PHASES = ("split", "group", "wrap", "clips", "encode")
+
+
+def synthetic_transcript(num_captions: int, max_words_per_caption: int, seed: int = 0) -> List[Dict]:
+    """
+    Builds Whisper-style segments that group into roughly `num_captions` captions.
+    """
+    rng = random.Random(seed)
+    target_words = num_captions * max_words_per_caption
+    segments, t, words = [], 0.0, 0
+    while words < target_words:
+        n = min(rng.randint(*WORDS_PER_SEGMENT), target_words - words)
+        text = " ".join(rng.choice(WORDS) for _ in range(n))
+        segments.append({"start": t, "end": t + SEGMENT_SECONDS, "text": text})
+        t += SEGMENT_SECONDS
+        words += n
+    return segments
+
+
+def measure(fn: Callable, *args, **kwargs) -> Tuple[object, float, int]:
+    """
+    Runs `fn` and returns (result, seconds, peak_bytes).
+    Peak memory is what tracemalloc sees, so allocations made by external
+    tools such as ImageMagick and ffmpeg are not included.
+    """
+    tracemalloc.start()
+    start = time.perf_counter()
+    try:
+        result = fn(*args, **kwargs)
+    finally:
+        elapsed = time.perf_counter() - start
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, elapsed, peak
+
+
+def _encode(clips: list, duration: float, fps: int, output_path: str) -> None:
+    base = ColorClip(size=VIDEO_SIZE, color=(0, 0, 0), duration=duration)
+    final = CompositeVideoClip([base] + clips).set_duration(duration)
+    final.write_videofile(output_path, fps=fps, codec="libx264", audio=False, logger=None)
+    final.close()
+
+
+def run_case(
+    num_captions: int,
+    fontsize: int,
+    blur_radius: int,
+    font_path: str,
+    max_words_per_caption: int,
+    encode_seconds: float,
+    fps: int,
+    skip_encode: bool = False
+) -> Dict:
+    """
+    Times every caption phase for one (caption count, font size, blur) case.
+    """
+    box_size, position = captions._compute_caption_box(*VIDEO_SIZE)
+    transcript = synthetic_transcript(num_captions, max_words_per_caption)
+    result = {"captions": num_captions, "fontsize": fontsize, "blur": blur_radius, "phases": {}}
+
+    def record(name, fn, *args, **kwargs):
+        value, seconds, peak = measure(fn, *args, **kwargs)
+        result["phases"][name] = {"seconds": round(seconds, 4), "peak_mb": round(peak / 1024 ** 2, 2)}
+        return value
+
+    words = record("split", captions.split_transcription_words, transcript)
+    grouped = record("group", captions.group_caption_words, words, max_words_per_caption)
+    wrapped = record("wrap", captions.wrap_caption_lines, grouped, fontsize, font_path, box_size[0])
+    clips = record(
+        "clips", captions.build_caption_clips, wrapped, font_path, box_size, position,
+        fontsize=fontsize, blur_radius=blur_radius
+    )
+
+    if not skip_encode:
+        # Only the first `encode_seconds` are encoded; at 1000 captions the
+        # full timeline would be close to an hour of video.
+        duration = min(encode_seconds, max((c["end"] for c in wrapped), default=encode_seconds))
+        with tempfile.TemporaryDirectory() as tmp:
+            record("encode", _encode, clips, duration, fps, os.path.join(tmp, "bench.mp4"))
+
+    for clip in clips:
+        try:
+            clip.close()
+        except Exception:
+            pass
+    return result
+
+
+def print_report(results: List[Dict]) -> None:
+    header = f"{'captions':>8} {'font':>5} {'blur':>4} " + " ".join(f"{p + ' s':>10} {p + ' MB':>10}" for p in PHASES)
+    print(header)
+    print("-" * len(header))
+    for r in results:
+        cols = []
+        for p in PHASES:
+            phase = r["phases"].get(p)
+            cols.append(f"{phase['seconds']:>10.3f} {phase['peak_mb']:>10.2f}" if phase else f"{'-':>10} {'-':>10}")
+        print(f"{r['captions']:>8} {r['fontsize']:>5} {r['blur']:>4} " + " ".join(cols))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the caption pipeline phase by phase.")
+    parser.add_argument("--counts", nargs="+", type=int, default=[10, 100, 1000], help="Caption counts to test.")
+    parser.add_argument("--font_sizes", nargs="+", type=int, default=[CAPTION_SETTINGS.get("TEXT_SIZE", 85)])
+    parser.add_argument("--blur", nargs="+", type=int, default=[0, 4], help="Blur radii to test.")
+    parser.add_argument("--font_path", default=None)
+    parser.add_argument("--max_words_per_caption", type=int, default=CAPTION_SETTINGS.get("MAX_WORDS_PER_CAPTION", 8))
+    parser.add_argument("--encode_seconds", type=float, default=10.0, help="Seconds of video to encode per case.")
+    parser.add_argument("--fps", type=int, default=24)
+    parser.add_argument("--skip_encode", action="store_true", help="Skip the composite/encode phase.")
+    parser.add_argument("--json", dest="json_path", help="Write raw results to this JSON file.")
+    args = parser.parse_args()
+
+    font_path = args.font_path or captions.get_default_font()
+    if not os.path.isfile(font_path):
+        print(f"Font file not found at {font_path}")
+        sys.exit(1)
+
+    results = []
+    for count, fontsize, blur in product(args.counts, args.font_sizes, args.blur):
+        print(f"Running: captions={count} fontsize={fontsize} blur={blur}")
+        results.append(run_case(
+            count, fontsize, blur, font_path, args.max_words_per_caption,
+            args.encode_seconds, args.fps, skip_encode=args.skip_encode
+        ))
+
+    print_report(results)
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=4)
+        print(f"Results saved to {args.json_path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -18,6 +18,10 @@ AUDIO_DIR = OUTPUT_DIR / "audio"
 VISUALS_DIR = OUTPUT_DIR / "visuals"
 CAPTIONS_DIR = OUTPUT_DIR / "captions"
 FINAL_VIDEO_DIR = OUTPUT_DIR / "final"
+CACHE_DIR = OUTPUT_DIR / "cache"
+IMAGE_CACHE_DIR = CACHE_DIR / "images"
+DERIVATIVES_DIR = CACHE_DIR / "derivatives"
+AUDIO_CACHE_DIR = CACHE_DIR / "audio"
 
 # Create directories if they don't exist
 for directory in [VIDEO_SCRIPTS_DIR, AUDIO_DIR, VISUALS_DIR, CAPTIONS_DIR, FINAL_VIDEO_DIR]:
@@ -66,6 +70,11 @@ LEONARDO_NUM_IMAGES = 1
 LEONARDO_ALCHEMY = False
 LEONARDO_MOTION_STRENGTH = 5
 
+# Cache Settings
+IMAGE_CACHE_MAX_BYTES = int(os.getenv('IMAGE_CACHE_MAX_MB', 5000)) * 1024 * 1024
+AUDIO_CACHE_MAX_BYTES = int(os.getenv('AUDIO_CACHE_MAX_MB', 2000)) * 1024 * 1024
+DERIVATIVES_MAX_BYTES = int(os.getenv('DERIVATIVES_MAX_MB', 2000)) * 1024 * 1024
+
 # Other Configurations
 MAX_SCRIPT_TOKENS = 5000
 MAX_RETRIES = 3
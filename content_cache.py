@@ -0,0 +1,195 @@
+"""Content-addressed on-disk cache for generated assets."""
+from __future__ import annotations
+
+import os
+import json
+import atexit
+import time
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Optional
+
+INDEX_FILE = "index.json"
+# Lookups only touch LRU times and counters; they are written at most this often
+SAVE_INTERVAL_SECONDS = 5.0
+
+
+def make_key(*parts) -> str:
+    """Hash the given parameters into a stable cache key."""
+    blob = json.dumps(parts, sort_keys=True, default=str).encode("utf-8")
+    return hashlib.sha256(blob).hexdigest()
+
+
+def file_digest(path: str | Path, block_size: int = 1 << 20) -> str:
+    """Return the SHA-256 of a file's contents."""
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(block_size), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def link_or_copy(src: str | Path, dest: str | Path) -> None:
+    """Hardlink ``src`` to ``dest``, copying when a link is not possible."""
+    dest = Path(dest)
+    if dest.exists() or dest.is_symlink():
+        dest.unlink()
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+class ContentCache:
+    """Size-bounded cache of files keyed by content hash and variant.
+
+    Each key can hold several variants (e.g. ``raw`` and ``upscaled_x4``).
+    Least recently used files are evicted once ``max_bytes`` is exceeded.
+    The index and hit/miss counters are kept in ``index.json`` under ``root``;
+    changes made by lookups are written at most every SAVE_INTERVAL_SECONDS
+    and on :meth:`flush` (also called at exit).
+
+    Files handed out by :meth:`materialize` are hardlinks into the cache, so
+    callers must replace them (unlink, then write) rather than rewrite them
+    in place.
+    """
+
+    def __init__(self, root: str | Path, max_bytes: int):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._index_path = self.root / INDEX_FILE
+        self._entries: dict = {}
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0}
+        self._dirty = False
+        self._last_save = 0.0
+        self._load()
+        atexit.register(self.flush)
+
+    def _load(self) -> None:
+        if not self._index_path.exists():
+            return
+        try:
+            data = json.loads(self._index_path.read_text(encoding="utf-8"))
+            self._entries = data.get("entries", {})
+            self._stats.update(data.get("stats", {}))
+        except (OSError, json.JSONDecodeError) as e:
+            logging.warning(f"Cache index at {self._index_path} unreadable ({e}); starting empty.")
+
+    def _save(self) -> None:
+        tmp = self._index_path.with_suffix(".tmp")
+        tmp.write_text(json.dumps({"entries": self._entries, "stats": self._stats}), encoding="utf-8")
+        os.replace(tmp, self._index_path)
+        self._dirty = False
+        self._last_save = time.monotonic()
+
+    def _touch(self) -> None:
+        """Note an index change from a lookup; saved once the interval has passed."""
+        self._dirty = True
+        if time.monotonic() - self._last_save >= SAVE_INTERVAL_SECONDS:
+            self._save()
+
+    def flush(self) -> None:
+        """Write pending LRU times and counters to the index."""
+        with self._lock:
+            if self._dirty:
+                self._save()
+
+    def _path_for(self, key: str, variant: str, suffix: str) -> Path:
+        return self.root / key[:2] / f"{key}_{variant}{suffix}"
+
+    def get(self, key: str, variant: str = "raw") -> Optional[Path]:
+        """Return the cached file for ``key``/``variant`` or None on a miss."""
+        with self._lock:
+            entry = self._entries.get(f"{key}:{variant}")
+            path = Path(entry["file"]) if entry else None
+            if path is None or not path.exists():
+                if entry:
+                    del self._entries[f"{key}:{variant}"]
+                self._stats["misses"] += 1
+                self._touch()
+                return None
+            entry["last_used"] = time.time()
+            self._stats["hits"] += 1
+            self._touch()
+            return path
+
+    def put(self, key: str, variant: str, src: str | Path, link: bool = False) -> Path:
+        """Store ``src`` under ``key``/``variant`` and return its cache path.
+
+        With ``link`` the cache entry is a hardlink to ``src`` instead of a copy;
+        the caller then owns the same contract as for :meth:`materialize`.
+        """
+        src = Path(src)
+        dest = self._path_for(key, variant, src.suffix)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        if link:
+            link_or_copy(src, dest)
+        else:
+            tmp = dest.with_suffix(dest.suffix + ".part")
+            shutil.copyfile(src, tmp)
+            os.replace(tmp, dest)
+        with self._lock:
+            self._entries[f"{key}:{variant}"] = {
+                "file": str(dest),
+                "size": dest.stat().st_size,
+                "last_used": time.time(),
+            }
+            self._evict(keep=f"{key}:{variant}")
+            self._save()
+        return dest
+
+    def put_bytes(self, key: str, variant: str, data: bytes, suffix: str = "") -> Path:
+        """Store ``data`` under ``key``/``variant`` and return its cache path."""
+        dest = self._path_for(key, variant, suffix)
+        dest.parent.mkdir(parents=True, exist_ok=True)
+        tmp = dest.with_suffix(dest.suffix + ".part")
+        tmp.write_bytes(data)
+        os.replace(tmp, dest)
+        with self._lock:
+            self._entries[f"{key}:{variant}"] = {
+                "file": str(dest),
+                "size": len(data),
+                "last_used": time.time(),
+            }
+            self._evict(keep=f"{key}:{variant}")
+            self._save()
+        return dest
+
+    def materialize(self, key: str, variant: str, dest: str | Path) -> bool:
+        """Hardlink a cached file to ``dest``. Returns False on a miss."""
+        path = self.get(key, variant)
+        if path is None:
+            return False
+        link_or_copy(path, dest)
+        return True
+
+    def _evict(self, keep: Optional[str] = None) -> None:
+        """Drop least recently used entries until within budget, never ``keep``."""
+        total = sum(e["size"] for e in self._entries.values())
+        for name, entry in sorted(self._entries.items(), key=lambda kv: kv[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if name == keep:
+                continue
+            try:
+                Path(entry["file"]).unlink()
+            except FileNotFoundError:
+                pass
+            total -= entry["size"]
+            del self._entries[name]
+            self._stats["evictions"] += 1
+
+    def stats(self) -> dict:
+        """Return hit/miss/eviction counters and current size."""
+        with self._lock:
+            return {
+                **self._stats,
+                "entries": len(self._entries),
+                "bytes": sum(e["size"] for e in self._entries.values()),
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,330 @@
+"""In-process job queue and micro-batching scheduler for the Flux server.
+
+Kept free of torch/diffusers imports so the scheduling logic can be exercised
+with a stub pipeline on CPU-only machines.
+"""
+from __future__ import annotations
+
+import time
+import uuid
+import logging
+import threading
+from io import BytesIO
+from collections import deque
+from typing import Callable, List, Optional
+
+from content_cache import ContentCache, make_key
+
+logger = logging.getLogger("flux-server")
+
+# Finished jobs (and their images) are kept this long for clients to collect
+RESULT_TTL_SECONDS = 3600
+
+# Requests must agree on these to share one pipeline call
+BATCH_FIELDS = ("width", "height", "num_inference_steps", "guidance_scale", "enhance")
+
+
+# Requests that agree on these produce the same image
+REQUEST_FIELDS = ("prompt", "width", "height", "num_inference_steps", "guidance_scale", "seed", "enhance")
+
+
+def batch_key(params: dict) -> tuple:
+    return tuple(params.get(f) for f in BATCH_FIELDS)
+
+
+def request_key(params: dict) -> str:
+    return make_key(*(params.get(f) for f in REQUEST_FIELDS))
+
+
+class PipelineRunner:
+    """Runs a batch of compatible requests as one pipeline call.
+
+    ``pipe`` is called like a diffusers pipeline with a list of prompts and
+    must return an object whose ``images`` are PIL images in prompt order.
+    ``make_generator(seed)`` builds a per-image RNG (``seed`` may be None);
+    without it seeds are ignored, which is what a stub pipeline wants.
+    Stage times of the last batch are left in ``last_timings``.
+    """
+
+    def __init__(self, pipe, make_generator: Optional[Callable] = None):
+        self.pipe = pipe
+        self.make_generator = make_generator
+        self.last_timings: dict[str, float] = {}
+
+    def __call__(self, batch: List[dict]) -> List[bytes]:
+        first = batch[0]
+        logger.info(
+            f"Generating batch of {len(batch)}: size={first['width']}×{first['height']}, "
+            f"steps={first['num_inference_steps']}, scale={first['guidance_scale']}, "
+            f"prompts={[p['prompt'] for p in batch]!r}, seeds={[p.get('seed') for p in batch]}"
+        )
+        generator = None
+        if self.make_generator and any(p.get("seed") is not None for p in batch):
+            generator = [self.make_generator(p.get("seed")) for p in batch]
+        start = time.perf_counter()
+        out = self.pipe(
+            [p["prompt"] for p in batch],
+            width=first["width"],
+            height=first["height"],
+            guidance_scale=first["guidance_scale"],
+            num_inference_steps=first["num_inference_steps"],
+            generator=generator,
+        )
+        inference = time.perf_counter() - start
+        if first.get("enhance"):
+            logger.warning("Enhance flag set, but enhancement is not yet implemented. Returning base image.")
+
+        results = []
+        for img in out.images:
+            buf = BytesIO()
+            img.save(buf, format="PNG")
+            results.append(buf.getvalue())
+        self.last_timings = {"inference": inference, "encode": time.perf_counter() - start - inference}
+        return results
+
+
+class Job:
+    """A single generation request and its lifecycle."""
+
+    def __init__(self, params: dict):
+        self.id = uuid.uuid4().hex
+        self.params = params
+        self.status = "queued"
+        self.created = time.time()
+        self.started: Optional[float] = None
+        self.finished: Optional[float] = None
+        self.result: Optional[bytes] = None
+        self.error: Optional[str] = None
+        # Seconds spent per stage: queue, inference, encode, send
+        self.timings: dict[str, float] = {}
+        self.done = threading.Event()
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "created": self.created,
+            "started": self.started,
+            "finished": self.finished,
+            "error": self.error,
+            "timings": {k: round(v, 3) for k, v in self.timings.items()},
+        }
+
+
+class JobQueue:
+    """FIFO queue of jobs served by a single micro-batching worker thread.
+
+    The worker takes the oldest job, then waits up to ``max_wait`` seconds for
+    more jobs with the same :func:`batch_key`, up to ``max_batch`` in total.
+    ``run`` receives the batch's params and returns one encoded image per
+    job, in order. Per-job run times feed a moving average used for ETAs.
+
+    Submissions identical (per :func:`request_key`) to a queued or running
+    job are attached to that job instead of queueing a new one, and, when a
+    ``cache`` is given, finished images are stored there and served directly
+    to later identical submissions.
+
+    ``on_complete`` is called with every finished batch, e.g. to record
+    metrics from the jobs' ``timings``.
+    """
+
+    def __init__(
+        self,
+        run: Callable[[List[dict]], List[bytes]],
+        max_batch: int = 1,
+        max_wait: float = 0.0,
+        initial_estimate: float = 60.0,
+        cache: Optional[ContentCache] = None,
+        on_complete: Optional[Callable[[List[Job]], None]] = None,
+    ):
+        self.run = run
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait
+        self.avg_seconds = initial_estimate
+        self.cache = cache
+        self.on_complete = on_complete
+        self.counters = {"submitted": 0, "coalesced": 0, "cache_hits": 0, "generated": 0, "failed": 0}
+        self._jobs: dict[str, Job] = {}
+        self._inflight: dict[str, Job] = {}
+        self._pending: deque[Job] = deque()
+        self._running: List[Job] = []
+        self._cond = threading.Condition()
+        self._worker: Optional[threading.Thread] = None
+
+    def start(self) -> None:
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._work, name="flux-worker", daemon=True)
+            self._worker.start()
+
+    def submit(self, params: dict) -> Job:
+        key = request_key(params)
+        with self._cond:
+            self._prune()
+            self.counters["submitted"] += 1
+            existing = self._inflight.get(key)
+            if existing is not None:
+                self.counters["coalesced"] += 1
+                logger.info(f"Coalesced request into in-flight job {existing.id}")
+                return existing
+
+        cached = None
+        if self.cache:
+            path = self.cache.get(key, "png")
+            try:
+                cached = path.read_bytes() if path else None
+            except FileNotFoundError:
+                # Evicted between lookup and read; treat as a miss
+                cached = None
+        job = Job(params)
+        with self._cond:
+            self._jobs[job.id] = job
+            if cached is not None:
+                self.counters["cache_hits"] += 1
+                job.result = cached
+                job.status = "done"
+                job.started = job.finished = time.time()
+                job.done.set()
+                return job
+            # Re-check: an identical job may have been queued meanwhile
+            existing = self._inflight.get(key)
+            if existing is not None:
+                del self._jobs[job.id]
+                self.counters["coalesced"] += 1
+                return existing
+            self._inflight[key] = job
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def stats(self) -> dict:
+        with self._cond:
+            info = dict(self.counters, queue_depth=len(self._pending), running=len(self._running))
+        if self.cache:
+            info["cache"] = self.cache.stats()
+        return info
+
+    def get(self, job_id: str) -> Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def position(self, job: Job) -> int:
+        """Number of jobs ahead of a queued ``job``, counting the running one."""
+        with self._cond:
+            try:
+                return self._pending.index(job) + len(self._running)
+            except ValueError:
+                return 0
+
+    def eta(self, job: Job) -> float:
+        """Estimated seconds until ``job`` finishes."""
+        if job.status in ("done", "failed"):
+            return 0.0
+        if job.status == "running":
+            return max(0.0, self.avg_seconds - (time.time() - job.started))
+        return (self.position(job) + 1) * self.avg_seconds
+
+    def status(self, job: Job) -> dict:
+        info = job.to_dict()
+        if job.status == "queued":
+            info["position"] = self.position(job)
+        info["eta_seconds"] = round(self.eta(job), 1)
+        return info
+
+    def depth(self) -> int:
+        with self._cond:
+            return len(self._pending)
+
+    def _prune(self) -> None:
+        cutoff = time.time() - RESULT_TTL_SECONDS
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished < cutoff]:
+            del self._jobs[job_id]
+
+    def _take_compatible(self, key: tuple, batch: List[Job]) -> None:
+        for job in list(self._pending):
+            if len(batch) >= self.max_batch:
+                return
+            if batch_key(job.params) == key:
+                self._pending.remove(job)
+                batch.append(job)
+
+    def next_batch(self) -> List[Job]:
+        """Block until work is available and return the next batch to run."""
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            first = self._pending.popleft()
+            key = batch_key(first.params)
+            batch = [first]
+            deadline = time.monotonic() + self.max_wait
+            self._take_compatible(key, batch)
+            while len(batch) < self.max_batch:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+                self._take_compatible(key, batch)
+            self._running = batch
+            return batch
+
+    def _execute(self, batch: List[Job]) -> None:
+        results = self.run([job.params for job in batch])
+        if len(results) != len(batch):
+            raise RuntimeError(f"Pipeline returned {len(results)} images for {len(batch)} requests")
+        stage_times = getattr(self.run, "last_timings", {})
+        for job, result in zip(batch, results):
+            job.result = result
+            job.status = "done"
+            job.timings.update(stage_times)
+            if self.cache:
+                self.cache.put_bytes(request_key(job.params), "png", result, ".png")
+
+    def _fail(self, jobs: List[Job], error: Exception) -> None:
+        logger.error(f"Batch {[job.id for job in jobs]} failed: {error}")
+        for job in jobs:
+            job.error = str(error)
+            job.status = "failed"
+
+    def run_batch(self, batch: List[Job]) -> None:
+        """Run one batch and hand each job its image (or its error).
+
+        A failed batch of several jobs (e.g. out of GPU memory) is retried one
+        job at a time, so only the jobs that fail on their own are failed.
+        """
+        started = time.time()
+        for job in batch:
+            job.status = "running"
+            job.started = started
+            job.timings["queue"] = started - job.created
+        try:
+            self._execute(batch)
+        except Exception as e:
+            if len(batch) == 1:
+                self._fail(batch, e)
+            else:
+                logger.warning(f"Batch of {len(batch)} failed ({e}); retrying its jobs one at a time")
+                for job in batch:
+                    try:
+                        self._execute([job])
+                    except Exception as single_error:
+                        self._fail([job], single_error)
+        finished = time.time()
+        # Exponential moving average of per-job run time for ETAs
+        per_job = (finished - started) / len(batch)
+        self.avg_seconds = 0.7 * self.avg_seconds + 0.3 * per_job
+        with self._cond:
+            self._running = []
+            for job in batch:
+                self._inflight.pop(request_key(job.params), None)
+                self.counters["generated" if job.status == "done" else "failed"] += 1
+        for job in batch:
+            job.finished = finished
+            job.done.set()
+        if self.on_complete:
+            try:
+                self.on_complete(batch)
+            except Exception as e:
+                logger.warning(f"on_complete hook failed: {e}")
+
+    def _work(self) -> None:
+        while True:
+            self.run_batch(self.next_batch())
@@ -20,8 +20,7 @@ try:
 except ImportError:
     HAS_NGROK = False
 
-# Pillow for thumbnail compression
-from PIL import Image
+from image_derivatives import DERIVATIVES, INSTAGRAM_IMAGE
 
 load_dotenv()
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -69,28 +68,8 @@ def prepare_thumbnail(path):
     if os.path.getsize(path) <= MAX_IMG_BYTES:
         return path
 
-    img = Image.open(path)
-
-    # Convert RGBA or palette to RGB with white background
-    if img.mode == "RGBA":
-        bg = Image.new("RGB", img.size, (255, 255, 255))
-        bg.paste(img, mask=img.split()[3])
-        img = bg
-    elif img.mode != "RGB":
-        img = img.convert("RGB")
-
-    # Resize width to 1080px if wider
-    if img.width > 1080:
-        h = int(img.height * 1080 / img.width)
-        img = img.resize((1080, h), Image.LANCZOS)
-
-    out = os.path.splitext(path)[0] + "_ig.jpg"
-    quality = 85
-    img.save(out, "JPEG", quality=quality)
-    while os.path.getsize(out) > MAX_IMG_BYTES and quality > 30:
-        quality -= 10
-        img.save(out, "JPEG", quality=quality)
-
+    # Width capped at 1080px, JPEG compressed under the limit; reused if already prepared
+    out = str(DERIVATIVES.upload_image(path, INSTAGRAM_IMAGE))
     logging.info(f"Compressed thumbnail → {out} ({os.path.getsize(out)/1024:.1f} KB)")
     return out
 
@@ -0,0 +1,332 @@
+"""Image generation backends behind one interface, with routing and failover.
+
+A backend turns ``(prompt, config, dest_path)`` into an image file, where
+``config`` is a model config as returned by
+``visuals.get_model_config_by_style``; extra results (e.g. Leonardo's
+ranked alternates) go into the optional ``info`` dict. Each backend declares how many
+generations it can run at once and whether it is healthy. The registry sends
+work to the first healthy backend (in priority order) with a free slot, so a
+saturated backend spills over to the next one, and retries on the next
+backend when one fails or times out.
+
+Failures that belong to one prompt (a failed job, a moderation rejection)
+raise :class:`PromptError` and never count against a backend's health. A
+backend is only cooled down after ``IMAGE_BACKEND_MAX_FAILURES`` failures in
+a row, and never while it is the last healthy one; work waits for a cooling
+backend instead of failing.
+
+Backends are chosen with ``IMAGE_BACKENDS`` (comma separated, highest
+priority first), e.g. ``IMAGE_BACKENDS=flux,leonardo``.
+"""
+from __future__ import annotations
+
+import os
+import time
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import requests
+from PIL import Image, ImageDraw
+
+import visuals
+
+IMAGE_BACKENDS_ENV = os.getenv("IMAGE_BACKENDS", "flux")
+FLUX_CONCURRENCY = int(os.getenv("FLUX_CONCURRENCY", 4))
+LEONARDO_CONCURRENCY = int(os.getenv("LEONARDO_CONCURRENCY", 2))
+STUB_CONCURRENCY = 8
+# A generation not finished after this long raises TimeoutError, a backend failure
+BACKEND_TIMEOUT_SECONDS = int(os.getenv("IMAGE_BACKEND_TIMEOUT", 1800))
+HEALTH_TTL_SECONDS = 30
+# A backend that failed this many times in a row is skipped for FAILURE_COOLDOWN_SECONDS
+MAX_CONSECUTIVE_FAILURES = int(os.getenv("IMAGE_BACKEND_MAX_FAILURES", 3))
+FAILURE_COOLDOWN_SECONDS = 120
+
+
+class PromptError(RuntimeError):
+    """A generation failed for this prompt only; the backend itself is fine."""
+
+
+class ImageBackend:
+    """Base class: health tracking, cooldown after failures and latency stats."""
+
+    name = ""
+
+    def __init__(self, max_concurrency: int, timeout: int = BACKEND_TIMEOUT_SECONDS):
+        self.max_concurrency = max(1, max_concurrency)
+        self.timeout = timeout
+        self.in_flight = 0
+        self.stats = {"succeeded": 0, "failed": 0, "avg_seconds": None}
+        self._healthy: Optional[bool] = None
+        self._checked = 0.0
+        self._down_until = 0.0
+        self._consecutive_failures = 0
+
+    def probe(self) -> bool:
+        """Cheap liveness check; backends without one are assumed healthy."""
+        return True
+
+    def cooldown_remaining(self) -> float:
+        return max(0.0, self._down_until - time.monotonic())
+
+    def cooling_down(self) -> bool:
+        return self.cooldown_remaining() > 0
+
+    def available(self) -> bool:
+        now = time.monotonic()
+        if now < self._down_until:
+            return False
+        if self._healthy is None or now - self._checked > HEALTH_TTL_SECONDS:
+            try:
+                self._healthy = bool(self.probe())
+            except Exception as e:
+                logging.warning(f"Health check for image backend {self.name} failed: {e}")
+                self._healthy = False
+            self._checked = now
+        return self._healthy
+
+    def record_success(self, seconds: float) -> None:
+        avg = self.stats["avg_seconds"]
+        self.stats["avg_seconds"] = seconds if avg is None else 0.7 * avg + 0.3 * seconds
+        self.stats["succeeded"] += 1
+        self._consecutive_failures = 0
+
+    def record_failure(self, error: Exception, allow_cooldown: bool = True) -> None:
+        """
+        Count a backend-level failure. Re-probes health on the next use and,
+        after MAX_CONSECUTIVE_FAILURES in a row, cools the backend down unless
+        ``allow_cooldown`` is False (it is the last healthy backend).
+        """
+        self.stats["failed"] += 1
+        self._consecutive_failures += 1
+        self._checked = 0.0
+        if self._consecutive_failures >= MAX_CONSECUTIVE_FAILURES and allow_cooldown:
+            self._down_until = time.monotonic() + FAILURE_COOLDOWN_SECONDS
+            self._consecutive_failures = 0
+            logging.warning(
+                f"Image backend {self.name} failed {MAX_CONSECUTIVE_FAILURES} times in a row ({error}); "
+                f"skipping it for {FAILURE_COOLDOWN_SECONDS}s"
+            )
+        else:
+            logging.warning(f"Image backend {self.name} failed ({error})")
+
+    def generate(self, prompt: str, config: dict, dest_path: Path, info: Optional[dict] = None) -> Path:
+        raise NotImplementedError
+
+
+class FluxBackend(ImageBackend):
+    """The local Flux server, through the job API in ``visuals``."""
+
+    name = "flux"
+
+    def probe(self) -> bool:
+        return requests.get(f"{visuals.LOCAL_FLUX_API}/health", timeout=5).ok
+
+    def generate(self, prompt: str, config: dict, dest_path: Path, info: Optional[dict] = None) -> Path:
+        # Connection errors and HTTP errors from the server propagate as
+        # backend failures; a job that ran and failed is the prompt's problem
+        job_id = visuals.generate_image(prompt, config, dest_path=str(dest_path))
+        if not job_id:
+            raise RuntimeError(f"Failed to start image generation for prompt: {prompt}")
+        start = time.monotonic()
+        data = visuals.poll_generation_status(job_id, timeout=self.timeout)
+        if not data:
+            # Both a failed job and a timeout come back empty; only the
+            # former is the prompt's fault
+            if time.monotonic() - start >= self.timeout:
+                raise TimeoutError(f"Image generation not finished after {self.timeout}s.")
+            raise PromptError("Image generation failed.")
+        image_url = visuals.extract_image_url(data)
+        if not image_url:
+            raise PromptError("Could not extract image URL.")
+        visuals.download_content(image_url, str(dest_path))
+        return Path(dest_path)
+
+
+def _leonardo_side(side: int) -> int:
+    # Leonardo accepts 32-1536 pixels in multiples of 8
+    return min(1536, max(32, int(side) // 8 * 8))
+
+
+class LeonardoBackend(ImageBackend):
+    """
+    Leonardo.ai; keeps the best of the returned candidates (see visuals2) and
+    reports the others in ``info["alternates"]`` and the pick's scores in
+    ``info["quality"]``, as ``visuals2.process_visuals`` records them.
+    """
+
+    name = "leonardo"
+
+    def probe(self) -> bool:
+        return bool(os.getenv("LEONARDO_API_KEY"))
+
+    def generate(self, prompt: str, config: dict, dest_path: Path, info: Optional[dict] = None) -> Path:
+        # Imported lazily: visuals2 exits at import time without an API key
+        import visuals2
+
+        model_config = {
+            **visuals2.ANIME_XL_MODEL,
+            **config.get("leonardo", {}),
+            "width": _leonardo_side(config["width"]),
+            "height": _leonardo_side(config["height"]),
+        }
+        client = visuals2.get_client()
+        generation_id = client.submit(prompt, model_config)
+        if not generation_id:
+            raise RuntimeError(f"Failed to start Leonardo generation for prompt: {prompt}")
+        start = time.monotonic()
+        data = None
+        for _, data in client.poll_many([generation_id], timeout=self.timeout):
+            pass
+        if not data:
+            if time.monotonic() - start >= self.timeout:
+                raise TimeoutError(f"Leonardo generation not finished after {self.timeout}s.")
+            # Failed generations include moderation rejections of the prompt
+            raise PromptError("Leonardo generation failed.")
+        dest_path = Path(dest_path)
+        best, alternates = visuals2.download_candidates(data, str(dest_path.with_suffix("")))
+        if not best:
+            raise RuntimeError("Could not download any Leonardo candidate.")
+        best_path = Path(best.pop("path"))
+        if info is not None:
+            info["alternates"] = alternates
+            info["quality"] = best
+        if best_path.suffix.lower() != dest_path.suffix.lower():
+            with Image.open(best_path) as img:
+                img.save(dest_path)
+            best_path.unlink()
+        elif best_path != dest_path:
+            os.replace(best_path, dest_path)
+        return dest_path
+
+
+class StubBackend(ImageBackend):
+    """Offline placeholder images (a colour derived from the prompt), for testing."""
+
+    name = "stub"
+
+    def generate(self, prompt: str, config: dict, dest_path: Path, info: Optional[dict] = None) -> Path:
+        digest = hashlib.sha256(prompt.encode("utf-8")).digest()
+        img = Image.new("RGB", (int(config["width"]), int(config["height"])), tuple(digest[:3]))
+        ImageDraw.Draw(img).text((10, 10), prompt[:80], fill=(255, 255, 255))
+        dest_path = Path(dest_path)
+        dest_path.unlink(missing_ok=True)
+        img.save(dest_path)
+        return dest_path
+
+
+BACKEND_TYPES = {
+    "flux": (FluxBackend, FLUX_CONCURRENCY),
+    "leonardo": (LeonardoBackend, LEONARDO_CONCURRENCY),
+    "stub": (StubBackend, STUB_CONCURRENCY),
+}
+
+
+class BackendRegistry:
+    """Priority-ordered backends with per-backend concurrency slots."""
+
+    def __init__(self, backends: List[ImageBackend] = ()):
+        self._backends: Dict[str, ImageBackend] = {}
+        self._cond = threading.Condition()
+        for backend in backends:
+            self.register(backend)
+
+    def register(self, backend: ImageBackend) -> None:
+        with self._cond:
+            self._backends[backend.name] = backend
+
+    def get(self, name: str) -> Optional[ImageBackend]:
+        return self._backends.get(name)
+
+    def capacity(self) -> int:
+        """Total concurrent generations across all backends."""
+        return sum(b.max_concurrency for b in self._backends.values()) or 1
+
+    def _ordered(self, prefer: Optional[str]) -> List[ImageBackend]:
+        backends = list(self._backends.values())
+        if prefer in self._backends:
+            backends.remove(self._backends[prefer])
+            backends.insert(0, self._backends[prefer])
+        return backends
+
+    def _acquire(self, prefer: Optional[str], tried: set) -> Optional[ImageBackend]:
+        """
+        Block until a healthy, untried backend has a free slot, waiting out
+        cooldowns; None once every untried backend fails its health probe.
+        """
+        while True:
+            untried = [b for b in self._ordered(prefer) if b.name not in tried]
+            candidates = [b for b in untried if b.available()]
+            if not candidates and not any(b.cooling_down() for b in untried):
+                return None
+            with self._cond:
+                for backend in candidates:
+                    if backend.in_flight < backend.max_concurrency:
+                        backend.in_flight += 1
+                        return backend
+                # Re-check periodically for free slots, recoveries and expired cooldowns
+                cooldowns = [b.cooldown_remaining() for b in untried if b.cooling_down()]
+                self._cond.wait(timeout=min([5.0] + [c + 0.01 for c in cooldowns]))
+
+    def _others_healthy(self, backend: ImageBackend) -> bool:
+        return any(b is not backend and b.available() for b in self._backends.values())
+
+    def _release(self, backend: ImageBackend) -> None:
+        with self._cond:
+            backend.in_flight -= 1
+            self._cond.notify_all()
+
+    def generate(self, prompt: str, config: dict, dest_path: Path, prefer: Optional[str] = None,
+                 info: Optional[dict] = None) -> tuple:
+        """
+        Generate an image on the best available backend, failing over to the
+        others. Returns ``(path, backend_name)``; backend extras land in ``info``.
+        """
+        tried = set()
+        last_error = None
+        while True:
+            backend = self._acquire(prefer, tried)
+            if backend is None:
+                raise RuntimeError(
+                    f"No image backend could generate {Path(dest_path).name} "
+                    f"(tried {sorted(tried) or 'none available'}): {last_error}"
+                )
+            start = time.monotonic()
+            try:
+                path = backend.generate(prompt, config, dest_path, info)
+            except PromptError as e:
+                logging.warning(f"Image backend {backend.name} could not generate {Path(dest_path).name}: {e}")
+                tried.add(backend.name)
+                last_error = e
+                continue
+            except Exception as e:
+                backend.record_failure(e, allow_cooldown=self._others_healthy(backend))
+                tried.add(backend.name)
+                last_error = e
+                continue
+            else:
+                backend.record_success(time.monotonic() - start)
+                return path, backend.name
+            finally:
+                self._release(backend)
+
+    def stats(self) -> dict:
+        return {
+            name: {**b.stats, "in_flight": b.in_flight, "max_concurrency": b.max_concurrency}
+            for name, b in self._backends.items()
+        }
+
+
+def build_registry(names: str = IMAGE_BACKENDS_ENV) -> BackendRegistry:
+    registry = BackendRegistry()
+    for name in [n.strip() for n in names.split(",") if n.strip()]:
+        if name not in BACKEND_TYPES:
+            raise ValueError(f"Unknown image backend {name!r}; choose from {sorted(BACKEND_TYPES)}")
+        cls, concurrency = BACKEND_TYPES[name]
+        registry.register(cls(concurrency))
+    return registry
+
+
+IMAGE_BACKENDS = build_registry()
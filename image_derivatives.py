@@ -0,0 +1,145 @@
+"""Render- and upload-ready variants of source images.
+
+Each source image is decoded once and the variants consumers need are kept
+next to each other, keyed by the source file and the target size:
+
+* render variants are raw RGB arrays saved as ``.npy`` and loaded memory-mapped,
+  so the assembler gets pixels at exactly the video size without decoding or
+  resampling a PNG on every render;
+* upload variants are compact JPEG/WebP files sized for a given platform.
+"""
+from __future__ import annotations
+
+import io
+import os
+import logging
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+from PIL import Image
+
+from content_cache import ContentCache, make_key
+from config import DERIVATIVES_DIR, DERIVATIVES_MAX_BYTES
+
+# Upload variants used by the social uploaders
+YOUTUBE_THUMBNAIL = {"box": (1280, 720), "format": "JPEG", "max_bytes": 2 * 1024 * 1024}
+INSTAGRAM_IMAGE = {"box": (1080, None), "format": "JPEG", "max_bytes": 8 * 1024 * 1024}
+
+QUALITY_STEPS = [90, 85, 80, 75, 70, 65, 60, 55, 50, 40, 30]
+EXTENSIONS = {"JPEG": ".jpg", "WEBP": ".webp"}
+
+
+def _to_rgb(img: Image.Image) -> Image.Image:
+    """Flatten transparency onto white and convert to RGB."""
+    if img.mode in ("RGBA", "LA") or (img.mode == "P" and "transparency" in img.info):
+        img = img.convert("RGBA")
+        bg = Image.new("RGB", img.size, (255, 255, 255))
+        bg.paste(img, mask=img.split()[3])
+        return bg
+    return img.convert("RGB") if img.mode != "RGB" else img
+
+
+def _fit_box(size: tuple, box: tuple) -> tuple:
+    """Largest size within ``box`` keeping aspect ratio; never enlarges."""
+    w, h = size
+    bw, bh = box
+    scale = min(1.0, (bw or w) / w, (bh or h) / h)
+    return max(1, round(w * scale)), max(1, round(h * scale))
+
+
+class DerivativeStore:
+    """Decode-once store of resized image variants.
+
+    Variants live in a :class:`ContentCache` bounded by ``max_bytes``, so
+    variants of replaced or edited sources age out instead of piling up.
+    """
+
+    def __init__(self, root: str | Path = DERIVATIVES_DIR, max_bytes: int = DERIVATIVES_MAX_BYTES):
+        self.cache = ContentCache(root, max_bytes)
+
+    def _source_key(self, src: str | Path) -> str:
+        # Path, size and mtime identify a source without reading its bytes
+        st = os.stat(src)
+        return make_key(str(Path(src).resolve()), st.st_size, st.st_mtime_ns)
+
+    @staticmethod
+    def _render_variant(size: tuple) -> str:
+        return f"{int(size[0])}x{int(size[1])}"
+
+    @staticmethod
+    def _upload_variant(spec: dict) -> str:
+        bw, bh = spec["box"]
+        return f"fit{bw or 0}x{bh or 0}"
+
+    def render_array(self, src: str | Path, size: tuple) -> np.ndarray:
+        """Return an RGB array of ``src`` at exactly ``size`` (width, height)."""
+        key, variant = self._source_key(src), self._render_variant(size)
+        path = self.cache.get(key, variant)
+        if path is None:
+            self.prepare(src, render_sizes=[size])
+            path = self.cache.get(key, variant)
+            if path is None:
+                raise FileNotFoundError(f"Render variant {variant} of {src} was evicted before use")
+        return np.load(path, mmap_mode="r")
+
+    def upload_image(self, src: str | Path, spec: dict) -> Path:
+        """Return a compact upload file for ``src`` matching ``spec``."""
+        key, variant = self._source_key(src), self._upload_variant(spec)
+        path = self.cache.get(key, variant)
+        if path is None:
+            self.prepare(src, uploads=[spec])
+            path = self.cache.get(key, variant)
+            if path is None:
+                raise FileNotFoundError(f"Upload variant {variant} of {src} was evicted before use")
+        return path
+
+    def prepare(
+        self,
+        src: str | Path,
+        render_sizes: Iterable[tuple] = (),
+        uploads: Iterable[dict] = (),
+    ) -> None:
+        """Decode ``src`` once and write every missing variant."""
+        key = self._source_key(src)
+        render_todo = [s for s in render_sizes if self.cache.get(key, self._render_variant(s)) is None]
+        upload_todo = [u for u in uploads if self.cache.get(key, self._upload_variant(u)) is None]
+        if not render_todo and not upload_todo:
+            return
+
+        with Image.open(src) as img:
+            rgb = _to_rgb(img)
+            rgb.load()
+
+        for size in render_todo:
+            arr = np.asarray(rgb.resize((int(size[0]), int(size[1])), Image.LANCZOS), dtype=np.uint8)
+            buf = io.BytesIO()
+            np.save(buf, arr)
+            self.cache.put_bytes(key, self._render_variant(size), buf.getvalue(), suffix=".npy")
+
+        for spec in upload_todo:
+            self._write_upload(rgb, key, spec)
+
+    def _write_upload(self, rgb: Image.Image, key: str, spec: dict) -> None:
+        fmt = spec.get("format", "JPEG").upper()
+        variant = self._upload_variant(spec)
+        target = _fit_box(rgb.size, spec["box"])
+        img = rgb.resize(target, Image.LANCZOS) if target != rgb.size else rgb
+        max_bytes: Optional[int] = spec.get("max_bytes")
+        # Written beside the cache and linked in; the cache takes its suffix from the file
+        tmp = self.cache.root / f"{key}_{variant}.part{EXTENSIONS[fmt]}"
+        for quality in QUALITY_STEPS:
+            img.save(tmp, format=fmt, quality=quality, optimize=True)
+            if not max_bytes or tmp.stat().st_size <= max_bytes:
+                break
+        else:
+            tmp.unlink(missing_ok=True)
+            raise ValueError(f"Could not reduce {variant} of {key[:12]} under {max_bytes} bytes")
+        try:
+            dest = self.cache.put(key, variant, tmp, link=True)
+        finally:
+            tmp.unlink(missing_ok=True)
+        logging.info(f"Upload variant {dest.name} ({dest.stat().st_size / 1024:.1f} KB)")
+
+
+DERIVATIVES = DerivativeStore()
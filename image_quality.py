@@ -0,0 +1,61 @@
+"""Cheap NumPy quality scores for picking between generated image candidates."""
+from __future__ import annotations
+
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+from PIL import Image
+
+# Images are scored on a downsampled copy; ranking does not need full resolution
+SCORE_MAX_SIDE = 512
+BLANK_STD = 0.02        # luminance std below this is a flat/blank frame
+NEAR_BLACK_MEAN = 0.06  # mean luminance below this is a near-black frame
+CLIP_LEVEL = 0.02       # luminance within this of 0 or 1 counts as clipped
+
+
+def _luminance(path: str | Path) -> np.ndarray:
+    with Image.open(path) as img:
+        img = img.convert("L")
+        img.thumbnail((SCORE_MAX_SIDE, SCORE_MAX_SIDE))
+        return np.asarray(img, dtype=np.float32) / 255.0
+
+
+def laplacian_variance(gray: np.ndarray) -> float:
+    """Variance of the 4-neighbour Laplacian; higher means sharper."""
+    lap = (
+        -4 * gray[1:-1, 1:-1]
+        + gray[:-2, 1:-1] + gray[2:, 1:-1]
+        + gray[1:-1, :-2] + gray[1:-1, 2:]
+    )
+    return float(lap.var())
+
+
+def score_image(path: str | Path) -> dict:
+    """Score an image on sharpness and exposure and flag blank frames.
+
+    ``score`` is 0 for blank or near-black images and otherwise grows with
+    sharpness, scaled down for images far from mid-grey or with clipped
+    shadows/highlights.
+    """
+    gray = _luminance(path)
+    mean = float(gray.mean())
+    std = float(gray.std())
+    sharpness = laplacian_variance(gray) * 1000
+    clipped = float(np.mean((gray < CLIP_LEVEL) | (gray > 1 - CLIP_LEVEL)))
+    exposure = max(0.0, 1.0 - 2 * abs(mean - 0.5)) * (1.0 - clipped)
+    blank = std < BLANK_STD or mean < NEAR_BLACK_MEAN
+    score = 0.0 if blank else float(np.log1p(sharpness) * (0.5 + 0.5 * exposure))
+    return {
+        "sharpness": round(sharpness, 3),
+        "exposure": round(exposure, 3),
+        "clipped": round(clipped, 3),
+        "blank": blank,
+        "score": round(score, 4),
+    }
+
+
+def rank_candidates(paths: List[str | Path]) -> List[Tuple[str, dict]]:
+    """Return (path, scores) pairs, best first."""
+    scored = [(str(p), score_image(p)) for p in paths]
+    return sorted(scored, key=lambda item: item[1]["score"], reverse=True)
@@ -0,0 +1,114 @@
+"""One continuous narration track instead of a WAV per segment.
+
+``write_track`` concatenates the per-segment PCM WAVs into a single WAV and
+writes a sidecar JSON index of each segment's ``start_sample`` and
+``length`` (in samples). The assembler then opens the track once and takes
+each segment as a subclip, so one ffmpeg reader serves the whole video
+instead of one per segment, and captions can be transcribed from the track
+directly.
+"""
+from __future__ import annotations
+
+import os
+import json
+import wave
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+TRACK_FILENAME = "narration.wav"
+COPY_FRAMES = 1 << 16
+
+
+def index_path(track_path) -> Path:
+    return Path(track_path).with_suffix(".index.json")
+
+
+def write_track(entries: List[Tuple[dict, str]], track_path) -> dict:
+    """
+    Concatenate ``(key, wav_path)`` entries, in order, into ``track_path``.
+    ``key`` identifies the segment (e.g. section and segment numbers) and is
+    copied into its index entry. All WAVs must share one PCM format.
+    Returns the index, which is also written next to the track.
+    """
+    track_path = Path(track_path)
+    tmp_path = Path(f"{track_path}.part")
+    segments = []
+    params = None
+    try:
+        with wave.open(str(tmp_path), "wb") as out:
+            position = 0
+            for key, wav_path in entries:
+                with wave.open(str(wav_path), "rb") as src:
+                    fmt = (src.getnchannels(), src.getsampwidth(), src.getframerate())
+                    if params is None:
+                        params = fmt
+                        out.setnchannels(fmt[0])
+                        out.setsampwidth(fmt[1])
+                        out.setframerate(fmt[2])
+                    elif fmt != params:
+                        raise ValueError(f"{wav_path} is {fmt}, expected {params} (channels, width, rate)")
+                    length = src.getnframes()
+                    while True:
+                        frames = src.readframes(COPY_FRAMES)
+                        if not frames:
+                            break
+                        out.writeframes(frames)
+                segments.append({**key, "start_sample": position, "length": length})
+                position += length
+        os.replace(tmp_path, track_path)
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+    channels, sample_width, sample_rate = params or (1, 2, 0)
+    index = {
+        "track": str(track_path),
+        "sample_rate": sample_rate,
+        "channels": channels,
+        "sample_width": sample_width,
+        "segments": segments,
+    }
+    index_path(track_path).write_text(json.dumps(index, indent=2))
+    return index
+
+
+def load_index(track_path) -> Optional[dict]:
+    try:
+        return json.loads(index_path(track_path).read_text())
+    except (OSError, ValueError):
+        return None
+
+
+def segment_seconds(narration: dict, sample_rate: int) -> Optional[Tuple[float, float]]:
+    """(start, end) of a segment within the track, from its narration block."""
+    start = narration.get("track_start")
+    length = narration.get("track_length")
+    if start is None or length is None or not sample_rate:
+        return None
+    return start / sample_rate, (start + length) / sample_rate
+
+
+def track_spans(script: dict) -> List[Tuple[float, float, float]]:
+    """
+    ``(track_start, track_end, video_start)`` in seconds for each segment the
+    assembler placed from the narration track, in track order.
+    """
+    track = script.get("narration_track") or {}
+    spans = []
+    for section in script.get("sections", []):
+        for segment in section.get("segments", []):
+            narration = segment.get("narration", {})
+            bounds = segment_seconds(narration, track.get("sample_rate"))
+            if bounds and narration.get("video_start") is not None:
+                spans.append((bounds[0], bounds[1], narration["video_start"]))
+    return sorted(spans)
+
+
+def to_video_time(t: float, spans: List[Tuple[float, float, float]]) -> float:
+    """Map a time in the narration track to the time it plays in the video."""
+    for start, end, video_start in spans:
+        if t < end:
+            return video_start + max(0.0, t - start)
+    if spans:
+        start, _, video_start = spans[-1]
+        return video_start + t - start
+    return t
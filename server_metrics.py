@@ -0,0 +1,194 @@
+"""Minimal Prometheus text-format metrics for the model servers.
+
+Counters, gauges and histograms with optional labels, rendered by
+``Registry.render()`` for a ``/metrics`` endpoint. Rates such as images per
+second or audio seconds per wall second are derived from the counters with
+PromQL ``rate()``.
+"""
+from __future__ import annotations
+
+import os
+import time
+import resource
+import threading
+from bisect import bisect_left
+from typing import Callable, Dict, Optional, Sequence, Tuple
+
+DEFAULT_BUCKETS = (0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+# Paths that match no route share one label so scanners can't grow cardinality
+UNMATCHED_ROUTE = "other"
+
+
+def route_label(path: str, routes: Sequence = ()) -> str:
+    """The template of the app route matching ``path`` (e.g. ``/jobs/{job_id}``)."""
+    for route in routes:
+        regex = getattr(route, "path_regex", None)
+        if regex is not None and regex.match(path):
+            return route.path
+    return UNMATCHED_ROUTE
+
+
+def process_rss_bytes() -> int:
+    """Current resident set size, falling back to the peak where /proc is missing."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _fmt_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, labels: dict) -> Tuple:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = list(self._values.items())
+        if not items and not self.labels:
+            items = [((), 0.0)]
+        return self.header() + [f"{self.name}{_fmt_labels(self.labels, k)} {v}" for k, v in items]
+
+
+class Gauge(_Metric):
+    """Gauge set directly or computed at scrape time by ``fn``."""
+
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, help_text)
+        self.fn = fn
+        self.value = 0.0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def render(self) -> list:
+        value = self.fn() if self.fn else self.value
+        return self.header() + [f"{self.name} {value}"]
+
+
+class CallbackCounter(Gauge):
+    """Counter whose value is read at scrape time from ``fn``."""
+
+    kind = "counter"
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        self._series: Dict[Tuple, list] = {}
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._series.setdefault(key, [[0] * (len(self.buckets) + 1), 0.0])
+            counts[bisect_left(self.buckets, value)] += 1
+            self._series[key][1] = total + value
+
+    def time(self, **labels):
+        """Context manager observing the elapsed wall time of its block."""
+        return _Timer(self, labels)
+
+    def render(self) -> list:
+        lines = self.header()
+        with self._lock:
+            series = [(k, list(c), s) for k, (c, s) in self._series.items()]
+        for key, counts, total in series:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                le = 'le="%s"' % bound
+                lines.append(f"{self.name}_bucket{_fmt_labels(self.labels, key, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_fmt_labels(self.labels, key)} {total}")
+            lines.append(f"{self.name}_count{_fmt_labels(self.labels, key)} {cumulative}")
+        return lines
+
+
+class _Timer:
+    def __init__(self, histogram: Histogram, labels: dict):
+        self.histogram = histogram
+        self.labels = labels
+        self.elapsed = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.elapsed = time.perf_counter() - self._start
+        self.histogram.observe(self.elapsed, **self.labels)
+        return False
+
+
+class Registry:
+    """Collection of metrics rendered together in Prometheus text format."""
+
+    def __init__(self, prefix: str):
+        self.prefix = prefix
+        self._metrics: list = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, help_text: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(f"{self.prefix}_{name}", help_text, labels))
+
+    def gauge(self, name: str, help_text: str, fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(f"{self.prefix}_{name}", help_text, fn))
+
+    def counter_fn(self, name: str, help_text: str, fn: Callable[[], float]) -> CallbackCounter:
+        return self._add(CallbackCounter(f"{self.prefix}_{name}", help_text, fn))
+
+    def histogram(self, name: str, help_text: str, labels: Sequence[str] = (), buckets=DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(f"{self.prefix}_{name}", help_text, labels, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+def server_timing(timings: Dict[str, float]) -> str:
+    """Format a timing breakdown (seconds) as a Server-Timing header value."""
+    return ", ".join(f"{name};dur={seconds * 1000:.1f}" for name, seconds in timings.items())
@@ -1,15 +1,21 @@
 #!/usr/bin/env python3
 import os
+import time
 import logging
 import torch
 import pynvml
 from diffusers import FluxPipeline
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from io import BytesIO
-from fastapi.responses import StreamingResponse
+from typing import Optional
+from fastapi.responses import Response, StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from PIL import Image
 
+from flux_jobs import JobQueue, PipelineRunner
+from content_cache import ContentCache
+from server_metrics import Registry, route_label, process_rss_bytes, server_timing
+
 # ── PyTorch Memory Tweaks ─────────────────────────────────────────────────────
 os.environ["PYTORCH_CUDA_ALLOC_CONF"] = (
     "expandable_segments:True,"
@@ -48,6 +54,74 @@ pipe.enable_attention_slicing()
 pipe.enable_model_cpu_offload()
 logger.info("✔ Flux pipeline loaded and offloaded")
 
+# ── Job Queue ────────────────────────────────────────────────────────────────
+# Batching trades VRAM for throughput; raise only with memory to spare
+MAX_BATCH = int(os.getenv("FLUX_MAX_BATCH", 1))
+MAX_BATCH_WAIT = float(os.getenv("FLUX_MAX_BATCH_WAIT", 0.5))
+RESULT_CACHE_DIR = os.getenv("FLUX_CACHE_DIR", "flux_cache")
+RESULT_CACHE_MAX_BYTES = int(os.getenv("FLUX_CACHE_MAX_MB", 2000)) * 1024 * 1024
+SEND_CHUNK_SIZE = 256 * 1024
+# Draft-tier requests are capped so storyboard previews stay cheap
+DRAFT_MAX_STEPS = int(os.getenv("FLUX_DRAFT_MAX_STEPS", 12))
+DRAFT_MAX_SIDE = int(os.getenv("FLUX_DRAFT_MAX_SIDE", 768))
+
+# ── Metrics ───────────────────────────────────────────────────────────────────
+metrics = Registry("flux")
+REQUESTS = metrics.counter("requests_total", "HTTP requests by route and status.", ("route", "status"))
+REQUEST_LATENCY = metrics.histogram("request_latency_seconds", "Time to response headers by route.", ("route",))
+STAGE_SECONDS = metrics.histogram(
+    "stage_seconds",
+    "Time by stage: queue and send per job, inference and encode per pipeline call.",
+    ("stage",),
+)
+BATCH_SIZE = metrics.histogram("batch_size", "Jobs per pipeline call.", buckets=(1, 2, 4, 8, 16))
+IMAGES = metrics.counter("images_generated_total", "Images produced by the pipeline.")
+FAILURES = metrics.counter("jobs_failed_total", "Jobs whose pipeline call raised.")
+
+def record_batch(batch):
+    BATCH_SIZE.observe(len(batch))
+    # Inference and encode times are shared by the batch's jobs; observe each
+    # distinct pipeline call once (a failed batch retried singly has several)
+    calls = set()
+    for job in batch:
+        STAGE_SECONDS.observe(job.timings.get("queue", 0.0), stage="queue")
+        call = (job.timings.get("inference"), job.timings.get("encode"))
+        if call[0] is not None and call not in calls:
+            calls.add(call)
+            STAGE_SECONDS.observe(call[0], stage="inference")
+            STAGE_SECONDS.observe(call[1] or 0.0, stage="encode")
+        (IMAGES if job.status == "done" else FAILURES).inc()
+
+def make_generator(seed):
+    """Per-image RNG; unseeded requests in a seeded batch get a random seed."""
+    generator = torch.Generator("cpu")
+    if seed is None:
+        generator.seed()
+    else:
+        generator.manual_seed(seed)
+    return generator
+
+jobs = JobQueue(
+    PipelineRunner(pipe, make_generator),
+    max_batch=MAX_BATCH,
+    max_wait=MAX_BATCH_WAIT,
+    cache=ContentCache(RESULT_CACHE_DIR, RESULT_CACHE_MAX_BYTES),
+    on_complete=record_batch,
+)
+jobs.start()
+
+metrics.gauge("queue_depth", "Jobs waiting for the worker.", fn=jobs.depth)
+metrics.counter_fn("requests_coalesced_total", "Submissions attached to an identical in-flight job.",
+                   fn=lambda: jobs.counters["coalesced"])
+metrics.counter_fn("cache_hits_total", "Submissions served from the result cache.",
+                   fn=lambda: jobs.counters["cache_hits"])
+metrics.gauge("gpu_memory_allocated_bytes", "Memory held by tensors on the Flux GPU.",
+              fn=lambda: torch.cuda.memory_allocated(DEVICE_FLUX))
+metrics.gauge("gpu_memory_reserved_bytes", "Memory reserved by the CUDA caching allocator.",
+              fn=lambda: torch.cuda.memory_reserved(DEVICE_FLUX))
+metrics.gauge("process_resident_memory_bytes", "Resident set size of the server.", fn=process_rss_bytes)
+logger.info(f"Micro-batching up to {MAX_BATCH} requests within {MAX_BATCH_WAIT}s")
+
 # ── FastAPI Setup ─────────────────────────────────────────────────────────────
 app = FastAPI(title="Flux Fast-Load API")
 
@@ -57,35 +131,91 @@ class GenerationRequest(BaseModel):
     height: int = 1024
     guidance_scale: float = 4.5
     num_inference_steps: int = 50
+    seed: Optional[int] = None
     enhance: bool = False  # reserved flag for future ESRGAN
+    tier: str = "final"    # "draft" caps steps and size for quick previews
+
+def _job_params(req: GenerationRequest) -> dict:
+    """Request params as queued; draft requests are clamped to the draft limits."""
+    if req.tier not in ("final", "draft"):
+        raise HTTPException(status_code=422, detail=f"Unknown tier {req.tier!r}")
+    params = req.dict()
+    if req.tier == "draft":
+        params["num_inference_steps"] = min(req.num_inference_steps, DRAFT_MAX_STEPS)
+        longest = max(req.width, req.height)
+        if longest > DRAFT_MAX_SIDE:
+            scale = DRAFT_MAX_SIDE / longest
+            params["width"] = max(16, int(req.width * scale) // 16 * 16)
+            params["height"] = max(16, int(req.height * scale) // 16 * 16)
+    return params
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = route_label(request.url.path, app.routes)
+    REQUESTS.inc(route=route, status=response.status_code)
+    REQUEST_LATENCY.observe(time.perf_counter() - start, route=route)
+    return response
+
+def _image_response(job):
+    """Stream a finished job's PNG, timing the send and exposing the breakdown."""
+    def body():
+        start = time.perf_counter()
+        for i in range(0, len(job.result), SEND_CHUNK_SIZE):
+            yield job.result[i:i + SEND_CHUNK_SIZE]
+        job.timings["send"] = time.perf_counter() - start
+        STAGE_SECONDS.observe(job.timings["send"], stage="send")
+    headers = {"Server-Timing": server_timing(job.timings)} if job.timings else None
+    return StreamingResponse(body(), media_type="image/png", headers=headers)
+
+def _get_job(job_id: str):
+    job = jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Unknown job {job_id}")
+    return job
+
+@app.get("/health")
+async def health():
+    return {"status": "ok", "queue_depth": jobs.depth()}
+
+@app.get("/metrics")
+async def prometheus_metrics():
+    """Prometheus text exposition of request, queue, stage and memory metrics."""
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats():
+    """Request, coalescing and result-cache counters."""
+    return jobs.stats()
+
+@app.post("/jobs")
+async def submit_job(req: GenerationRequest):
+    """Queue a generation and return immediately with its job ID and ETA."""
+    job = jobs.submit(_job_params(req))
+    return jobs.status(job)
+
+@app.get("/jobs/{job_id}")
+async def job_status(job_id: str):
+    return jobs.status(_get_job(job_id))
+
+@app.get("/jobs/{job_id}/result")
+async def job_result(job_id: str):
+    job = _get_job(job_id)
+    if job.status == "failed":
+        raise HTTPException(status_code=500, detail=job.error)
+    if job.status != "done":
+        raise HTTPException(status_code=409, detail=f"Job {job_id} is {job.status}")
+    return _image_response(job)
 
 @app.post("/generate")
 async def generate(req: GenerationRequest):
-    try:
-        logger.info(
-            f"Generating: prompt={req.prompt!r}, size={req.width}×{req.height}, "
-            f"steps={req.num_inference_steps}, scale={req.guidance_scale}, enhance={req.enhance}"
-        )
-        out = pipe(
-            req.prompt,
-            width=req.width,
-            height=req.height,
-            guidance_scale=req.guidance_scale,
-            num_inference_steps=req.num_inference_steps,
-        )
-        img = out.images[0]
-
-        if req.enhance:
-            logger.warning("Enhance flag set, but enhancement is not yet implemented. Returning base image.")
-
-        buf = BytesIO()
-        img.save(buf, format="PNG")
-        buf.seek(0)
-        return StreamingResponse(buf, media_type="image/png")
-
-    except Exception as e:
-        logger.error(f"Inference error: {e}")
-        raise HTTPException(status_code=500, detail=str(e))
+    """Synchronous variant: queue the request and wait for it off the event loop."""
+    job = jobs.submit(_job_params(req))
+    await run_in_threadpool(job.done.wait)
+    if job.status != "done":
+        raise HTTPException(status_code=500, detail=job.error)
+    return _image_response(job)
 
 if __name__ == "__main__":
     import uvicorn
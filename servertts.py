@@ -1,63 +1,317 @@
 # app.py
-from typing import Optional
-import io
+from typing import List, Optional
+import os
+import math
+import time
+import asyncio
+import weakref
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from pydantic import BaseModel
-from starlette.responses import StreamingResponse
+from starlette.responses import Response, StreamingResponse
 
-from TTS.api import TTS
-import soundfile as sf
+import tts_worker
+from audio_formats import AUDIO_FORMATS, resolve_format
+from server_metrics import Registry, route_label, process_rss_bytes, server_timing
+from tts_batch import MEDIA_TYPE as BATCH_MEDIA_TYPE, pack_frame
+from tts_stream import MEDIA_TYPE as STREAM_MEDIA_TYPE, split_sentences, wav_header
 
 app = FastAPI(title="Coqui-TTS Server")
 
-# — Initialize your multi-speaker model once —
-tts = TTS(model_name="tts_models/en/vctk/vits")  # this is multi-speaker :contentReference[oaicite:0]{index=0}
+# — Model replicas —
+# Synthesis runs off the event loop on TTS_REPLICAS model replicas, each in its
+# own process (default) or thread; /voices, /metrics and health checks stay
+# responsive while long narrations are being synthesized.
+MODEL_NAME = "tts_models/en/vctk/vits"  # this is multi-speaker
+TTS_REPLICAS = max(1, int(os.getenv("TTS_REPLICAS", 1)))
+TTS_WORKER_MODE = os.getenv("TTS_WORKER_MODE", "process")  # "process" or "thread"
+# Requests allowed to wait for a replica before new ones get 429
+TTS_QUEUE_SIZE = int(os.getenv("TTS_QUEUE_SIZE", 8))
+MAX_BATCH_ITEMS = int(os.getenv("TTS_MAX_BATCH", 64))
+
+if TTS_WORKER_MODE == "thread":
+    # PyTorch releases the GIL during inference, so threads run replicas in parallel
+    executor = ThreadPoolExecutor(
+        max_workers=TTS_REPLICAS,
+        initializer=tts_worker.init_worker,
+        initargs=(MODEL_NAME,),
+    )
+else:
+    executor = ProcessPoolExecutor(
+        max_workers=TTS_REPLICAS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=tts_worker.init_worker,
+        initargs=(MODEL_NAME, max(1, (os.cpu_count() or 1) // TTS_REPLICAS)),
+    )
+
+# Speakers/languages come from a replica; the server process loads no model
+VOICES = executor.submit(tts_worker.voice_info).result()
+
+class Admission:
+    """Counts queued and running synthesis items and refuses work past capacity."""
+
+    def __init__(self, replicas: int, queue_size: int):
+        self.replicas = replicas
+        self.capacity = replicas + queue_size
+        self.pending = 0
+        self.avg_inference = 5.0
+
+    def try_acquire(self, n: int = 1) -> bool:
+        # Only touched from the event loop, so no lock is needed
+        if self.pending + n > self.capacity:
+            return False
+        self.pending += n
+        return True
+
+    def release(self, n: int = 1) -> None:
+        self.pending -= n
+
+    def retry_after(self) -> int:
+        return max(1, math.ceil(self.avg_inference * self.pending / self.replicas))
+
+admission = Admission(TTS_REPLICAS, TTS_QUEUE_SIZE)
+
+# — Metrics —
+SEND_CHUNK_SIZE = 64 * 1024
+metrics = Registry("tts")
+REQUESTS = metrics.counter("requests_total", "HTTP requests by route and status.", ("route", "status"))
+REQUEST_LATENCY = metrics.histogram("request_latency_seconds", "Time to response headers by route.", ("route",))
+STAGE_SECONDS = metrics.histogram("stage_seconds", "Per-request time by stage: inference, encode, send.", ("stage",))
+AUDIO_SECONDS = metrics.counter("audio_seconds_total", "Seconds of audio synthesized.")
+INFERENCE_SECONDS = metrics.counter(
+    "inference_seconds_total",
+    "Wall seconds spent in the model; audio_seconds_total / this is the realtime factor.",
+)
+REJECTED = metrics.counter("requests_rejected_total", "Requests refused with 429 because the queue was full.")
+metrics.gauge("requests_in_flight", "Synthesis items queued or running.", fn=lambda: admission.pending)
+metrics.gauge("replicas", "Model replicas serving synthesis.", fn=lambda: TTS_REPLICAS)
+metrics.gauge("process_resident_memory_bytes", "Resident set size of the server.", fn=process_rss_bytes)
+
+@app.middleware("http")
+async def record_request(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    route = route_label(request.url.path, app.routes)
+    REQUESTS.inc(route=route, status=response.status_code)
+    REQUEST_LATENCY.observe(time.perf_counter() - start, route=route)
+    return response
+
+@app.get("/metrics", summary="Prometheus metrics")
+async def prometheus_metrics():
+    return Response(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/health", summary="Liveness and queue state")
+async def health():
+    return {"status": "ok", "replicas": TTS_REPLICAS, "pending": admission.pending, "capacity": admission.capacity}
+
+def _timed_body(data: bytes):
+    start = time.perf_counter()
+    for i in range(0, len(data), SEND_CHUNK_SIZE):
+        yield data[i:i + SEND_CHUNK_SIZE]
+    STAGE_SECONDS.observe(time.perf_counter() - start, stage="send")
 
 class TTSRequest(BaseModel):
     text: str
-    speaker: Optional[str] = None  # must match one of tts.speakers
+    speaker: Optional[str] = None  # must match one of the model's speakers
     language: Optional[str] = None
+    format: Optional[str] = None  # "wav" (PCM16, default), "flac" or "opus"
+    sample_rate: Optional[int] = None  # defaults to the model's rate
+
+class TTSBatchRequest(BaseModel):
+    texts: List[str]
+    speaker: Optional[str] = None
+    language: Optional[str] = None
+    format: Optional[str] = None
+    sample_rate: Optional[int] = None
 
 @app.get("/voices", summary="List available speakers & languages")
 async def list_voices():
-    data = {}
-    if tts.is_multi_speaker:
-        data["speakers"] = tts.speakers   # list of strings :contentReference[oaicite:1]{index=1}
-    if tts.is_multi_lingual:
-        data["languages"] = tts.languages
+    data = {"model": MODEL_NAME, "sample_rate": VOICES["sample_rate"], "formats": sorted(AUDIO_FORMATS)}
+    if VOICES["is_multi_speaker"]:
+        data["speakers"] = VOICES["speakers"]
+    if VOICES["is_multi_lingual"]:
+        data["languages"] = VOICES["languages"]
     return data
 
-@app.post("/synthesize", summary="Synthesize text → WAV")
-async def synthesize(req: TTSRequest):
-    if not req.text.strip():
-        raise HTTPException(400, "Text must not be empty")
-
+def _check_voice(speaker: Optional[str], language: Optional[str]) -> None:
     # Enforce speaker selection for multi-speaker models
-    if tts.is_multi_speaker and not req.speaker:
+    if VOICES["is_multi_speaker"] and not speaker:
         raise HTTPException(
             400,
             f"Model is multi-speaker; you must supply `speaker`. "
-            f"Available: {tts.speakers}"
+            f"Available: {VOICES['speakers']}"
         )
 
     # Enforce language selection for multi-lingual models
-    if tts.is_multi_lingual and not req.language:
+    if VOICES["is_multi_lingual"] and not language:
         raise HTTPException(
             400,
             f"Model is multi-lingual; you must supply `language`. "
-            f"Available: {tts.languages}"
+            f"Available: {VOICES['languages']}"
         )
 
-    # Perform TTS
-    wav = tts.tts(
-        text=req.text,
-        speaker=req.speaker,
-        language=req.language
-    )
+def _output_format(fmt: Optional[str], sample_rate: Optional[int]):
+    try:
+        return resolve_format(fmt, sample_rate, VOICES["sample_rate"])
+    except ValueError as e:
+        raise HTTPException(400, str(e))
 
-    # Stream back a WAV
-    buf = io.BytesIO()
-    sf.write(buf, wav, tts.synthesizer.output_sample_rate, format="WAV")
-    buf.seek(0)
-    return StreamingResponse(buf, media_type="audio/wav")
+def _admit(n: int = 1):
+    """
+    Takes ``n`` queue slots or raises 429; returns a function that gives them
+    back, safe to call more than once.
+    """
+    if not admission.try_acquire(n):
+        REJECTED.inc()
+        raise HTTPException(
+            429,
+            f"Synthesis queue is full ({admission.pending}/{admission.capacity})",
+            headers={"Retry-After": str(admission.retry_after())},
+        )
+    held = [n]
+
+    def release() -> None:
+        if held:
+            admission.release(held.pop())
+    return release
+
+def _holding(body, release):
+    """
+    Ties queue slots to a streaming body: its own ``finally`` releases them,
+    and so does dropping a body that was never iterated (e.g. the client
+    disconnected before the first chunk), where that ``finally`` never runs.
+    """
+    weakref.finalize(body, release)
+    return body
+
+async def _synthesize_audio(text: str, speaker: Optional[str], language: Optional[str],
+                            fn=tts_worker.synthesize, **options):
+    """Synthesize one text on a replica; returns (audio bytes, audio seconds, stage timings)."""
+    future = executor.submit(fn, text, speaker, language, **options)
+    data, duration, timings = await asyncio.wrap_future(future)
+    admission.avg_inference = 0.8 * admission.avg_inference + 0.2 * timings["inference"]
+    STAGE_SECONDS.observe(timings["inference"], stage="inference")
+    STAGE_SECONDS.observe(timings["encode"], stage="encode")
+    INFERENCE_SECONDS.inc(timings["inference"])
+    AUDIO_SECONDS.inc(duration)
+    return data, duration, timings
+
+@app.post("/synthesize", summary="Synthesize text → WAV")
+async def synthesize(req: TTSRequest):
+    if not req.text.strip():
+        raise HTTPException(400, "Text must not be empty")
+    _check_voice(req.speaker, req.language)
+    fmt, rate = _output_format(req.format, req.sample_rate)
+
+    # Perform TTS and stream back the encoded audio
+    release = _admit()
+    try:
+        data, _, timings = await _synthesize_audio(req.text, req.speaker, req.language, fmt=fmt, sample_rate=rate)
+    finally:
+        release()
+    headers = {"Server-Timing": server_timing(timings), "X-Sample-Rate": str(rate)}
+    return StreamingResponse(_timed_body(data), media_type=AUDIO_FORMATS[fmt]["media_type"], headers=headers)
+
+@app.post("/synthesize_stream", summary="Synthesize text → WAV streamed sentence by sentence")
+async def synthesize_stream(req: TTSRequest):
+    """
+    Sends a PCM16 WAV header at once, then each sentence's audio as soon as it
+    is synthesized. The header's sizes are unknown while streaming (see
+    tts_stream); a dropped connection means the audio is incomplete. Only
+    the "wav" format can be streamed.
+    """
+    sentences = split_sentences(req.text)
+    if not sentences:
+        raise HTTPException(400, "Text must not be empty")
+    _check_voice(req.speaker, req.language)
+    fmt, rate = _output_format(req.format, req.sample_rate)
+    if fmt != "wav":
+        raise HTTPException(400, "Only the `wav` format can be streamed; use /synthesize")
+    # The current and the upcoming sentence are in flight together
+    release = _admit(min(2, len(sentences)))
+
+    def submit(sentence: str):
+        return asyncio.ensure_future(
+            _synthesize_audio(sentence, req.speaker, req.language, tts_worker.synthesize_pcm, sample_rate=rate)
+        )
+
+    async def body():
+        upcoming = None
+        try:
+            yield wav_header(rate)
+            upcoming = submit(sentences[0])
+            for i in range(len(sentences)):
+                current = upcoming
+                # Queue the next sentence so a replica never waits on the network
+                upcoming = submit(sentences[i + 1]) if i + 1 < len(sentences) else None
+                pcm, _, _ = await current
+                start = time.perf_counter()
+                for j in range(0, len(pcm), SEND_CHUNK_SIZE):
+                    yield pcm[j:j + SEND_CHUNK_SIZE]
+                STAGE_SECONDS.observe(time.perf_counter() - start, stage="send")
+        finally:
+            if upcoming is not None:
+                upcoming.cancel()
+            release()
+
+    headers = {"X-Sentence-Count": str(len(sentences)), "X-Sample-Rate": str(rate)}
+    return StreamingResponse(_holding(body(), release), media_type=STREAM_MEDIA_TYPE, headers=headers)
+
+@app.post("/synthesize_batch", summary="Synthesize several texts → framed WAVs")
+async def synthesize_batch(req: TTSBatchRequest):
+    """
+    Synthesizes the texts with one speaker/language/format, up to one per
+    replica at a time, and streams one frame per text (see tts_batch) as soon
+    as each is ready; frames may arrive out of order and carry their index.
+    """
+    if not req.texts:
+        raise HTTPException(400, "`texts` must not be empty")
+    if len(req.texts) > MAX_BATCH_ITEMS:
+        raise HTTPException(400, f"At most {MAX_BATCH_ITEMS} texts per batch")
+    empty = [i for i, text in enumerate(req.texts) if not text.strip()]
+    if empty:
+        raise HTTPException(400, f"Texts must not be empty (indexes {empty})")
+    _check_voice(req.speaker, req.language)
+    fmt, rate = _output_format(req.format, req.sample_rate)
+
+    # A batch holds at most one queue slot per replica while it runs
+    window = min(len(req.texts), TTS_REPLICAS)
+    release = _admit(window)
+
+    async def run(i: int, text: str):
+        try:
+            data, duration, _ = await _synthesize_audio(text, req.speaker, req.language, fmt=fmt, sample_rate=rate)
+        except Exception as e:
+            return pack_frame({"index": i, "error": str(e)})
+        return pack_frame({
+            "index": i,
+            "media_type": AUDIO_FORMATS[fmt]["media_type"],
+            "sample_rate": rate,
+            "duration": round(duration, 3),
+        }, data)
+
+    async def frames():
+        items = iter(enumerate(req.texts))
+        running = set()
+        try:
+            while True:
+                while len(running) < window:
+                    item = next(items, None)
+                    if item is None:
+                        break
+                    running.add(asyncio.ensure_future(run(*item)))
+                if not running:
+                    return
+                done, running = await asyncio.wait(running, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+        finally:
+            for task in running:
+                task.cancel()
+            release()
+
+    return StreamingResponse(
+        _holding(frames(), release), media_type=BATCH_MEDIA_TYPE, headers={"X-Batch-Count": str(len(req.texts))}
+    )
@@ -0,0 +1,161 @@
+"""Scheduler tests for flux_jobs, driven by a stub pipeline (no torch needed)."""
+import threading
+import time
+from io import BytesIO
+from types import SimpleNamespace
+
+import pytest
+from PIL import Image
+
+from flux_jobs import JobQueue, PipelineRunner
+
+
+class StubPipe:
+    """Records each call and returns one small image per prompt, coloured by prompt length."""
+
+    def __init__(self, fail=None):
+        self.calls = []
+        self.fail = fail
+
+    def __call__(self, prompts, width, height, guidance_scale, num_inference_steps, generator=None):
+        self.calls.append(list(prompts))
+        if self.fail and self.fail(prompts):
+            raise RuntimeError("CUDA out of memory")
+        return SimpleNamespace(images=[Image.new("RGB", (4, 4), (len(p), 0, 0)) for p in prompts])
+
+
+def params(prompt, width=64, height=64, steps=4, guidance=3.5):
+    return {
+        "prompt": prompt,
+        "width": width,
+        "height": height,
+        "num_inference_steps": steps,
+        "guidance_scale": guidance,
+        "seed": None,
+        "enhance": False,
+    }
+
+
+def red_of(job):
+    return Image.open(BytesIO(job.result)).getpixel((0, 0))[0]
+
+
+def test_groups_compatible_requests_only():
+    pipe = StubPipe()
+    queue = JobQueue(PipelineRunner(pipe), max_batch=8)
+    a = queue.submit(params("a"))
+    other_size = queue.submit(params("b", width=128))
+    c = queue.submit(params("cc"))
+    other_steps = queue.submit(params("d", steps=8))
+    other_guidance = queue.submit(params("e", guidance=7.0))
+
+    batch = queue.next_batch()
+    assert batch == [a, c]
+    queue.run_batch(batch)
+    for _ in range(3):
+        queue.run_batch(queue.next_batch())
+    assert pipe.calls == [["a", "cc"], ["b"], ["d"], ["e"]]
+    assert all(j.status == "done" for j in (a, other_size, c, other_steps, other_guidance))
+
+
+def test_max_batch_caps_batch_size():
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=2)
+    jobs = [queue.submit(params(f"p{i}")) for i in range(5)]
+    assert queue.next_batch() == jobs[:2]
+    assert queue.next_batch() == jobs[2:4]
+    assert queue.next_batch() == jobs[4:]
+
+
+def test_max_wait_collects_late_arrivals():
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=4, max_wait=0.5)
+    first = queue.submit(params("a"))
+    late = []
+    timer = threading.Timer(0.1, lambda: late.append(queue.submit(params("b"))))
+    timer.start()
+    batch = queue.next_batch()
+    timer.join()
+    assert batch == [first] + late
+
+
+def test_max_wait_bounds_the_delay():
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=4, max_wait=0.2)
+    first = queue.submit(params("a"))
+    start = time.monotonic()
+    assert queue.next_batch() == [first]
+    assert 0.15 <= time.monotonic() - start < 1.0
+
+
+def test_images_go_back_to_their_jobs():
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=4)
+    jobs = [queue.submit(params("x" * n)) for n in (1, 3, 2)]
+    queue.run_batch(queue.next_batch())
+    assert [red_of(job) for job in jobs] == [1, 3, 2]
+    assert all("inference" in job.timings and "queue" in job.timings for job in jobs)
+
+
+def test_pipeline_error_fails_every_job_in_the_batch():
+    queue = JobQueue(PipelineRunner(StubPipe(fail=lambda prompts: True)), max_batch=4)
+    jobs = [queue.submit(params(f"p{i}")) for i in range(3)]
+    queue.run_batch(queue.next_batch())
+    assert [job.status for job in jobs] == ["failed"] * 3
+    assert all("out of memory" in job.error for job in jobs)
+    assert all(job.done.is_set() for job in jobs)
+    assert queue.counters["failed"] == 3
+
+
+def test_failed_batch_is_retried_one_job_at_a_time():
+    # Fails whenever more than one prompt is batched, like an OOM would
+    pipe = StubPipe(fail=lambda prompts: len(prompts) > 1)
+    queue = JobQueue(PipelineRunner(pipe), max_batch=4)
+    jobs = [queue.submit(params("x" * n)) for n in (1, 2, 3)]
+    queue.run_batch(queue.next_batch())
+    assert pipe.calls == [["x", "xx", "xxx"], ["x"], ["xx"], ["xxx"]]
+    assert [job.status for job in jobs] == ["done"] * 3
+    assert [red_of(job) for job in jobs] == [1, 2, 3]
+
+
+def test_identical_requests_are_coalesced():
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=4)
+    assert queue.submit(params("a")) is queue.submit(params("a"))
+    assert queue.counters["coalesced"] == 1
+
+
+@pytest.mark.parametrize("max_batch", [1, 3])
+def test_worker_thread_finishes_all_jobs(max_batch):
+    queue = JobQueue(PipelineRunner(StubPipe()), max_batch=max_batch, max_wait=0.05)
+    queue.start()
+    jobs = [queue.submit(params(f"p{i}")) for i in range(5)]
+    assert all(job.done.wait(5) for job in jobs)
+    assert all(job.status == "done" for job in jobs)
+
+
+
+def test_result_cache_serves_repeats(tmp_path):
+    from content_cache import ContentCache
+
+    pipe = StubPipe()
+    queue = JobQueue(PipelineRunner(pipe), cache=ContentCache(tmp_path, 10 ** 6))
+    queue.submit(params("a"))
+    queue.run_batch(queue.next_batch())
+    hit = queue.submit(params("a"))
+    assert hit.status == "done" and queue.counters["cache_hits"] == 1
+    assert len(pipe.calls) == 1
+
+
+def test_cache_entry_evicted_before_read_is_a_miss(tmp_path):
+    class EvictingCache:
+        """Finds an entry whose file is gone by the time it is read."""
+
+        def get(self, key, variant):
+            return tmp_path / "evicted.png"
+
+        def put_bytes(self, key, variant, data, suffix=""):
+            pass
+
+        def stats(self):
+            return {}
+
+    queue = JobQueue(PipelineRunner(StubPipe()), cache=EvictingCache())
+    job = queue.submit(params("a"))
+    assert job.status == "queued"
+    assert queue.counters["cache_hits"] == 0
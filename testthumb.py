@@ -5,17 +5,15 @@ import json
 import time
 import logging
 import argparse
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 import openai
 from dotenv import load_dotenv
 
 from config import VISUALS_DIR
-from visuals2 import (
-    generate_image as leonardo_generate_image,
-    poll_generation_status,
-    extract_image_url,
-)
-from visuals import download_content  # For downloading images
+from visuals import get_model_config_by_style
+from image_backends import build_registry
+from image_derivatives import DERIVATIVES, YOUTUBE_THUMBNAIL, INSTAGRAM_IMAGE
 
 # ------------------- CONFIG -------------------
 load_dotenv()
@@ -29,6 +27,8 @@ openai.api_key = OPENAI_API_KEY
 openai.log = "debug"
 logging.basicConfig(level=logging.INFO)
 
+THUMBNAIL_BACKENDS = build_registry(os.getenv("THUMBNAIL_BACKENDS", "leonardo,flux"))
+
 # ----------------------------------------------
 
 def sanitize_filename(name):
@@ -107,48 +107,40 @@ Respond strictly in JSON format:
     prompts['youtube_thumbnail_prompt'] = clean_prompt(prompts['youtube_thumbnail_prompt'])
     prompts['social_media_image_prompt'] = clean_prompt(prompts['social_media_image_prompt'])
 
-    # Generate YouTube thumbnail image (1376x768)
-    yt_model_config = {
-        "id": "de7d3faf-762f-48e0-b3b7-9d0ac3a3fcf3",
-        "name": "Leonardo Phoenix 1.0",
-        "width": 1376,
-        "height": 768,
-        "num_images": 1,
-        "alchemy": True,
-        "enhancePrompt": False,
-        "photoReal": False,
-        "photoRealVersion": "",
-        "presetStyle": "CINEMATIC"
-    }
-    yt_gen_id = leonardo_generate_image(prompts["youtube_thumbnail_prompt"], yt_model_config)
-    yt_poll = poll_generation_status(yt_gen_id)
-    yt_url = extract_image_url(yt_poll)
-    yt_raw_path = VISUALS_DIR / f"yt_raw_{int(time.time()*1000)}.png"
-    download_content(yt_url, str(yt_raw_path))
-
-    # Generate Social Media thumbnail image (1080x1080)
-    sm_model_config = {
-        "id": "de7d3faf-762f-48e0-b3b7-9d0ac3a3fcf3",
-        "name": "Leonardo Phoenix 1.0",
-        "width": 1080,
-        "height": 1080,
-        "num_images": 1,
-        "alchemy": True,
-        "enhancePrompt": False,
-        "photoReal": False,
-        "photoRealVersion": "",
-        "presetStyle": "CINEMATIC"
-    }
-    sm_gen_id = leonardo_generate_image(prompts["social_media_image_prompt"], sm_model_config)
-    sm_poll = poll_generation_status(sm_gen_id)
-    sm_url = extract_image_url(sm_poll)
-    sm_raw_path = VISUALS_DIR / f"social_raw_{int(time.time()*1000)}.png"
-    download_content(sm_url, str(sm_raw_path))
+    # Leonardo first, Flux as failover; sizes are per platform
+    base_config = get_model_config_by_style("thumbnail")
+    leonardo_options = {"num_images": 1, "alchemy": True, "presetStyle": "CINEMATIC"}
+    jobs = [
+        ("yt_raw", prompts["youtube_thumbnail_prompt"], (1376, 768), YOUTUBE_THUMBNAIL),
+        ("social_raw", prompts["social_media_image_prompt"], (1080, 1080), INSTAGRAM_IMAGE),
+    ]
+
+    def generate(job):
+        prefix, prompt, (width, height), upload_spec = job
+        config = {**base_config, "width": width, "height": height, "leonardo": leonardo_options}
+        raw_path = VISUALS_DIR / f"{prefix}_{int(time.time()*1000)}.png"
+        raw_path, backend = THUMBNAIL_BACKENDS.generate(prompt, config, raw_path)
+        logging.info(f"Thumbnail {prefix} generated by {backend}")
+        DERIVATIVES.prepare(raw_path, uploads=[upload_spec])
+        return raw_path
+
+    # Generate both thumbnails at once and keep whichever succeed
+    paths = {}
+    with ThreadPoolExecutor(max_workers=len(jobs)) as pool:
+        futures = {pool.submit(generate, job): job[0] for job in jobs}
+        for fut in as_completed(futures):
+            prefix = futures[fut]
+            try:
+                paths[prefix] = fut.result()
+            except Exception as e:
+                logging.error(f"Thumbnail generation failed for {prefix}: {e}")
+    yt_raw_path = paths.get("yt_raw")
+    sm_raw_path = paths.get("social_raw")
 
     # Save AI-generated images as thumbnails
     script["thumbnails"] = {
-        "youtube": str(yt_raw_path),
-        "social": str(sm_raw_path)
+        "youtube": str(yt_raw_path) if yt_raw_path else None,
+        "social": str(sm_raw_path) if sm_raw_path else None
     }
     return script
 
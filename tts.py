@@ -1,58 +1,292 @@
 import os
 import json
+import time
+import wave
+import unicodedata
 import requests
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from requests.adapters import HTTPAdapter
 from config import tts_default_speaker, tts_default_language  # config loads .env
+from config import AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES
+from content_cache import ContentCache, make_key
+from tts_batch import read_frames
+from tts_stream import patch_wav_header
+from audio_formats import AUDIO_FORMATS, MAX_SAMPLE_RATE, resolve_format
+from narration_track import TRACK_FILENAME, index_path, write_track
 
 # Constants
 LOCAL_TTS_URL = os.getenv("LOCAL_TTS_URL", "http://192.168.1.154:5500")
 AUDIO_DIR = Path("audio")
 AUDIO_DIR.mkdir(exist_ok=True)
-CHUNK_SIZE = 1024
+# Large reads keep the per-chunk overhead negligible on multi-megabyte narrations
+CHUNK_SIZE = 1024 * 1024
+# Output sample rate; unset keeps the model's own rate
+TTS_SAMPLE_RATE = int(os.getenv("TTS_SAMPLE_RATE", 0)) or None
+# Encoding requested from the server: "wav" (PCM16), "flac" or "opus". Checked
+# with the server's own rules, so a bad setting fails here at import rather
+# than as a 400 on every segment
+try:
+    TTS_FORMAT, _rate = resolve_format(os.getenv("TTS_FORMAT", "wav"), TTS_SAMPLE_RATE, MAX_SAMPLE_RATE)
+except ValueError as e:
+    raise ValueError(f"Invalid TTS_FORMAT/TTS_SAMPLE_RATE: {e}") from None
+if TTS_SAMPLE_RATE and _rate != TTS_SAMPLE_RATE:
+    print(f"TTS_FORMAT={TTS_FORMAT} does not support {TTS_SAMPLE_RATE} Hz; using {_rate} Hz.")
+    TTS_SAMPLE_RATE = _rate
+AUDIO_SUFFIX = AUDIO_FORMATS[TTS_FORMAT]["suffix"]
+# Cache entries are kept per encoding so switching formats never mixes them up
+CACHE_VARIANT = TTS_FORMAT if TTS_SAMPLE_RATE is None else f"{TTS_FORMAT}-{TTS_SAMPLE_RATE}"
+# Segments synthesized at once; 1 restores the old one-by-one behaviour
+TTS_CONCURRENCY = int(os.getenv("TTS_CONCURRENCY", 4))
+TTS_RETRIES = int(os.getenv("TTS_RETRIES", 3))
+RETRY_BACKOFF_SECONDS = 2
+REQUEST_TIMEOUT = 300
+MAX_RETRY_AFTER_SECONDS = 60
+# Segments per /synthesize_batch request; 1 sends one request per segment
+TTS_BATCH_SIZE = int(os.getenv("TTS_BATCH_SIZE", 16))
+# Single segments are streamed sentence by sentence (/synthesize_stream) and
+# written as they arrive; narrations at least this long skip batching for it
+TTS_STREAM = os.getenv("TTS_STREAM", "1") != "0"
+TTS_STREAM_MIN_CHARS = int(os.getenv("TTS_STREAM_MIN_CHARS", 600))
+# Also join all narration into one track with a sample-offset index (PCM WAV only)
+TTS_SINGLE_TRACK = os.getenv("TTS_SINGLE_TRACK", "0") == "1"
+# Fallback when the server does not report its model via /voices
+TTS_MODEL = os.getenv("TTS_MODEL", "tts_models/en/vctk/vits")
+# After a failed /voices lookup the fallback is used this long before asking again
+SERVER_MODEL_RETRY_SECONDS = 60
 
+# Synthesized audio is cached by what determines it, so reruns skip the server
+AUDIO_CACHE = ContentCache(AUDIO_CACHE_DIR, AUDIO_CACHE_MAX_BYTES)
+_server_model = None
+_server_model_retry_at = 0.0
+_batch_supported = True
+_stream_supported = True
 
-def generate_tts_local(narration_text, audio_path, speaker=None, language=None):
+# Shared keep-alive session, pooled for the worker threads
+SESSION = requests.Session()
+SESSION.mount("http://", HTTPAdapter(pool_maxsize=max(TTS_CONCURRENCY, 4)))
+SESSION.mount("https://", HTTPAdapter(pool_maxsize=max(TTS_CONCURRENCY, 4)))
+
+
+def normalize_text(text):
+    """Unicode-normalize and collapse whitespace so trivial edits still hit the cache."""
+    return " ".join(unicodedata.normalize("NFKC", text).split())
+
+
+def server_model():
+    """
+    Model name reported by the TTS server, looked up once per process. A
+    failed lookup falls back to TTS_MODEL for SERVER_MODEL_RETRY_SECONDS.
+    """
+    global _server_model, _server_model_retry_at
+    if _server_model is None:
+        if time.monotonic() < _server_model_retry_at:
+            return TTS_MODEL
+        try:
+            response = SESSION.get(f"{LOCAL_TTS_URL}/voices", timeout=10)
+            response.raise_for_status()
+            _server_model = response.json().get("model") or TTS_MODEL
+        except (requests.RequestException, ValueError):
+            _server_model_retry_at = time.monotonic() + SERVER_MODEL_RETRY_SECONDS
+            return TTS_MODEL
+    return _server_model
+
+
+def audio_cache_key(text, speaker, language, model):
+    return make_key(normalize_text(text), speaker, language, model)
+
+
+def generate_tts_local(narration_text, audio_path, speaker=None, language=None, stream=TTS_STREAM):
     """
     Generate TTS audio using a local OpenTTS server and save it to a file.
+    Audio already synthesized for the same normalized text, speaker, language
+    and model is hardlinked from the audio cache instead. With `stream`, the
+    server sends audio sentence by sentence and it is written as it arrives.
     """
-    url = f"{LOCAL_TTS_URL}/synthesize"
+    global _stream_supported
+    # Only PCM WAV can be streamed sentence by sentence
+    stream = stream and _stream_supported and TTS_FORMAT == "wav"
+    url = f"{LOCAL_TTS_URL}/synthesize_stream" if stream else f"{LOCAL_TTS_URL}/synthesize"
     # Use default speaker/language if not provided
     _speaker = speaker or tts_default_speaker
     _language = language or tts_default_language
+    cache_key = audio_cache_key(narration_text, _speaker, _language, server_model())
+    if AUDIO_CACHE.materialize(cache_key, CACHE_VARIANT, audio_path):
+        print(f"Audio cache hit: {audio_path}")
+        return True
     # Build payload
     payload = {
         "text": narration_text,
-        "speaker": _speaker
+        "speaker": _speaker,
+        "format": TTS_FORMAT,
     }
     if _language:
         payload["language"] = _language
+    if TTS_SAMPLE_RATE:
+        payload["sample_rate"] = TTS_SAMPLE_RATE
     headers = {"Content-Type": "application/json"}
 
     
 
-    response = requests.post(url, json=payload, headers=headers, stream=True)
-    if response.status_code == 200:
-        with open(audio_path, "wb") as f:
-            for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
-                if chunk:
-                    f.write(chunk)
-        print(f"Audio content saved to {audio_path}")
-        return True
-    else:
-        print(f"Error: {response.status_code} - {response.text}")
+    try:
+        response = SESSION.post(url, json=payload, headers=headers, stream=True, timeout=REQUEST_TIMEOUT)
+    except requests.RequestException as e:
+        print(f"Error: TTS request failed - {e}")
         return False
+    if stream and response.status_code in (404, 405):
+        response.close()
+        _stream_supported = False
+        print("TTS server has no streaming endpoint; using /synthesize.")
+        return generate_tts_local(narration_text, audio_path, speaker, language, stream=False)
+    with response:
+        if response.status_code == 200:
+            # Write to a temporary file so a dropped connection never leaves a truncated WAV
+            tmp_path = Path(f"{audio_path}.part")
+            try:
+                with open(tmp_path, "wb") as f:
+                    for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                        if chunk:
+                            f.write(chunk)
+                if stream:
+                    # Streamed WAVs are sent with unknown sizes in the header
+                    patch_wav_header(tmp_path)
+                os.replace(tmp_path, audio_path)
+            except (OSError, ValueError, requests.RequestException) as e:
+                print(f"Error: writing {audio_path} failed - {e}")
+                return False
+            finally:
+                tmp_path.unlink(missing_ok=True)
+            AUDIO_CACHE.put(cache_key, CACHE_VARIANT, audio_path, link=True)
+            print(f"Audio content saved to {audio_path}")
+            return True
+        elif response.status_code == 429:
+            # Server queue is full; wait as long as it asks before the caller retries
+            delay = _retry_after(response)
+            print(f"TTS server busy; waiting {delay}s")
+            time.sleep(delay)
+            return False
+        else:
+            print(f"Error: {response.status_code} - {response.text}")
+            return False
+
+
+def _retry_after(response):
+    try:
+        return min(MAX_RETRY_AFTER_SECONDS, max(1, int(response.headers.get("Retry-After", RETRY_BACKOFF_SECONDS))))
+    except ValueError:
+        return RETRY_BACKOFF_SECONDS
 
 
-def process_tts(script_data, audio_dir=AUDIO_DIR):
+def _cached_audio(text, audio_path, speaker, language):
+    """Hardlink cached audio for a segment into place; False on a miss."""
+    _speaker = speaker or tts_default_speaker
+    _language = language or tts_default_language
+    return AUDIO_CACHE.materialize(audio_cache_key(text, _speaker, _language, server_model()), CACHE_VARIANT, audio_path)
+
+
+def synthesize_batch(texts, audio_paths, speaker=None, language=None, retries=TTS_RETRIES):
+    """
+    Synthesize several texts in one /synthesize_batch request. Each item is
+    written to its path (and cached) as its frame arrives. A busy server
+    (429) is asked again after its Retry-After, up to `retries` attempts.
+    Returns one bool per text, or None when the server has no batch endpoint.
+    """
+    global _batch_supported
+    _speaker = speaker or tts_default_speaker
+    _language = language or tts_default_language
+    payload = {"texts": list(texts), "speaker": _speaker, "format": TTS_FORMAT}
+    if _language:
+        payload["language"] = _language
+    if TTS_SAMPLE_RATE:
+        payload["sample_rate"] = TTS_SAMPLE_RATE
+    model = server_model()
+    results = [False] * len(texts)
+    for attempt in range(1, max(1, retries) + 1):
+        response = SESSION.post(f"{LOCAL_TTS_URL}/synthesize_batch", json=payload, stream=True,
+                                timeout=REQUEST_TIMEOUT)
+        if response.status_code != 429 or attempt >= retries:
+            break
+        delay = _retry_after(response)
+        response.close()
+        print(f"TTS server busy; retrying batch of {len(texts)} in {delay}s (attempt {attempt}/{retries})")
+        time.sleep(delay)
+    with response:
+        if response.status_code in (404, 405):
+            _batch_supported = False
+            print("TTS server has no batch endpoint; synthesizing segments one by one.")
+            return None
+        response.raise_for_status()
+        response.raw.decode_content = True
+        for header, data in read_frames(response.raw):
+            i = header["index"]
+            audio_path = Path(audio_paths[i])
+            if header.get("error"):
+                print(f"Error: TTS for {audio_path.stem} failed - {header['error']}")
+                continue
+            tmp_path = Path(f"{audio_path}.part")
+            tmp_path.write_bytes(data)
+            os.replace(tmp_path, audio_path)
+            AUDIO_CACHE.put(audio_cache_key(texts[i], _speaker, _language, model), CACHE_VARIANT, audio_path, link=True)
+            print(f"Audio content saved to {audio_path}")
+            results[i] = True
+    return results
+
+
+def _synthesize_group(group, speaker, language, retries):
+    """
+    Synthesize a group of (text, audio_path) pairs with one batch request;
+    items the batch could not produce are retried one by one.
+    """
+    results = None
+    if _batch_supported and len(group) > 1:
+        try:
+            results = synthesize_batch([t for t, _ in group], [p for _, p in group], speaker, language, retries)
+        except (requests.RequestException, EOFError, ValueError) as e:
+            print(f"Error: batch TTS request failed - {e}; retrying segments one by one")
+    if results is None:
+        results = [False] * len(group)
+    return [
+        ok or _synthesize_with_retries(text, audio_path, speaker, language, retries)
+        for ok, (text, audio_path) in zip(results, group)
+    ]
+
+
+def _synthesize_with_retries(text, audio_path, speaker, language, retries):
+    for attempt in range(1, retries + 1):
+        if generate_tts_local(text, audio_path, speaker=speaker, language=language):
+            return True
+        if attempt < retries:
+            delay = RETRY_BACKOFF_SECONDS * attempt
+            print(f"Retrying {audio_path.name} in {delay}s (attempt {attempt}/{retries} failed)")
+            time.sleep(delay)
+    return False
+
+
+def process_tts(script_data, audio_dir=AUDIO_DIR, max_workers=TTS_CONCURRENCY, retries=TTS_RETRIES,
+                batch_size=TTS_BATCH_SIZE, single_track=TTS_SINGLE_TRACK):
     """
     Process the script JSON, generate audio for each narration segment,
     and update the JSON with audio paths.
+
+    Segments found in the audio cache are linked into place first. Narrations
+    of at least TTS_STREAM_MIN_CHARS are streamed one per request; the rest
+    are sent in /synthesize_batch requests of up to `batch_size` texts, with
+    up to `max_workers` requests in flight over a shared session; segments
+    a batch could not produce are retried one by one up to `retries` times.
+    Every segment gets the same file name as in a serial run and its result
+    is written back into its own narration block, so the script is never
+    reordered.
+
+    With `single_track`, the segments are then concatenated into one track
+    (see narration_track); each narration block gets its `track_start` and
+    `track_length` in samples and the script a `narration_track` entry.
     """
     sections = script_data.get("sections", [])
     # Optional speaker and language settings at top level
     speaker = script_data.get("speaker")
     language = script_data.get("language")
 
+    jobs = []
     for section_idx, section in enumerate(sections, start=1):
         segments = section.get("segments", [])
         if not segments:
@@ -67,18 +301,86 @@ def process_tts(script_data, audio_dir=AUDIO_DIR):
                 print(f"Section {section_idx}, Segment {segment_idx} has no narration text. Skipping.")
                 continue
 
-            print(f"Generating TTS for Section {section_idx}, Segment {segment_idx}: {text}")
+            # Suffix follows TTS_FORMAT; the assembler reads any of them as is
+            audio_filename = f"section_{section_idx}_segment_{segment_idx}{AUDIO_SUFFIX}"
+            jobs.append((segment, text, Path(audio_dir) / audio_filename, (section_idx, segment_idx)))
 
-            # Save as WAV for compatibility with OpenTTS output
-            audio_filename = f"section_{section_idx}_segment_{segment_idx}.wav"
-            audio_path = audio_dir / audio_filename
+    failed = 0
+    pending = []
+    for segment, text, audio_path, _ in jobs:
+        if _cached_audio(text, audio_path, speaker, language):
+            print(f"Audio cache hit: {audio_path}")
+            segment.setdefault("narration", {})["audio_path"] = str(audio_path)
+        else:
+            pending.append((segment, text, audio_path))
 
-            success = generate_tts_local(text, audio_path, speaker=speaker, language=language)
-            segment.setdefault("narration", {})["audio_path"] = str(audio_path) if success else None
+    batch_size = max(1, batch_size)
+    # Long narrations are streamed on their own rather than held whole in a batch
+    groups, batched = [], []
+    for job in pending:
+        if TTS_STREAM and len(job[1]) >= TTS_STREAM_MIN_CHARS:
+            groups.append([job])
+        else:
+            batched.append(job)
+    groups += [batched[i:i + batch_size] for i in range(0, len(batched), batch_size)]
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as pool:
+        futures = {}
+        for group in groups:
+            for _, text, audio_path in group:
+                print(f"Generating TTS for {audio_path.stem}: {text}")
+            futures[pool.submit(
+                _synthesize_group, [(text, path) for _, text, path in group], speaker, language, retries
+            )] = group
+        for fut in as_completed(futures):
+            group = futures[fut]
+            try:
+                outcomes = fut.result()
+            except Exception as e:
+                print(f"Error: TTS for {group[0][2].stem}..{group[-1][2].stem} failed - {e}")
+                outcomes = [False] * len(group)
+            for (segment, _, audio_path), success in zip(group, outcomes):
+                failed += not success
+                segment.setdefault("narration", {})["audio_path"] = str(audio_path) if success else None
 
+    if failed:
+        print(f"TTS failed for {failed} of {len(jobs)} segment(s).")
+    print(f"Audio cache: {AUDIO_CACHE.stats()}")
+    if single_track:
+        build_narration_track(script_data, jobs, audio_dir)
     return script_data
 
 
+def build_narration_track(script_data, jobs, audio_dir=AUDIO_DIR):
+    """Concatenate the synthesized segments into one track and record their offsets."""
+    script_data.pop("narration_track", None)
+    for segment, _, _, _ in jobs:
+        segment.get("narration", {}).pop("track_start", None)
+        segment.get("narration", {}).pop("track_length", None)
+    if TTS_FORMAT != "wav":
+        print(f"Single narration track needs TTS_FORMAT=wav (got {TTS_FORMAT}); keeping per-segment files.")
+        return None
+    done = [(segment, path, ids) for segment, _, path, ids in jobs
+            if segment.get("narration", {}).get("audio_path")]
+    if not done:
+        return None
+    track_path = Path(audio_dir) / TRACK_FILENAME
+    try:
+        index = write_track([({"section": s, "segment": g}, path) for _, path, (s, g) in done], track_path)
+    except (OSError, EOFError, ValueError, wave.Error) as e:
+        print(f"Error: building narration track failed - {e}; keeping per-segment files.")
+        return None
+    for (segment, _, _), entry in zip(done, index["segments"]):
+        segment["narration"]["track_start"] = entry["start_sample"]
+        segment["narration"]["track_length"] = entry["length"]
+    script_data["narration_track"] = {
+        "path": str(track_path),
+        "index": str(index_path(track_path)),
+        "sample_rate": index["sample_rate"],
+    }
+    print(f"Narration track with {len(done)} segment(s) saved to {track_path}")
+    return track_path
+
+
 def save_audio_paths(updated_script, filename="video_script_with_audio.json"):
     """
     Save the updated script JSON with audio paths to a file.
@@ -0,0 +1,42 @@
+"""Wire format of servertts' /synthesize_batch responses.
+
+The body is a sequence of frames, one per requested text, sent as each item
+finishes: a 4-byte big-endian header length, a JSON header (``index``,
+``length`` and audio metadata, or ``error``) and ``length`` bytes of audio.
+"""
+from __future__ import annotations
+
+import json
+import struct
+from typing import Iterator, Tuple
+
+MEDIA_TYPE = "application/x-tts-batch"
+_LEN = struct.Struct(">I")
+
+
+def pack_frame(header: dict, payload: bytes = b"") -> bytes:
+    meta = json.dumps({**header, "length": len(payload)}).encode("utf-8")
+    return _LEN.pack(len(meta)) + meta + payload
+
+
+def _read_exact(stream, size: int) -> bytes:
+    chunks = []
+    while size:
+        chunk = stream.read(size)
+        if not chunk:
+            raise EOFError("Batch response ended mid-frame")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b"".join(chunks)
+
+
+def read_frames(stream) -> Iterator[Tuple[dict, bytes]]:
+    """Yield ``(header, payload)`` for each frame of a file-like ``stream``."""
+    while True:
+        prefix = stream.read(_LEN.size)
+        if not prefix:
+            return
+        if len(prefix) < _LEN.size:
+            prefix += _read_exact(stream, _LEN.size - len(prefix))
+        header = json.loads(_read_exact(stream, _LEN.unpack(prefix)[0]))
+        yield header, _read_exact(stream, header["length"]) if header["length"] else b""
@@ -0,0 +1,56 @@
+"""Wire format of servertts' /synthesize_stream responses.
+
+The body is a PCM16 WAV whose RIFF and data sizes are not known when the
+header is sent, so both hold ``UNKNOWN_SIZE``; sentence audio follows as
+it is synthesized. Clients write the body to disk as it arrives and call
+:func:`patch_wav_header` once it is complete.
+"""
+from __future__ import annotations
+
+import os
+import re
+import struct
+from typing import List
+
+MEDIA_TYPE = "audio/wav"
+HEADER_SIZE = 44
+UNKNOWN_SIZE = 0xFFFFFFFF
+# Split after sentence punctuation (and closing quotes/brackets) followed by whitespace
+_SENTENCE_END = re.compile(r"(?:(?<=[.!?…])|(?<=[.!?…][\"')\]]))\s+")
+
+
+def split_sentences(text: str, min_chars: int = 20) -> List[str]:
+    """Split text at sentence boundaries, merging fragments shorter than ``min_chars``."""
+    sentences = []
+    for part in _SENTENCE_END.split(text.strip()):
+        part = part.strip()
+        if not part:
+            continue
+        if sentences and len(sentences[-1]) < min_chars:
+            sentences[-1] = f"{sentences[-1]} {part}"
+        else:
+            sentences.append(part)
+    return sentences
+
+
+def wav_header(sample_rate: int, channels: int = 1, bits: int = 16, data_size: int = UNKNOWN_SIZE) -> bytes:
+    block_align = channels * bits // 8
+    riff_size = UNKNOWN_SIZE if data_size == UNKNOWN_SIZE else data_size + HEADER_SIZE - 8
+    return struct.pack(
+        "<4sI4s4sIHHIIHH4sI",
+        b"RIFF", riff_size, b"WAVE",
+        b"fmt ", 16, 1, channels, sample_rate, sample_rate * block_align, block_align, bits,
+        b"data", data_size,
+    )
+
+
+def patch_wav_header(path) -> None:
+    """Write the real RIFF and data sizes into a streamed WAV file."""
+    data_size = os.path.getsize(path) - HEADER_SIZE
+    if data_size < 0:
+        raise ValueError(f"{path} is shorter than a WAV header")
+    with open(path, "r+b") as f:
+        f.seek(4)
+        f.write(struct.pack("<I", data_size + HEADER_SIZE - 8))
+        f.seek(40)
+        f.write(struct.pack("<I", data_size))
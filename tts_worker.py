@@ -0,0 +1,82 @@
+"""Coqui-TTS model replicas used by servertts.
+
+Each worker process (or thread) loads its own model in :func:`init_worker`.
+This module holds no server state, so spawned worker processes can import it
+without starting another server.
+"""
+import io
+import time
+import threading
+
+import numpy as np
+import soundfile as sf
+
+from audio_formats import AUDIO_FORMATS, DEFAULT_FORMAT
+
+_local = threading.local()
+
+
+def init_worker(model_name, num_threads=None):
+    """Load one model replica for the calling worker."""
+    from TTS.api import TTS
+
+    if num_threads:
+        # Split the CPU between process replicas instead of oversubscribing it
+        import torch
+        torch.set_num_threads(num_threads)
+    _local.model = TTS(model_name=model_name)
+
+
+def voice_info():
+    tts = _local.model
+    return {
+        "is_multi_speaker": bool(tts.is_multi_speaker),
+        "speakers": list(tts.speakers or []) if tts.is_multi_speaker else [],
+        "is_multi_lingual": bool(tts.is_multi_lingual),
+        "languages": list(tts.languages or []) if tts.is_multi_lingual else [],
+        "sample_rate": tts.synthesizer.output_sample_rate,
+    }
+
+
+def resample(wav, src_rate, dst_rate):
+    """Band-limited linear resampling; plenty for speech."""
+    if src_rate == dst_rate or not len(wav):
+        return wav
+    if dst_rate < src_rate:
+        # Low-pass below the new Nyquist frequency to avoid aliasing
+        cutoff = dst_rate / src_rate / 2
+        taps = np.arange(-32, 33)
+        kernel = np.sinc(2 * cutoff * taps) * np.hamming(len(taps))
+        wav = np.convolve(wav, kernel / kernel.sum(), mode="same")
+    n_out = int(round(len(wav) * dst_rate / src_rate))
+    return np.interp(np.arange(n_out) * (src_rate / dst_rate), np.arange(len(wav)), wav).astype(np.float32)
+
+
+def _infer(text, speaker, language, sample_rate):
+    tts = _local.model
+    start = time.perf_counter()
+    wav = np.asarray(tts.tts(text=text, speaker=speaker, language=language), dtype=np.float32)
+    inference = time.perf_counter() - start
+    native_rate = tts.synthesizer.output_sample_rate
+    rate = sample_rate or native_rate
+    return resample(wav, native_rate, rate), rate, inference
+
+
+def synthesize(text, speaker=None, language=None, fmt=DEFAULT_FORMAT, sample_rate=None):
+    """Synthesize one text as an encoded file; returns (bytes, audio seconds, stage timings)."""
+    wav, rate, inference = _infer(text, speaker, language, sample_rate)
+    start = time.perf_counter()
+    spec = AUDIO_FORMATS[fmt]
+    buf = io.BytesIO()
+    sf.write(buf, wav, rate, format=spec["format"], subtype=spec["subtype"])
+    encode = time.perf_counter() - start
+    return buf.getvalue(), len(wav) / rate, {"inference": inference, "encode": encode}
+
+
+def synthesize_pcm(text, speaker=None, language=None, sample_rate=None):
+    """Synthesize one text as raw mono PCM16; returns (bytes, audio seconds, stage timings)."""
+    wav, rate, inference = _infer(text, speaker, language, sample_rate)
+    start = time.perf_counter()
+    pcm = (np.clip(wav, -1.0, 1.0) * 32767).astype("<i2").tobytes()
+    encode = time.perf_counter() - start
+    return pcm, len(wav) / rate, {"inference": inference, "encode": encode}
@@ -1,26 +1,385 @@
 #!/usr/bin/env python3
 import os
+import glob
 import json
+import hashlib
+import time
 import argparse
+import threading
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+import numpy as np
+import requests
+from requests.adapters import HTTPAdapter
+from PIL import Image, ImageFilter
+
+from content_cache import file_digest, link_or_copy
+
+# Scale factors offered by the remote upscaler service
+REMOTE_MODELS = {"x2": 2, "x4": 4}
+# Up to this factor a local Lanczos resize is indistinguishable after encoding
+LOCAL_RESIZE_MAX_SCALE = float(os.getenv("LOCAL_RESIZE_MAX_SCALE", 1.5))
+
+# Local CPU backend: images are processed in tiles of this many output pixels
+LOCAL_TILE_SIZE = int(os.getenv("LOCAL_UPSCALE_TILE", 512))
+# Extra pixels around each tile so filters see real neighbours (no seams)
+TILE_PAD = 16
+# Mild sharpening to offset the softness of interpolation
+UNSHARP = ImageFilter.UnsharpMask(radius=1.2, percent=60, threshold=2)
+# Optional ONNX super-resolution model (NCHW float32 RGB in [0, 1])
+ONNX_MODEL_PATH = os.getenv("UPSCALE_ONNX_MODEL")
+
+UPSCALER_URL = os.getenv("UPSCALER_URL", "http://192.168.1.154:5700/upscale")
+UPSCALE_CONCURRENCY = int(os.getenv("UPSCALE_CONCURRENCY", 2))
+DEFAULT_MODEL = "x4"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+# Per output directory: source content hash -> output file, model
+MANIFEST_FILE = ".upscale_manifest.json"
+IMAGE_SUFFIXES = (".png", ".jpg", ".jpeg", ".webp")
+
+UPSCALER_HEALTH_URL = os.getenv("UPSCALER_HEALTH_URL", "http://192.168.1.154:5700/health")
+# How long a health verdict is trusted before probing again
+HEALTH_TTL_SECONDS = 30
+# After a failed remote call the service is skipped for this long
+REMOTE_COOLDOWN_SECONDS = 120
+
+_onnx_session = None
+_session = None
+_remote_state = {"healthy": None, "checked": 0.0, "down_until": 0.0}
 
-def upscale_image(image_path: Path) -> Path:
-    upscaled_path = image_path.parent / f"upscaled_{image_path.name}"
-    curl_cmd = f'curl -s -X POST "http://192.168.1.154:5700/upscale?model=x4" -F "file=@{image_path}" --output {upscaled_path}'
-    os.system(curl_cmd)
 
-    if upscaled_path.exists() and upscaled_path.stat().st_size > 0:
-        return upscaled_path
+def plan_upscale(native_size: tuple, target_size: tuple) -> dict:
+    """
+    Decides how an image of `native_size` should reach `target_size`.
+
+    The scale needed is the larger of the two axis ratios, since the assembler
+    stretches every image to the video size. Small gaps are closed with a local
+    Lanczos resize, larger ones with the smallest remote model that is enough
+    (optionally followed by a Lanczos step instead of jumping to x4).
+    """
+    nw, nh = native_size
+    tw, th = target_size
+    scale = max(tw / nw, th / nh)
+    plan = {
+        "native_size": [nw, nh],
+        "target_size": [tw, th],
+        "scale": round(scale, 3),
+        "model": None,
+        "local_resize": False,
+    }
+    if scale <= 1.0:
+        plan["method"] = "none"
+        return plan
+    if scale <= LOCAL_RESIZE_MAX_SCALE:
+        plan.update(method="lanczos", local_resize=True)
+        return plan
+
+    for name, factor in sorted(REMOTE_MODELS.items(), key=lambda kv: kv[1]):
+        if factor >= scale:
+            plan["model"] = name
+            break
+        if scale / factor <= LOCAL_RESIZE_MAX_SCALE:
+            plan.update(model=name, local_resize=True)
+            break
     else:
-        print(f"[WARNING] Upscaling failed or produced empty file for: {image_path}")
-        return image_path  # fallback to original
+        plan.update(model=max(REMOTE_MODELS, key=REMOTE_MODELS.get), local_resize=True)
+    plan["method"] = plan["model"] + ("+lanczos" if plan["local_resize"] else "")
+    return plan
+
+
+def local_resize(image_path: Path, dest_path: Path, size: tuple) -> Path:
+    """
+    Resizes an image to `size` with Lanczos resampling.
+    """
+    with Image.open(image_path) as img:
+        resized = img.resize((int(size[0]), int(size[1])), Image.LANCZOS)
+    dest_path.unlink(missing_ok=True)
+    resized.save(dest_path)
+    return dest_path
+
+def remote_available() -> bool:
+    """
+    Whether the remote upscaler should be used: not in cooldown after a
+    failure and answering its health URL (any non-5xx response counts).
+    """
+    now = time.monotonic()
+    if now < _remote_state["down_until"]:
+        return False
+    if _remote_state["healthy"] is not None and now - _remote_state["checked"] < HEALTH_TTL_SECONDS:
+        return _remote_state["healthy"]
+    try:
+        healthy = requests.get(UPSCALER_HEALTH_URL, timeout=3).status_code < 500
+    except requests.RequestException:
+        healthy = False
+    _remote_state.update(healthy=healthy, checked=now)
+    if not healthy:
+        print(f"[WARNING] Remote upscaler at {UPSCALER_HEALTH_URL} is unhealthy; using local backend")
+    return healthy
+
+
+def mark_remote_failed() -> None:
+    """Takes the remote upscaler out of rotation for REMOTE_COOLDOWN_SECONDS."""
+    _remote_state.update(healthy=False, checked=time.monotonic(),
+                         down_until=time.monotonic() + REMOTE_COOLDOWN_SECONDS)
+
+
+def _get_onnx_session():
+    """Loads the ONNX model on first use; False when unavailable."""
+    global _onnx_session
+    if _onnx_session is None:
+        _onnx_session = False
+        if ONNX_MODEL_PATH and Path(ONNX_MODEL_PATH).exists():
+            try:
+                import onnxruntime as ort
+                _onnx_session = ort.InferenceSession(ONNX_MODEL_PATH, providers=["CPUExecutionProvider"])
+            except Exception as e:
+                print(f"[WARNING] ONNX upscaler unavailable ({e}); using tiled Lanczos")
+    return _onnx_session
+
+
+def _tiles(width: int, height: int, tile: int):
+    for y in range(0, height, tile):
+        for x in range(0, width, tile):
+            yield x, y, min(x + tile, width), min(y + tile, height)
+
+
+def _onnx_upscale(img: Image.Image, session) -> Image.Image:
+    """Runs the ONNX model tile by tile; output is at the model's native factor."""
+    src = np.asarray(img, dtype=np.float32) / 255.0
+    h, w = src.shape[:2]
+    input_name = session.get_inputs()[0].name
+    out = factor = None
+    for x0, y0, x1, y1 in _tiles(w, h, LOCAL_TILE_SIZE // 4):
+        px0, py0 = max(0, x0 - TILE_PAD), max(0, y0 - TILE_PAD)
+        px1, py1 = min(w, x1 + TILE_PAD), min(h, y1 + TILE_PAD)
+        patch = src[py0:py1, px0:px1].transpose(2, 0, 1)[None]
+        result = session.run(None, {input_name: patch})[0][0].transpose(1, 2, 0)
+        if out is None:
+            factor = result.shape[0] // (py1 - py0)
+            out = np.empty((h * factor, w * factor, 3), dtype=np.uint8)
+        inner = result[(y0 - py0) * factor:(y1 - py0) * factor, (x0 - px0) * factor:(x1 - px0) * factor]
+        out[y0 * factor:y1 * factor, x0 * factor:x1 * factor] = (np.clip(inner, 0, 1) * 255 + 0.5).astype(np.uint8)
+    return Image.fromarray(out)
+
+
+def _tiled_resize(img: Image.Image, size: tuple, sharpen: bool) -> Image.Image:
+    """
+    Lanczos resize (plus unsharp mask) computed one output tile at a time.
+    Each tile samples its exact source box from the full image, so tiles
+    join without seams; only one tile of intermediate data is alive at once.
+    """
+    tw, th = int(size[0]), int(size[1])
+    sx, sy = img.width / tw, img.height / th
+    out = Image.new("RGB", (tw, th))
+    for x0, y0, x1, y1 in _tiles(tw, th, LOCAL_TILE_SIZE):
+        px0, py0 = max(0, x0 - TILE_PAD), max(0, y0 - TILE_PAD)
+        px1, py1 = min(tw, x1 + TILE_PAD), min(th, y1 + TILE_PAD)
+        tile = img.resize((px1 - px0, py1 - py0), Image.LANCZOS, box=(px0 * sx, py0 * sy, px1 * sx, py1 * sy))
+        if sharpen:
+            tile = tile.filter(UNSHARP)
+        out.paste(tile.crop((x0 - px0, y0 - py0, x1 - px0, y1 - py0)), (x0, y0))
+    return out
+
+
+def local_upscale(image_path: Path, dest_path: Path, size: tuple) -> Path:
+    """
+    Upscales an image to exactly `size` on the CPU: through the ONNX model in
+    UPSCALE_ONNX_MODEL when it loads, otherwise with tiled Lanczos plus an
+    unsharp mask.
+    """
+    with Image.open(image_path) as img:
+        img = img.convert("RGB")
+        session = _get_onnx_session()
+        if session:
+            img = _onnx_upscale(img, session)
+        result = _tiled_resize(img, size, sharpen=not session)
+    dest_path = Path(dest_path)
+    dest_path.unlink(missing_ok=True)
+    result.save(dest_path)
+    return dest_path
+
+def get_session() -> requests.Session:
+    """Shared keep-alive session, pooled for UPSCALE_CONCURRENCY callers."""
+    global _session
+    if _session is None:
+        _session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(UPSCALE_CONCURRENCY, 4))
+        _session.mount("http://", adapter)
+        _session.mount("https://", adapter)
+    return _session
+
+
+def upscale_remote(image_path: Path, dest_path: Path, model: str = DEFAULT_MODEL) -> Path:
+    """
+    Sends an image to the remote upscaler and streams the result to
+    `dest_path` via a `.part` file. Raises on HTTP errors and on responses
+    that are not images, so a failure never leaves a bogus output behind.
+    """
+    dest_path = Path(dest_path)
+    tmp = dest_path.with_name(dest_path.name + ".part")
+    try:
+        with open(image_path, "rb") as f, get_session().post(
+            UPSCALER_URL, params={"model": model}, files={"file": f}, timeout=600, stream=True
+        ) as resp:
+            resp.raise_for_status()
+            content_type = resp.headers.get("content-type", "")
+            if not content_type.startswith("image/"):
+                raise requests.HTTPError(f"Upscaler returned {content_type or 'no content type'}, not an image", response=resp)
+            with open(tmp, "wb") as out:
+                for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                    out.write(chunk)
+        os.replace(tmp, dest_path)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return dest_path
 
-def process_json(json_path: Path):
+
+def upscale_file(image_path: Path, dest_path: Path, model: str = DEFAULT_MODEL) -> tuple:
+    """
+    Upscales one image by the model's factor, remotely when the service is
+    available and locally otherwise. Returns (dest_path, backend).
+    """
+    if remote_available():
+        try:
+            return upscale_remote(image_path, dest_path, model), "remote"
+        except requests.RequestException as e:
+            print(f"[WARNING] Remote upscaling failed for {image_path}: {e}; upscaling locally")
+            mark_remote_failed()
+    factor = REMOTE_MODELS[model]
+    with Image.open(image_path) as img:
+        size = (img.width * factor, img.height * factor)
+    return local_upscale(image_path, dest_path, size), "local"
+
+
+def upscale_image(image_path: Path, model: str = DEFAULT_MODEL) -> Path:
+    """Upscales an image to `upscaled_<name>` next to it."""
+    upscaled_path = image_path.parent / f"upscaled_{image_path.name}"
+    return upscale_file(image_path, upscaled_path, model)[0]
+
+
+def _load_manifest(out_dir: Path) -> dict:
+    try:
+        with open(out_dir / MANIFEST_FILE, encoding="utf-8") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_manifest(out_dir: Path, manifest: dict) -> None:
+    tmp = out_dir / (MANIFEST_FILE + ".part")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp, out_dir / MANIFEST_FILE)
+
+
+def upscale_batch(paths, out_dir: Path = None, model: str = DEFAULT_MODEL,
+                  workers: int = UPSCALE_CONCURRENCY, force: bool = False) -> tuple:
+    """
+    Upscales many images with at most `workers` requests in flight.
+
+    Outputs are `upscaled_<name>` in `out_dir` (default: next to each source);
+    sources sharing a name in `out_dir` get a hash of their directory as well,
+    `upscaled_<dirhash>_<name>`, so they never overwrite each other.
+    A source whose content hash is already recorded in the output directory's
+    manifest for this model is skipped (or linked, if only its name changed)
+    unless `force` is set. Returns ({source: output or None}, summary).
+    """
+    start = time.monotonic()
+    summary = {"total": 0, "remote": 0, "local": 0, "skipped": 0, "failed": 0,
+               "bytes_in": 0, "bytes_out": 0, "failures": {}}
+    results = {}
+    manifests = {}
+    lock = threading.Lock()
+
+    def output_name(src: Path) -> str:
+        if out_dir and name_counts[src.name] > 1:
+            dir_hash = hashlib.sha256(str(src.parent.resolve()).encode("utf-8")).hexdigest()[:8]
+            return f"upscaled_{dir_hash}_{src.name}"
+        return f"upscaled_{src.name}"
+
+    def run(src: Path):
+        dest_dir = Path(out_dir) if out_dir else src.parent
+        dest = dest_dir / output_name(src)
+        digest = file_digest(src)
+        with lock:
+            manifest = manifests.setdefault(dest_dir, _load_manifest(dest_dir))
+            entry = manifest.get(digest)
+        if not force and entry and entry["model"] == model and (dest_dir / entry["output"]).exists():
+            if entry["output"] != dest.name:
+                link_or_copy(dest_dir / entry["output"], dest)
+            return dest, "skipped"
+        dest, backend = upscale_file(src, dest, model)
+        with lock:
+            manifest[digest] = {"output": dest.name, "model": model}
+        return dest, backend
+
+    if out_dir:
+        Path(out_dir).mkdir(parents=True, exist_ok=True)
+    paths = [Path(p) for p in paths]
+    name_counts = Counter(p.name for p in paths)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        futures = {pool.submit(run, p): p for p in paths}
+        for fut in as_completed(futures):
+            src = futures[fut]
+            summary["total"] += 1
+            try:
+                dest, outcome = fut.result()
+            except Exception as e:
+                print(f"[FAILED] {src}: {e}")
+                summary["failed"] += 1
+                summary["failures"][str(src)] = str(e)
+                results[src] = None
+                continue
+            print(f"[{outcome.upper()}] {src} -> {dest}")
+            summary[outcome] += 1
+            results[src] = dest
+            if outcome != "skipped":
+                summary["bytes_in"] += src.stat().st_size
+                summary["bytes_out"] += dest.stat().st_size
+
+    for dest_dir, manifest in manifests.items():
+        _save_manifest(dest_dir, manifest)
+    elapsed = time.monotonic() - start
+    done = summary["remote"] + summary["local"]
+    summary["elapsed_seconds"] = round(elapsed, 2)
+    summary["images_per_second"] = round(done / elapsed, 3) if elapsed else 0.0
+    summary["mb_out_per_second"] = round(summary["bytes_out"] / 1e6 / elapsed, 3) if elapsed else 0.0
+    return results, summary
+
+
+def print_summary(summary: dict) -> None:
+    print(
+        f"[SUMMARY] {summary['total']} image(s) in {summary['elapsed_seconds']}s: "
+        f"{summary['remote']} remote, {summary['local']} local, {summary['skipped']} skipped, "
+        f"{summary['failed']} failed — {summary['images_per_second']} img/s, "
+        f"{summary['mb_out_per_second']} MB/s written"
+    )
+    for src, err in summary["failures"].items():
+        print(f"  [FAILED] {src}: {err}")
+
+
+def collect_images(patterns) -> list:
+    """Expands directories and glob patterns into source images, skipping earlier outputs."""
+    found = []
+    for pattern in patterns:
+        if Path(pattern).is_dir():
+            candidates = sorted(Path(pattern).iterdir())
+        else:
+            candidates = sorted(Path(p) for p in glob.glob(pattern, recursive=True))
+        for path in candidates:
+            if (path.is_file() and path.suffix.lower() in IMAGE_SUFFIXES
+                    and not path.name.startswith("upscaled_") and path not in found):
+                found.append(path)
+    return found
+
+
+def process_json(json_path: Path, model: str = DEFAULT_MODEL, workers: int = UPSCALE_CONCURRENCY,
+                 force: bool = False):
     with json_path.open("r", encoding="utf-8") as f:
         data = json.load(f)
 
-    changed = False
-
+    visuals = []
     for section in data.get("sections", []):
         for segment in section.get("segments", []):
             visual = segment.get("visual", {})
@@ -29,11 +388,19 @@ def process_json(json_path: Path):
                 if not original_path.exists():
                     print(f"[SKIP] Missing file: {original_path}")
                     continue
+                if original_path.name.startswith("upscaled_"):
+                    continue
+                visuals.append((visual, original_path))
 
-                upscaled_path = upscale_image(original_path)
-                if upscaled_path != original_path:
-                    visual["image_path"] = str(upscaled_path)
-                    changed = True
+    results, summary = upscale_batch([p for _, p in visuals], model=model, workers=workers, force=force)
+    print_summary(summary)
+
+    changed = False
+    for visual, original_path in visuals:
+        upscaled_path = results.get(original_path)
+        if upscaled_path and upscaled_path != original_path:
+            visual["image_path"] = str(upscaled_path)
+            changed = True
 
     if changed:
         with json_path.open("w", encoding="utf-8") as f:
@@ -41,10 +408,30 @@ def process_json(json_path: Path):
         print(f"[UPDATED] JSON saved with upscaled paths: {json_path}")
     else:
         print("[NO CHANGE] No visuals were upscaled or updated.")
+    return summary
 
 if __name__ == "__main__":
-    parser = argparse.ArgumentParser(description="Upscale visuals in a video script JSON.")
-    parser.add_argument("json_file", type=str, help="Path to the video script JSON file.")
+    parser = argparse.ArgumentParser(description="Upscale visuals in a video script JSON, or a batch of images.")
+    parser.add_argument("json_file", type=str, nargs="?", help="Path to the video script JSON file.")
+    parser.add_argument("--images", nargs="+", metavar="PATH_OR_GLOB",
+                        help="Directories or glob patterns of images to upscale instead of a script.")
+    parser.add_argument("--out", type=str, help="Output directory for --images (default: next to each image).")
+    parser.add_argument("--model", choices=sorted(REMOTE_MODELS), default=DEFAULT_MODEL)
+    parser.add_argument("--workers", type=int, default=UPSCALE_CONCURRENCY, help="Concurrent upscale requests.")
+    parser.add_argument("--force", action="store_true", help="Upscale even if the content hash was already done.")
+    parser.add_argument("--summary-json", type=str, help="Also write the run summary to this file.")
     args = parser.parse_args()
 
-    process_json(Path(args.json_file))
+    if args.images:
+        images = collect_images(args.images)
+        if not images:
+            parser.error("No images matched.")
+        _, summary = upscale_batch(images, out_dir=args.out, model=args.model, workers=args.workers, force=args.force)
+        print_summary(summary)
+    elif args.json_file:
+        summary = process_json(Path(args.json_file), model=args.model, workers=args.workers, force=args.force)
+    else:
+        parser.error("Give a script JSON file or --images.")
+    if args.summary_json:
+        with open(args.summary_json, "w", encoding="utf-8") as f:
+            json.dump(summary, f, indent=2)
@@ -21,6 +21,8 @@ from moviepy.editor import (
 from moviepy.video.fx.all import fadeout
 from moviepy.audio.fx.all import audio_loop, audio_fadeout, audio_fadein
 from config import VIDEO_SIZE as CFG_VIDEO_SIZE, FPS, FINAL_VIDEO_DIR
+from image_derivatives import DERIVATIVES
+from narration_track import segment_seconds
 
 # -------------------- Constants --------------------
 DEFAULT_BG_MUSIC_PATH = "./fallbacks/default_bg_music.mp3"
@@ -171,20 +173,28 @@ def assemble_video(script_json_path):
     timeline = 0.0
     first = True
 
+    # One reader for the whole narration track (see tts.TTS_SINGLE_TRACK);
+    # each segment is a subclip of it instead of its own AudioFileClip
+    track = data.get('narration_track') or {}
+    track_clip = AudioFileClip(track['path']) if track.get('path') and os.path.exists(track['path']) else None
+
     for sec in data.get('sections', []):
         segs = sec.get('segments', [])
         for seg in segs:
             dur = seg['narration'].get('duration', 0)
             ap = seg['narration'].get('audio_path')
-            if ap and os.path.exists(ap):
-                audio_clip = AudioFileClip(ap)
+            bounds = segment_seconds(seg['narration'], track.get('sample_rate')) if track_clip else None
+            if bounds or (ap and os.path.exists(ap)):
+                audio_clip = track_clip.subclip(*bounds) if bounds else AudioFileClip(ap)
                 start = timeline + (NARRATION_INITIAL_DELAY if first else 0)
                 narrs.append(audio_clip.set_start(start))
+                # Lets captions map narration-track times onto the video
+                seg['narration']['video_start'] = start
                 first = False
                 dur = audio_clip.duration
             img = seg.get('visual',{}).get('image_path')
             if img and os.path.exists(img):
-                ic = ImageClip(img).resize(VIDEO_SIZE)
+                ic = ImageClip(DERIVATIVES.render_array(img, VIDEO_SIZE))
                 ext_start = NARRATION_INITIAL_DELAY if len(clips) == 0 else 0
                 ext_end = END_EXTENSION if seg is segs[-1] and sec is data['sections'][-1] else 0
                 ic = ic.set_duration(dur + ext_start + ext_end)
@@ -244,7 +254,7 @@ def assemble_video(script_json_path):
     Path(script_json_path).write_text(json.dumps(data, indent=2))
 
     # clean up open clips
-    for clip in narrs + trans_auds:
+    for clip in narrs + trans_auds + ([track_clip] if track_clip else []):
         try:
             clip.close()
         except Exception:
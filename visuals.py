@@ -1,10 +1,15 @@
 import os
 import json
 import time
+import uuid
+import shutil
 import logging
 import requests
 from pathlib import Path
 
+from content_cache import ContentCache, make_key, link_or_copy
+from config import IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -18,6 +23,7 @@ logging.basicConfig(
 # Local Flux API configuration
 LOCAL_FLUX_API = os.getenv("LOCAL_FLUX_API", "http://192.168.1.154:8100")
 GENERATE_ENDPOINT = f"{LOCAL_FLUX_API}/generate"
+JOBS_ENDPOINT = f"{LOCAL_FLUX_API}/jobs"
 
 # Output directory for downloaded images
 OUTPUT_DIR = Path(os.getenv("OUTPUT_DIR", "downloaded_content"))
@@ -28,22 +34,58 @@ DEFAULT_WIDTH = int(os.getenv("FLUX_WIDTH", 1200))
 DEFAULT_HEIGHT = int(os.getenv("FLUX_HEIGHT", 688))
 DEFAULT_STEPS = int(os.getenv("FLUX_STEPS", 50))
 DEFAULT_SCALE = float(os.getenv("FLUX_SCALE", 4.5))
+DEFAULT_SEED = int(os.environ["FLUX_SEED"]) if os.getenv("FLUX_SEED") else None
+# Draft tier for storyboard review: few steps at a fraction of the final size
+DRAFT_STEPS = int(os.getenv("FLUX_DRAFT_STEPS", 8))
+DRAFT_SCALE = float(os.getenv("FLUX_DRAFT_SCALE", 0.5))
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+POLL_MIN_INTERVAL = 1.0
+POLL_MAX_INTERVAL = 10.0
+
+# Shared keep-alive session for job submission and polling
+SESSION = requests.Session()
+# Jobs submitted but not yet collected: job_id -> (cache_key, dest_path)
+_PENDING_JOBS = {}
+
+# Generated images are cached by their generation parameters so reruns skip Flux
+IMAGE_CACHE = ContentCache(IMAGE_CACHE_DIR, IMAGE_CACHE_MAX_BYTES)
+
+
+def _draft_side(side: int) -> int:
+    # Flux works on 16-pixel multiples; keep the final aspect ratio
+    return max(256, int(side * DRAFT_SCALE) // 16 * 16)
 
 
-def get_model_config_by_style(style: str) -> dict:
+def get_model_config_by_style(style: str, tier: str = "final") -> dict:
     """
     Returns configuration dict for a given style. Stubbed to use local Flux API.
+    The "draft" tier generates at DRAFT_SCALE of the final size with
+    DRAFT_STEPS steps, for previews that are reviewed and then discarded.
     """
+    if tier not in ("final", "draft"):
+        raise ValueError(f"Unknown generation tier: {tier}")
+    draft = tier == "draft"
     return {
         "endpoint": GENERATE_ENDPOINT,
-        "width": DEFAULT_WIDTH,
-        "height": DEFAULT_HEIGHT,
-        "num_inference_steps": DEFAULT_STEPS,
+        "jobs_endpoint": JOBS_ENDPOINT,
+        "tier": tier,
+        "width": _draft_side(DEFAULT_WIDTH) if draft else DEFAULT_WIDTH,
+        "height": _draft_side(DEFAULT_HEIGHT) if draft else DEFAULT_HEIGHT,
+        "num_inference_steps": min(DRAFT_STEPS, DEFAULT_STEPS) if draft else DEFAULT_STEPS,
         "guidance_scale": DEFAULT_SCALE,
+        "seed": DEFAULT_SEED,
         "enhance": False
     }
 
 
+def prompt_seed(prompt: str) -> int:
+    """
+    Deterministic seed for a prompt, used when no seed is configured so a
+    draft and its final render start from the same noise.
+    """
+    return int(make_key(prompt)[:8], 16)
+
+
 def get_model_from_config(config: dict) -> str:
     """
     Returns the model endpoint from config.
@@ -51,39 +93,115 @@ def get_model_from_config(config: dict) -> str:
     return config["endpoint"]
 
 
+def image_cache_key(prompt: str, config: dict) -> str:
+    """
+    Returns the cache key for an image generated from `prompt` with `config`.
+    """
+    return make_key(
+        prompt,
+        config["endpoint"],
+        config["width"],
+        config["height"],
+        config["num_inference_steps"],
+        config["guidance_scale"],
+        config.get("seed"),
+    )
+
+
+def stream_to_file(resp, dest_path) -> Path:
+    """
+    Streams a response body to `dest_path` via a temporary `.part` file that is
+    renamed into place, so readers never see a partial image and an existing
+    file (possibly a hardlink into the image cache) is replaced, not rewritten.
+    """
+    dest = Path(dest_path)
+    tmp = dest.with_name(dest.name + ".part")
+    try:
+        with open(tmp, "wb") as f:
+            for chunk in resp.iter_content(DOWNLOAD_CHUNK_SIZE):
+                f.write(chunk)
+        os.replace(tmp, dest)
+    finally:
+        tmp.unlink(missing_ok=True)
+    return dest
+
 
-def generate_image(prompt: str, config: dict) -> str:
+def generate_image(prompt: str, config: dict, dest_path: str = None) -> str:
     """
-    Submits an image generation request to the local Flux API.
-    Returns the path to the saved image.
+    Submits an image generation job to the local Flux API and returns its job
+    ID without waiting for the image; poll_generation_status collects it.
+    An identical earlier request is served from the image cache instead, in
+    which case the path to the image is returned.
     """
-    model_endpoint = config["endpoint"]
+    cache_key = image_cache_key(prompt, config)
+    if dest_path:
+        if IMAGE_CACHE.materialize(cache_key, "raw", dest_path):
+            logging.info(f"Image cache hit for prompt: {prompt!r} -> {dest_path}")
+            return str(dest_path)
+    else:
+        cached = IMAGE_CACHE.get(cache_key, "raw")
+        if cached:
+            logging.info(f"Image cache hit for prompt: {prompt!r} -> {cached}")
+            return str(cached)
+
+    jobs_endpoint = config.get("jobs_endpoint", JOBS_ENDPOINT)
     payload = {
         "prompt": prompt,
         "width": config["width"],
         "height": config["height"],
         "num_inference_steps": config["num_inference_steps"],
         "guidance_scale": config["guidance_scale"],
-        "enhance": config.get("enhance", False)
+        "enhance": config.get("enhance", False),
+        "tier": config.get("tier", "final")
     }
-    logging.info(f"POST {model_endpoint} -> {payload}")
-    resp = requests.post(model_endpoint, json=payload, timeout=1200)
+    if config.get("seed") is not None:
+        payload["seed"] = config["seed"]
+    logging.info(f"POST {jobs_endpoint} -> {payload}")
+    resp = SESSION.post(jobs_endpoint, json=payload, timeout=30)
     resp.raise_for_status()
-
-    filename = f"gen_{int(time.time() * 1000)}.png"
-    file_path = OUTPUT_DIR / filename
-    file_path.write_bytes(resp.content)
-    logging.info(f"Image saved to {file_path}")
-    return str(file_path)
-
+    job = resp.json()
+    _PENDING_JOBS[job["job_id"]] = (cache_key, dest_path, jobs_endpoint)
+    logging.info(f"Queued job {job['job_id']} (position {job.get('position')}, ETA {job.get('eta_seconds')}s)")
+    return job["job_id"]
 
 
-def poll_generation_status(job_id: str, timeout: int = 300) -> str:
+def poll_generation_status(job_id: str, timeout: int = 1800) -> str:
     """
-    Stub for polling generation status.
-    Since generate_image writes the file synchronously, return the job_id immediately.
+    Waits for a job submitted by generate_image, then streams its image to the
+    requested destination (or a new file in OUTPUT_DIR) and links it into the
+    image cache. Poll spacing follows the server's ETA. Returns the image
+    path, or None if the job failed or timed out. Paths returned by
+    generate_image for cache hits are passed through unchanged.
     """
-    return job_id
+    if job_id not in _PENDING_JOBS:
+        return job_id
+    cache_key, dest_path, jobs_endpoint = _PENDING_JOBS.pop(job_id)
+    deadline = time.time() + timeout
+    while True:
+        resp = SESSION.get(f"{jobs_endpoint}/{job_id}", timeout=30)
+        resp.raise_for_status()
+        status = resp.json()
+        if status["status"] == "done":
+            break
+        if status["status"] == "failed":
+            logging.error(f"Job {job_id} failed: {status.get('error')}")
+            return None
+        if time.time() > deadline:
+            logging.error(f"Job {job_id} not finished after {timeout}s")
+            return None
+        eta = status.get("eta_seconds") or POLL_MAX_INTERVAL
+        time.sleep(min(max(eta / 2, POLL_MIN_INTERVAL), POLL_MAX_INTERVAL))
+
+    if dest_path:
+        file_path = Path(dest_path)
+    else:
+        file_path = OUTPUT_DIR / f"gen_{int(time.time() * 1000)}_{uuid.uuid4().hex[:8]}.png"
+    with SESSION.get(f"{jobs_endpoint}/{job_id}/result", timeout=120, stream=True) as resp:
+        resp.raise_for_status()
+        stream_to_file(resp, file_path)
+    logging.info(f"Image saved to {file_path}")
+    IMAGE_CACHE.put(cache_key, "raw", file_path, link=True)
+    return str(file_path)
 
 
 def extract_image_url(generation_output) -> str:
@@ -96,18 +214,24 @@ def extract_image_url(generation_output) -> str:
 
 def download_content(source: str, dest_path: str) -> None:
     """
-    Downloads or copies generated content to final destination.
-    Supports HTTP URLs or local file paths.
+    Downloads or moves generated content to final destination.
+    Supports HTTP URLs or local file paths. Temporary generation outputs in
+    OUTPUT_DIR are moved; any other local file is hardlinked (or copied
+    across filesystems), so no bytes are copied when avoidable.
     """
     if source.startswith("http://") or source.startswith("https://"):
-        resp = requests.get(source, stream=True, timeout=120)
-        resp.raise_for_status()
-        with open(dest_path, 'wb') as f:
-            for chunk in resp.iter_content(1024):
-                f.write(chunk)
+        with requests.get(source, stream=True, timeout=120) as resp:
+            resp.raise_for_status()
+            stream_to_file(resp, dest_path)
     else:
-        # local file, copy
-        Path(dest_path).write_bytes(Path(source).read_bytes())
+        src, dest = Path(source), Path(dest_path)
+        if src.resolve() == dest.resolve():
+            return
+        if src.parent.resolve() == OUTPUT_DIR.resolve() and src.name.startswith("gen_"):
+            dest.unlink(missing_ok=True)
+            shutil.move(str(src), str(dest))
+        else:
+            link_or_copy(src, dest)
     logging.info(f"Downloaded content to {dest_path}")
 
 
@@ -124,12 +248,12 @@ def process_visuals(script_path: str, output_script_path: str = None) -> dict:
         if prompt:
             cfg = get_model_config_by_style(section.get('style', 'default'))
             model = get_model_from_config(cfg)
-            job_id = generate_image(prompt, cfg)
-            ready = poll_generation_status(job_id)
-            img_path = extract_image_url(ready)
-            # Move to final visuals directory
+            # Stream straight to the final visuals path
             final_name = f"section_{s_idx}.png"
             final_path = OUTPUT_DIR / final_name
+            job_id = generate_image(prompt, cfg, dest_path=str(final_path))
+            ready = poll_generation_status(job_id)
+            img_path = extract_image_url(ready)
             download_content(img_path, str(final_path))
             section['visual']['image_path'] = str(final_path)
 
@@ -138,11 +262,11 @@ def process_visuals(script_path: str, output_script_path: str = None) -> dict:
             if sprompt:
                 cfg = get_model_config_by_style(seg.get('style', 'default'))
                 model = get_model_from_config(cfg)
-                job_id = generate_image(sprompt, cfg)
-                ready = poll_generation_status(job_id)
-                img_path = extract_image_url(ready)
                 final_name = f"section_{s_idx}_segment_{seg_idx}.png"
                 final_path = OUTPUT_DIR / final_name
+                job_id = generate_image(sprompt, cfg, dest_path=str(final_path))
+                ready = poll_generation_status(job_id)
+                img_path = extract_image_url(ready)
                 download_content(img_path, str(final_path))
                 seg['visual']['image_path'] = str(final_path)
 
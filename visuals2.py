@@ -1,11 +1,16 @@
 import os
 import json
 import time
+import heapq
+import threading
 import requests
 import logging
+from email.utils import parsedate_to_datetime
 from pathlib import Path
 from urllib.parse import urlparse
 
+from image_quality import score_image
+
 # Configure logging
 logging.basicConfig(
     level=logging.INFO,
@@ -32,6 +37,14 @@ HEADERS = {
 }
 
 LEONARDO_API_ENDPOINT = "https://cloud.leonardo.ai/api/rest/v1"
+
+# Polling schedule: fast first polls, then back off towards POLL_MAX_WAIT
+POLL_INITIAL_WAIT = 3.0
+POLL_MAX_WAIT = 15.0
+POLL_BACKOFF = 1.5
+POLL_TIMEOUT = 600
+MIN_REQUEST_INTERVAL = 0.25
+RATE_LIMIT_RETRIES = 5
 OUTPUT_DIR = "downloaded_content"
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
@@ -56,59 +69,163 @@ def get_model_config_by_style(style=None):
     reason = "Overriding to use Leonardo Anime XL exclusively."
     return ANIME_XL_MODEL, reason
 
-def generate_image(prompt, model_config=ANIME_XL_MODEL):
-    if isinstance(model_config, tuple):
-        model_config = model_config[0]
-    url = f"{LEONARDO_API_ENDPOINT}/generations"
-    payload = {
-        "height": model_config['height'],
-        "modelId": model_config['id'],
-        "prompt": prompt,
-        "width": model_config['width'],
-        "num_images": model_config['num_images'],
-        "alchemy": model_config['alchemy'],
-        "photoReal": model_config['photoReal'],
-        "photoRealVersion": model_config['photoRealVersion'],
-        "enhancePrompt": model_config['enhancePrompt'],
-        "presetStyle": model_config['presetStyle']
-    }
-    logging.info(f"Image generation request (Anime XL) at {model_config['width']}x{model_config['height']} for prompt: {prompt}")
+def _retry_after_seconds(value, default):
+    """
+    Seconds to wait from a Retry-After header, which is either a number of
+    seconds or an HTTP date; `default` when it is missing or unparseable.
+    """
+    if not value:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
     try:
-        response = requests.post(url, json=payload, headers=HEADERS)
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return default
+
+def _generation_status(data):
+    status = (data.get('status') or
+              data.get('generations_by_pk', {}).get('status') or
+              data.get('sdGenerationJob', {}).get('status'))
+    return status.lower() if status else None
+
+class LeonardoClient:
+    """
+    Leonardo API client that shares one HTTP session, spaces requests out,
+    retries on HTTP 429 (honouring Retry-After) and polls many generations
+    together with adaptive backoff.
+    """
+
+    def __init__(self, min_interval=MIN_REQUEST_INTERVAL):
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS)
+        self.min_interval = min_interval
+        self._lock = threading.Lock()
+        self._last_request = 0.0
+
+    def _request(self, method, path, **kwargs):
+        url = f"{LEONARDO_API_ENDPOINT}{path}"
+        for attempt in range(1, RATE_LIMIT_RETRIES + 1):
+            with self._lock:
+                wait = self._last_request + self.min_interval - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+                self._last_request = time.monotonic()
+            response = self.session.request(method, url, timeout=60, **kwargs)
+            if response.status_code != 429:
+                response.raise_for_status()
+                return response.json()
+            retry_after = _retry_after_seconds(response.headers.get('Retry-After'), 2 ** attempt)
+            logging.warning(f"Rate limited by Leonardo; retrying in {retry_after}s (attempt {attempt}/{RATE_LIMIT_RETRIES})")
+            time.sleep(retry_after)
         response.raise_for_status()
-        data = response.json()
-        gen = data.get('generations_by_pk', {}) or data.get('sdGenerationJob', {})
-        generation_id = gen.get('id') or gen.get('generationId')
-        if generation_id:
-            logging.info(f"Image generation initiated. Generation ID: {generation_id}")
-            return generation_id
-        logging.error(f"No generation ID found in response: {json.dumps(data, indent=4)}")
-    except Exception as err:
-        logging.error(f"Error during image generation: {err}")
-    return None
 
-def poll_generation_status(generation_id, wait_time=10, max_retries=30):
-    url = f"{LEONARDO_API_ENDPOINT}/generations/{generation_id}"
-    for attempt in range(1, max_retries + 1):
+    def submit(self, prompt, model_config=ANIME_XL_MODEL):
+        """Starts a generation and returns its ID, or None on failure."""
+        if isinstance(model_config, tuple):
+            model_config = model_config[0]
+        payload = {
+            "height": model_config['height'],
+            "modelId": model_config['id'],
+            "prompt": prompt,
+            "width": model_config['width'],
+            "num_images": model_config['num_images'],
+            "alchemy": model_config['alchemy'],
+            "photoReal": model_config['photoReal'],
+            "photoRealVersion": model_config['photoRealVersion'],
+            "enhancePrompt": model_config['enhancePrompt'],
+            "presetStyle": model_config['presetStyle']
+        }
+        logging.info(f"Image generation request at {model_config['width']}x{model_config['height']} for prompt: {prompt}")
         try:
-            response = requests.get(url, headers=HEADERS)
-            response.raise_for_status()
-            data = response.json()
-            status = (data.get('status') or
-                      data.get('generations_by_pk', {}).get('status') or
-                      data.get('sdGenerationJob', {}).get('status'))
-            status = status.lower() if status else None
-            logging.info(f"Polling attempt {attempt}/{max_retries}. Status: {status}")
+            data = self._request("POST", "/generations", json=payload)
+            gen = data.get('generations_by_pk', {}) or data.get('sdGenerationJob', {})
+            generation_id = gen.get('id') or gen.get('generationId')
+            if generation_id:
+                logging.info(f"Image generation initiated. Generation ID: {generation_id}")
+                return generation_id
+            logging.error(f"No generation ID found in response: {json.dumps(data, indent=4)}")
+        except Exception as err:
+            logging.error(f"Error during image generation: {err}")
+        return None
+
+    def poll_many(self, generation_ids, initial_wait=POLL_INITIAL_WAIT, max_wait=POLL_MAX_WAIT,
+                  backoff=POLL_BACKOFF, timeout=POLL_TIMEOUT, max_polls=None):
+        """
+        Polls several generations at once and yields (generation_id, data) as
+        each one finishes; data is None when a generation failed or timed out.
+        Each generation gets its own schedule that starts at `initial_wait`
+        and grows by `backoff` up to `max_wait`.
+        """
+        start = time.monotonic()
+        queue = [(start + initial_wait, gid, initial_wait, 0) for gid in generation_ids if gid]
+        heapq.heapify(queue)
+        while queue:
+            due, gid, wait, polls = heapq.heappop(queue)
+            delay = due - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            polls += 1
+            status = None
+            try:
+                data = self._request("GET", f"/generations/{gid}")
+                status = _generation_status(data)
+                logging.info(f"Poll {polls} for {gid}. Status: {status}")
+            except Exception as err:
+                logging.error(f"Polling error for {gid}: {err}")
             if status == 'complete':
-                logging.info("Generation complete.")
-                return data
+                yield gid, data
+                continue
             if status == 'failed':
-                logging.error("Generation failed.")
-                return None
-            time.sleep(wait_time)
-        except Exception as err:
-            logging.error(f"Polling error: {err}")
-    logging.error("Exceeded maximum polling attempts. Generation incomplete.")
+                logging.error(f"Generation {gid} failed.")
+                yield gid, None
+                continue
+            if time.monotonic() - start > timeout or (max_polls and polls >= max_polls):
+                logging.error(f"Generation {gid} incomplete after {polls} polls.")
+                yield gid, None
+                continue
+            wait = min(wait * backoff, max_wait)
+            heapq.heappush(queue, (time.monotonic() + wait, gid, wait, polls))
+
+    def generate_many(self, jobs):
+        """
+        Submits every (prompt, model_config) pair up front and yields
+        (index, data) as generations complete.
+        """
+        ids = {}
+        for idx, (prompt, model_config) in enumerate(jobs):
+            gid = self.submit(prompt, model_config)
+            if gid:
+                ids[gid] = idx
+            else:
+                yield idx, None
+        for gid, data in self.poll_many(list(ids)):
+            yield ids[gid], data
+
+_client = None
+
+def get_client():
+    """Returns the shared LeonardoClient, creating it on first use."""
+    global _client
+    if _client is None:
+        _client = LeonardoClient()
+    return _client
+
+def generate_image(prompt, model_config=ANIME_XL_MODEL):
+    """
+    Starts a generation with the shared client and returns its ID.
+    """
+    return get_client().submit(prompt, model_config)
+
+def poll_generation_status(generation_id, wait_time=10, max_retries=30):
+    """
+    Waits for a single generation; polls quickly at first and backs off to
+    `wait_time` between polls, giving up after `max_retries` polls.
+    """
+    for _, data in get_client().poll_many([generation_id], max_wait=wait_time, max_polls=max_retries):
+        return data
     return None
 
 def extract_image_url(data):
@@ -122,16 +239,102 @@ def extract_image_url(data):
     logging.error(f"No image URL found in data: {json.dumps(data, indent=4)}")
     return None
 
+def extract_image_urls(data):
+    """
+    Returns the URLs of every generated image in a finished generation.
+    """
+    urls = []
+    for key in ['generations_by_pk', 'sdGenerationJob']:
+        for image in data.get(key, {}).get('generated_images', []):
+            url = image.get('url') or image.get('imageUrl')
+            if url:
+                urls.append(url)
+    return urls
+
+def download_candidates(data, out_stem):
+    """
+    Downloads every candidate of a generation, scores them with
+    image_quality.score_image and keeps the best at `out_stem` + ext.
+    The others are kept as `out_stem_altN` + ext. Candidates that fail to
+    download or decode are dropped. Returns (best, alternates) where best is
+    {"path", **scores} and alternates a best-first list of the same, or
+    (None, []) when no candidate is usable.
+    """
+    ranked = []
+    for i, url in enumerate(extract_image_urls(data)):
+        ext = os.path.splitext(urlparse(url).path)[1] or '.jpg'
+        path = f"{out_stem}_cand{i}{ext}"
+        if not download_content(url, path):
+            continue
+        try:
+            ranked.append((path, score_image(path)))
+        except Exception as e:
+            logging.error(f"Skipping undecodable candidate {path}: {e}")
+            os.remove(path)
+    if not ranked:
+        logging.error(f"No usable image candidates for {out_stem}")
+        return None, []
+
+    ranked.sort(key=lambda item: item[1]["score"], reverse=True)
+    best_tmp, best_scores = ranked[0]
+    best_path = out_stem + os.path.splitext(best_tmp)[1]
+    os.replace(best_tmp, best_path)
+    alternates = []
+    for n, (path, scores) in enumerate(ranked[1:], 1):
+        alt_path = f"{out_stem}_alt{n}{os.path.splitext(path)[1]}"
+        os.replace(path, alt_path)
+        alternates.append({"path": alt_path, **scores})
+    logging.info(f"Picked {best_path} (score {best_scores['score']}) from {len(ranked)} candidate(s)")
+    return {"path": best_path, **best_scores}, alternates
+
+def use_alternate(visual, index=0, upscale=None):
+    """
+    Swaps a visual's image with one of its stored alternates, so a bad pick
+    can be replaced without a new generation. The replaced image becomes an
+    alternate in turn. Alternates are raw candidates, so the swap happens on
+    `raw_image_path` when the visual was upscaled; the new pick is upscaled
+    with `upscale(path) -> (path, plan)` if given, otherwise it is used raw
+    and the stale upscale plan is dropped.
+    """
+    alternates = visual.get('alternates', [])
+    if index >= len(alternates):
+        return visual
+    chosen = alternates.pop(index)
+    current = visual.pop('raw_image_path', None) or visual.get('image_path')
+    if current:
+        alternates.append({"path": current, **visual.get('quality', {})})
+    raw_path = chosen.pop('path')
+    visual['quality'] = chosen
+    visual.pop('upscale', None)
+    visual['image_path'] = raw_path
+    if upscale:
+        path, plan = upscale(Path(raw_path))
+        if str(path) != raw_path:
+            visual['raw_image_path'] = raw_path
+        visual['image_path'] = str(path)
+        visual['upscale'] = plan
+    return visual
+
 def download_content(url, filename):
+    """
+    Downloads `url` to `filename` via a .part file, so a failed download never
+    leaves a truncated file behind. Returns True on success.
+    """
+    tmp = filename + '.part'
     try:
         response = requests.get(url, stream=True)
         response.raise_for_status()
-        with open(filename, 'wb') as f:
+        with open(tmp, 'wb') as f:
             for chunk in response.iter_content(1024):
                 f.write(chunk)
+        os.replace(tmp, filename)
         logging.info(f"Downloaded content to {filename}")
+        return True
     except Exception as err:
         logging.error(f"Download error: {err}")
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        return False
 
 def process_visuals(script_path, output_script_path=None):
     try:
@@ -148,13 +351,12 @@ def process_visuals(script_path, output_script_path=None):
                 result = poll_generation_status(gen_id)
                 if not result:
                     continue
-                img_url = extract_image_url(result)
-                if not img_url:
+                best, alternates = download_candidates(result, os.path.join(OUTPUT_DIR, f'section_{idx}_image'))
+                if not best:
                     continue
-                ext = os.path.splitext(urlparse(img_url).path)[1] or '.jpg'
-                out_path = os.path.join(OUTPUT_DIR, f'section_{idx}_image{ext}')
-                download_content(img_url, out_path)
-                section['visual']['image_path'] = out_path
+                section['visual']['image_path'] = best.pop('path')
+                section['visual']['quality'] = best
+                section['visual']['alternates'] = alternates
             for seg_i, seg in enumerate(section.get('segments', []), 1):
                 prompt = seg.get('visual', {}).get('prompt')
                 if prompt:
@@ -163,11 +365,14 @@ def process_visuals(script_path, output_script_path=None):
                     result = poll_generation_status(gen_id)
                     if not result:
                         continue
-                    img_url = extract_image_url(result)
-                    ext = os.path.splitext(urlparse(img_url).path)[1] or '.jpg'
-                    out_path = os.path.join(OUTPUT_DIR, f'section_{idx}_segment_{seg_i}_image{ext}')
-                    download_content(img_url, out_path)
-                    seg['visual']['image_path'] = out_path
+                    best, alternates = download_candidates(
+                        result, os.path.join(OUTPUT_DIR, f'section_{idx}_segment_{seg_i}_image')
+                    )
+                    if not best:
+                        continue
+                    seg['visual']['image_path'] = best.pop('path')
+                    seg['visual']['quality'] = best
+                    seg['visual']['alternates'] = alternates
         if output_script_path:
             with open(output_script_path, 'w', encoding='utf-8') as f:
                 json.dump(data, f, indent=4)
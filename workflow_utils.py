@@ -2,63 +2,359 @@
 from __future__ import annotations
 
 import os
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
 from pathlib import Path
 import requests
+from PIL import Image
 
 import captions
 from visuals import (
     get_model_config_by_style,
-    generate_image,
-    poll_generation_status,
-    extract_image_url,
-    download_content,
+    prompt_seed,
+    image_cache_key,
+    IMAGE_CACHE,
 )
-from config import VISUALS_DIR
+from image_backends import IMAGE_BACKENDS
+from content_cache import file_digest, make_key, link_or_copy
+from asset_index import ASSET_INDEX, REUSE_THRESHOLD, VARY_THRESHOLD, minhash, similarity, vary_image
+from narration_track import track_spans, to_video_time
+from upscaler import (
+    plan_upscale,
+    local_resize,
+    local_upscale,
+    upscale_remote,
+    remote_available,
+    mark_remote_failed,
+)
+from image_derivatives import DERIVATIVES
+from config import VISUALS_DIR, VIDEO_SIZE
+
+UPSCALE_CONCURRENCY = int(os.getenv("UPSCALE_CONCURRENCY", 2))
+IMAGE_RETRIES = int(os.getenv("IMAGE_RETRIES", 3))
+RETRY_BACKOFF_SECONDS = 5
+DRAFTS_DIR = VISUALS_DIR / "drafts"
+ASSET_REUSE = os.getenv("ASSET_REUSE", "1") != "0"
+
+
+def _with_retries(fn, label: str, attempts: int = IMAGE_RETRIES):
+    """Call ``fn`` until it succeeds, backing off between attempts."""
+    for attempt in range(1, attempts + 1):
+        try:
+            return fn()
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = RETRY_BACKOFF_SECONDS * attempt
+            logging.warning(f"{label} failed (attempt {attempt}/{attempts}): {e}; retrying in {delay}s")
+            time.sleep(delay)
+
+
+def _reuse_asset(source: Path, img_path: Path, score: float, seed: int) -> Path:
+    """Use ``source`` for ``img_path``: as-is above REUSE_THRESHOLD, else a light variation."""
+    if score >= REUSE_THRESHOLD:
+        link_or_copy(source, img_path)
+    else:
+        vary_image(source, img_path, seed)
+    return img_path
+
+
+def upscale_image_remote(img_path: Path, model: str = "x4") -> Path:
+    """Send an image to the upscaler service and save the result next to it.
+
+    Upscaled images are cached by the content hash of the source image, so an
+    unchanged image is never sent to the upscaler twice.
+    """
+    upscaled_path = img_path.parent / f"upscaled_{img_path.name}"
+    cache_key = make_key(file_digest(img_path))
+    variant = f"upscaled_{model}"
+    if IMAGE_CACHE.materialize(cache_key, variant, upscaled_path):
+        logging.info(f"Upscale cache hit for {img_path.name}")
+        return upscaled_path
+
+    upscale_remote(img_path, upscaled_path, model=model)
+    IMAGE_CACHE.put(cache_key, variant, upscaled_path, link=True)
+    return upscaled_path
+
+
+def _target_size(script: dict) -> tuple[int, int]:
+    """Video size from the script settings, as parsed by the assembler."""
+    size = script.get("settings", {}).get("video_size", "")
+    if "x" in size:
+        w, h = size.split("x")
+        return int(w), int(h)
+    return VIDEO_SIZE
+
+
+def upscale_for_target(img_path: Path, target_size: tuple[int, int]) -> tuple[Path, dict]:
+    """Bring an image up to ``target_size`` using the cheapest sufficient route.
+
+    Returns the path to use for rendering and the upscale plan. Small scales,
+    and any scale while the remote upscaler is unhealthy or failing, are
+    handled by the local CPU backend (``plan["method"] == "local"``). The
+    render-size derivative is prepared here so the assembler never decodes
+    the full image.
+    """
+    with Image.open(img_path) as img:
+        plan = plan_upscale(img.size, target_size)
+
+    path = img_path
+    upscaled_path = img_path.parent / f"upscaled_{img_path.name}"
+    if plan["model"] and not remote_available():
+        plan.update(method="local", model=None, local_resize=False, fallback=True)
+        path = local_upscale(img_path, upscaled_path, target_size)
+    elif plan["model"]:
+        try:
+            path = upscale_image_remote(img_path, model=plan["model"])
+        except requests.RequestException as e:
+            logging.warning(f"Remote upscale of {img_path.name} failed ({e}); upscaling locally")
+            mark_remote_failed()
+            plan.update(method="local", model=None, local_resize=False, fallback=True)
+            path = local_upscale(img_path, upscaled_path, target_size)
+        else:
+            if plan["local_resize"]:
+                path = local_resize(path, upscaled_path, target_size)
+    elif plan["local_resize"]:
+        plan["method"] = "local"
+        path = local_upscale(img_path, upscaled_path, target_size)
+    DERIVATIVES.prepare(path, render_sizes=[target_size])
+    return path, plan
+
+
+def generate_and_download_images(
+    script: dict,
+    generate_workers: int | None = None,
+    upscale_workers: int = UPSCALE_CONCURRENCY,
+    retries: int = IMAGE_RETRIES,
+    tier: str = "final",
+    select=None,
+    reuse_assets: bool = ASSET_REUSE,
+) -> dict:
+    """Generate visuals for each segment and save the upscaled images.
+
+    Each image is only upscaled as far as the script's ``video_size`` needs;
+    the chosen route is recorded in ``visual["upscale"]``. Generation and
+    upscaling run in separate bounded pools, so segment N is upscaled while
+    segment N+1 is still generating. Each step is retried on its own; results
+    are written back into the segments they belong to, so script order is
+    kept regardless of completion order. Segments that still fail are
+    reported together once every other segment has finished.
 
+    Every segment's seed is recorded in ``visual["seed"]`` and reused on later
+    runs. With ``tier="draft"`` images are generated small and with few steps
+    into ``DRAFTS_DIR`` for storyboard review, are not upscaled, and are
+    recorded in ``visual["draft"]``. ``select(section, segment)`` limits the
+    run to the segments it returns true for.
 
-def generate_and_download_images(script: dict) -> dict:
-    """Generate visuals for each segment and save the upscaled images."""
+    With ``reuse_assets``, a segment whose prompt is similar enough to an
+    earlier segment of the run, or to an image in the asset index, reuses
+    that image (or a light variation of it) instead of a Flux generation;
+    the match is recorded in ``visual["reused_from"]``.
+
+    Images are generated through the backend registry in ``image_backends``,
+    which spreads work over the configured backends and fails over between
+    them; ``generate_workers`` defaults to their combined concurrency and the
+    backend used is recorded in ``visual["image_backend"]``. Leonardo's
+    other candidates are recorded in ``visual["alternates"]`` (with the pick's
+    scores in ``visual["quality"]``) for ``visuals2.use_alternate``; those
+    describe raw candidates, so an upscaled pick keeps its raw file in
+    ``visual["raw_image_path"]``.
+    """
     model_config = get_model_config_by_style(
-        script["settings"].get("image_generation_style")
+        script["settings"].get("image_generation_style"), tier=tier
     )
+    draft = tier == "draft"
+    target_size = _target_size(script)
+    jobs = []
     for section in script.get("sections", []):
         for segment in section.get("segments", []):
-            prompt = segment["visual"]["prompt"]
-            generation_id = generate_image(prompt, model_config)
-            if not generation_id:
-                raise RuntimeError(
-                    f"Failed to start image generation for prompt: {prompt}"
-                )
-            data = poll_generation_status(generation_id)
-            if not data:
-                raise RuntimeError("Image generation did not complete.")
-            image_url = extract_image_url(data)
-            if not image_url:
-                raise RuntimeError("Could not extract image URL.")
+            if select and not select(section, segment):
+                continue
+            visual = segment["visual"]
+            for key in ("reused_from", "image_backend", "alternates", "quality", "raw_image_path"):
+                visual.pop(key, None)
+            if visual.get("seed") is None:
+                visual["seed"] = model_config["seed"]
+                if visual["seed"] is None:
+                    visual["seed"] = prompt_seed(visual["prompt"])
             img_filename = (
                 f"section_{section['section_number']}_segment_{segment['segment_number']}.png"
             )
-            img_path = VISUALS_DIR / img_filename
-            download_content(image_url, str(img_path))
-
-            upscaled_path = img_path.parent / f"upscaled_{img_path.name}"
-            with open(img_path, "rb") as f:
-                resp = requests.post(
-                    "http://192.168.1.154:5700/upscale?model=x4",
-                    files={"file": f},
-                    timeout=600,
-                )
-                resp.raise_for_status()
-                upscaled_path.write_bytes(resp.content)
-            segment["visual"]["image_path"] = str(upscaled_path)
+            jobs.append((segment, (DRAFTS_DIR if draft else VISUALS_DIR) / img_filename))
+    if draft:
+        DRAFTS_DIR.mkdir(parents=True, exist_ok=True)
+
+    # Plan reuse: segments close to an indexed image (earlier runs) or to an
+    # earlier segment of this run reuse or vary that image instead of generating
+    reuse = {}      # idx -> (cached source path, similarity, description)
+    followers = {}  # primary idx -> [(idx, similarity)]
+    if reuse_assets:
+        primaries = []
+        for idx, (segment, img_path) in enumerate(jobs):
+            prompt = segment["visual"]["prompt"]
+            signature = minhash(prompt)
+            in_run = max(
+                ((p_idx, similarity(signature, p_sig)) for p_idx, p_sig in primaries),
+                key=lambda item: item[1],
+                default=(None, 0.0),
+            )
+            if in_run[1] >= VARY_THRESHOLD:
+                followers.setdefault(in_run[0], []).append((idx, in_run[1]))
+                continue
+            # The best match may have been evicted from the image cache; try the next
+            for entry, score in ASSET_INDEX.find(prompt, model_config["width"], model_config["height"]):
+                cached = IMAGE_CACHE.get(entry["cache_key"], "raw")
+                if cached:
+                    reuse[idx] = (cached, score, f"indexed prompt {entry['prompt']!r}")
+                    break
+                ASSET_INDEX.discard(entry["cache_key"])
+            primaries.append((idx, signature))
+
+    failures = {}
+    extras = {}  # idx -> backend extras (alternates, quality)
+    with ThreadPoolExecutor(max_workers=generate_workers or IMAGE_BACKENDS.capacity()) as gen_pool, \
+            ThreadPoolExecutor(max_workers=upscale_workers) as up_pool:
+        pending = {}
+
+        def submit_generation(idx):
+            segment, img_path = jobs[idx]
+            cfg = {**model_config, "seed": segment["visual"]["seed"]}
+            # Leonardo's other candidates are kept for visuals2.use_alternate
+            info = extras.setdefault(idx, {})
+            pending[gen_pool.submit(
+                _with_retries,
+                lambda: IMAGE_BACKENDS.generate(segment["visual"]["prompt"], cfg, img_path, info=info),
+                f"Generation of {img_path.name}",
+                retries,
+            )] = ("generate", idx)
+
+        def submit_reuse(idx, source, score, description):
+            segment, img_path = jobs[idx]
+            segment["visual"]["reused_from"] = {
+                "source": description,
+                "similarity": round(score, 3),
+                "mode": "reuse" if score >= REUSE_THRESHOLD else "vary",
+            }
+            pending[gen_pool.submit(
+                _reuse_asset, Path(source), img_path, score, segment["visual"]["seed"]
+            )] = ("reuse", idx)
+
+        following = {f_idx for group in followers.values() for f_idx, _ in group}
+        for idx in range(len(jobs)):
+            if idx in reuse:
+                submit_reuse(idx, *reuse[idx])
+            elif idx not in following:
+                submit_generation(idx)
+
+        while pending:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for fut in done:
+                stage, idx = pending.pop(fut)
+                segment, img_path = jobs[idx]
+                visual = segment["visual"]
+                try:
+                    result = fut.result()
+                except Exception as e:
+                    if stage == "reuse" and isinstance(e, FileNotFoundError):
+                        # The source was evicted or deleted since planning; generate instead
+                        logging.info(f"Reuse source for {img_path.name} is gone ({e}); generating it")
+                        visual.pop("reused_from", None)
+                        submit_generation(idx)
+                        continue
+                    failures[idx] = e
+                    # Followers of a failed image generate their own
+                    for f_idx, _ in followers.pop(idx, []):
+                        submit_generation(f_idx)
+                    continue
+
+                if stage == "upscale":
+                    path, plan = result
+                    if Path(path) != img_path:
+                        visual["raw_image_path"] = str(img_path)
+                    visual["image_path"] = str(path)
+                    visual["upscale"] = plan
+                    continue
+
+                if stage == "generate":
+                    result, visual["image_backend"] = result
+                    visual.update(extras.pop(idx, {}))
+                # Only Flux results land in the image cache the index points at
+                if stage == "generate" and not draft and visual["image_backend"] == "flux":
+                    ASSET_INDEX.add(
+                        visual["prompt"],
+                        image_cache_key(visual["prompt"], {**model_config, "seed": visual["seed"]}),
+                        model_config["width"],
+                        model_config["height"],
+                    )
+                for f_idx, score in followers.pop(idx, []):
+                    submit_reuse(f_idx, result, score, f"segment {img_path.stem}")
+                if draft:
+                    visual["draft"] = {
+                        "image_path": str(result),
+                        "width": model_config["width"],
+                        "height": model_config["height"],
+                        "num_inference_steps": model_config["num_inference_steps"],
+                    }
+                    continue
+                pending[up_pool.submit(
+                    _with_retries,
+                    lambda path=result: upscale_for_target(path, target_size),
+                    f"Upscale of {img_path.name}",
+                    retries,
+                )] = ("upscale", idx)
+
+    ASSET_INDEX.flush()
+    reused = sum(1 for segment, _ in jobs if "reused_from" in segment["visual"])
+    if reused:
+        logging.info(f"Reused or varied {reused} existing image(s) instead of generating")
+    logging.info(f"Image cache stats: {IMAGE_CACHE.stats()}")
+    logging.info(f"Image backend stats: {IMAGE_BACKENDS.stats()}")
+    if failures:
+        details = "; ".join(
+            f"{jobs[idx][1].name}: {err}" for idx, err in sorted(failures.items())
+        )
+        raise RuntimeError(f"Image stage failed for {len(failures)} segment(s): {details}")
     return script
 
 
-def create_captions(video_path: str) -> list[dict]:
-    """Generate Whisper captions for a video."""
-    audio_temp = captions.extract_audio(video_path)
-    transcription = captions.transcribe_audio_whisper(audio_temp)
+def promote_to_final(script: dict, approved=None, **kwargs) -> dict:
+    """Regenerate approved draft segments at full quality.
+
+    ``approved`` is an iterable of ``(section_number, segment_number)`` pairs;
+    by default segments whose visual has ``"approved": true`` are promoted.
+    Each keeps the seed of its draft so the composition stays the same.
+    """
+    wanted = set(approved) if approved is not None else None
+
+    def select(section: dict, segment: dict) -> bool:
+        if wanted is None:
+            return bool(segment["visual"].get("approved"))
+        return (section["section_number"], segment["segment_number"]) in wanted
+
+    return generate_and_download_images(script, tier="final", select=select, **kwargs)
+
+
+def create_captions(video_path: str, chunked: bool = False, script: dict | None = None) -> list[dict]:
+    """Generate Whisper captions for a video.
+
+    With ``chunked`` the audio is split at silences and transcribed in parallel.
+    When ``script`` (as written back by ``assemble_video``) has a narration
+    track, that file is transcribed instead of audio extracted from the video,
+    and caption times are mapped onto the video with the segment offsets.
+    """
+    track = (script or {}).get("narration_track") or {}
+    spans = track_spans(script) if track.get("path") and Path(track["path"]).exists() else []
+    audio_temp = None if spans else captions.extract_audio(video_path)
+    audio_file = track["path"] if spans else audio_temp
+    if chunked:
+        transcription = captions.transcribe_audio_chunked(audio_file)
+    else:
+        transcription = captions.transcribe_audio_whisper(audio_file)
     cap_list = captions.generate_captions_from_whisper(transcription)
+    for cap in cap_list if spans else []:
+        cap["start"] = to_video_time(cap["start"], spans)
+        cap["end"] = to_video_time(cap["end"], spans)
     try:
         if audio_temp and Path(audio_temp).exists():
             Path(audio_temp).unlink()
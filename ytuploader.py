@@ -12,7 +12,8 @@ from googleapiclient.http import MediaFileUpload
 from google.oauth2.credentials import Credentials
 from google.auth.transport.requests import Request
 from dotenv import load_dotenv
-from PIL import Image
+
+from image_derivatives import DERIVATIVES, YOUTUBE_THUMBNAIL
 
 load_dotenv()
 logging.basicConfig(level=logging.DEBUG, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -99,22 +100,8 @@ def upload(json_path):
     thumbnail_path = metadata.get("thumbnails", {}).get("youtube")
     if thumbnail_path and os.path.exists(thumbnail_path):
         try:
-            orig_path = thumbnail_path
-            img = Image.open(orig_path).convert("RGB")
-            temp_thumb = orig_path.replace(".png", "_resized.jpg").replace(".webp", "_resized.jpg")
-
-            max_width = 1280
-            max_height = 720
-            img.thumbnail((max_width, max_height), Image.ANTIALIAS)
-
-            for quality in [90, 85, 80, 75, 70, 65, 60, 55, 50]:
-                img.save(temp_thumb, format="JPEG", quality=quality, optimize=True)
-                if os.path.getsize(temp_thumb) <= 2 * 1024 * 1024:
-                    break
-            else:
-                raise ValueError("Could not reduce thumbnail under 2MB")
-
-            thumbnail_path = temp_thumb
+            # Fit within 1280x720 and compress under 2MB; reused if already prepared
+            thumbnail_path = str(DERIVATIVES.upload_image(thumbnail_path, YOUTUBE_THUMBNAIL))
             logging.info(f"Uploading thumbnail from {thumbnail_path}")
             youtube.thumbnails().set(
                 videoId=video_id,